@@ -0,0 +1,91 @@
+"""
+Compare the ways of fitting significant locations to reduced GPS points: the original approach
+(expanding the points into duplicate rows, fitting every k below k_max and refitting the chosen
+one), and `fit_locations` with KMeans, MiniBatchKMeans and a weighted sample of the points.
+
+    python benchmarks/significant_locations_benchmark.py --fixes 200000 --places 6
+
+For each method, prints the runtime, the k chosen, and the largest distance (in meters) from one
+of the `--places` most visited centroids of the original approach to the nearest centroid found
+by the method.
+"""
+import argparse
+import time
+import sys, os
+import numpy as np
+from sklearn.cluster import KMeans
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from cortex.primary.significant_locations import reduce_locations, fit_locations, _nearest, EARTH_RADIUS
+
+
+def original_fit(latitude, longitude, count, k_max=10):
+    """
+    The KMeans fit as it was before it used weights: duplicate rows, a full sweep, and a refit.
+    """
+    X = np.repeat(np.stack([latitude, longitude], axis=1), count, axis=0)
+    kmeans = [KMeans(n_clusters=i) for i in range(1, min(k_max, len(X)))]
+    score = [kmeans[i].fit(X).score(X) for i in range(len(kmeans))]
+    for i in range(len(score)):
+        if i == len(score) - 1:
+            k = i + 1
+            break
+        elif abs(score[i + 1] - score[i] < .01):
+            k = i + 1
+            break
+    centers = KMeans(n_clusters=k, init='k-means++').fit(X).cluster_centers_
+    return centers[np.argsort(-np.bincount(_nearest(centers, X), minlength=k), kind='stable')]
+
+
+def make_points(fixes, places, seed=0):
+    """
+    Reduce a synthetic GPS trace: fixes scattered around a few places in one city, visited with
+    decreasing frequency, and some fixes in transit between them.
+    """
+    rng = np.random.default_rng(seed)
+    centers = np.array([42.36, -71.06]) + rng.uniform(-.1, .1, size=(places, 2))
+    visits = rng.choice(places, fixes, p=1 / np.arange(1, places + 1) / (1 / np.arange(1, places + 1)).sum())
+    coords = centers[visits] + rng.normal(scale=3e-5, size=(fixes, 2))
+    transit = rng.random(fixes) < .05
+    coords[transit] = np.array([42.36, -71.06]) + rng.uniform(-.1, .1, size=(transit.sum(), 2))
+    return reduce_locations(coords[:, 0], coords[:, 1])
+
+
+def agreement(expected, actual):
+    """
+    The largest distance (m) from an expected centroid to the nearest actual one.
+    """
+    e, a = np.radians(expected)[:, None, :], np.radians(actual)[None, :, :]
+    h = (np.sin((e[..., 0] - a[..., 0]) / 2) ** 2 +
+         np.cos(e[..., 0]) * np.cos(a[..., 0]) * np.sin((e[..., 1] - a[..., 1]) / 2) ** 2)
+    return (2 * EARTH_RADIUS * 1000 * np.arcsin(np.sqrt(h))).min(axis=1).max()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--fixes', type=int, default=100000)
+    parser.add_argument('--places', type=int, default=5)
+    parser.add_argument('--k_max', type=int, default=10)
+    parser.add_argument('--max_points', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    latitude, longitude, count = make_points(args.fixes, args.places)
+    print(f'{args.fixes} fixes reduced to {len(count)} points')
+    methods = {
+        'original': lambda: original_fit(latitude, longitude, count, k_max=args.k_max),
+        'kmeans': lambda: fit_locations(latitude, longitude, count, k_max=args.k_max),
+        'minibatch': lambda: fit_locations(latitude, longitude, count, k_max=args.k_max, minibatch=True),
+        'coreset': lambda: fit_locations(latitude, longitude, count, k_max=args.k_max,
+                                         max_points=args.max_points),
+        'minibatch+coreset': lambda: fit_locations(latitude, longitude, count, k_max=args.k_max,
+                                                   minibatch=True, max_points=args.max_points),
+    }
+    expected = None
+    for method, fit in methods.items():
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            centroids = fit()
+            elapsed = time.perf_counter() - start
+            expected = centroids if expected is None else expected
+            print(f'{method:>18}: {elapsed:8.3f}s  k={len(centroids)}  '
+                  f'max centroid distance={agreement(expected[:args.places], centroids):9.1f}m')
@@ -5,18 +5,59 @@ import yaml
 import LAMP
 import logging
 import argparse
+import numpy as np
 import pandas as pd
 from pprint import pprint
 from inspect import getargspec
 import compress_pickle as pickle
 import tarfile
 import re
+import time
+import threading
+import sqlite3
+from contextlib import closing, contextmanager
+from concurrent.futures import ProcessPoolExecutor
 #from .raw import sensors_results, cognitive_games_results, surveys_results # FIXME REMOVE LATER
 
 # Get a universal logger to share with all feature functions.
 logging.basicConfig(stream=sys.stderr, level=logging.DEBUG, format="[%(levelname)s:%(module)s:%(funcName)s] %(message)s")
 log = logging.getLogger('cortex')
 
+# Cached raw features are saved as `<feature>_<id>_<start>_<end>.cortex[.<compression>]` files
+# and looked up through an SQLite index kept alongside them in the caching directory.
+CACHE_INDEX = 'index.cortex.db'
+# Set `CORTEX_CACHE_FORMAT=parquet` to store the raw features below column-by-column (requires
+# `pyarrow`, e.g. `pip install LAMP-cortex[parquet]`), so reads can skip row groups outside the
+# requested window; the rest stay pickled. These are the column types of raw features returned as
+# DataFrames (`as_frame=True`); the cache keeps float columns as float64, so cached data is
+# returned as lists of dicts with the same values as the API.
+RAW_SCHEMA = {
+    'gps': {'timestamp': 'int64', 'latitude': 'float64', 'longitude': 'float64',
+            'altitude': 'float64', 'accuracy': 'float64'},
+    'accelerometer': {'timestamp': 'int64', 'x': 'float32', 'y': 'float32', 'z': 'float32'},
+}
+CACHE_ROW_GROUP_SIZE = 100000
+_CACHE_FILE = re.compile(r'^(?P<name>.+)_(?P<id>[^_]+)_(?P<start>-?\d+)_(?P<end>-?\d+)\.cortex(\.\w+)?$')
+
+# Raw features called with `stream=True` fetch STREAM_PAGE_SIZE (or `limit`) events at a time and
+# yield them as DataFrames of `chunk_size` (or STREAM_CHUNK_SIZE) rows. Raw features are cached in
+# segments of up to STREAM_SEGMENT_SIZE events, whether streamed or not.
+STREAM_PAGE_SIZE = 20000
+STREAM_CHUNK_SIZE = 100000
+STREAM_SEGMENT_SIZE = 500000
+
+# The LAMP API connection shared by every feature call (and thread) in this process.
+_connection = {'key': None}
+_connection_lock = threading.Lock()
+
+# Feature results are memoized while a `memoize()` scope is active in this thread. Raw feature
+# results are kept regardless of these parameters, which don't change the events returned (a
+# list of dicts also serves calls for a DataFrame), and primary feature results regardless of
+# where the raw data is cached.
+_memo = threading.local()
+_MEMO_IGNORED = ('start', 'end', 'resolution', 'limit', 'cache', 'cache_dir', 'as_frame')
+_MEMO_IGNORED_PRIMARY = ('start', 'end', 'cache', 'cache_dir')
+
 # List all registered features (raw, primary, secondary).
 __features__ = []
 def all_features():
@@ -46,13 +87,18 @@ def raw_feature(name, dependencies):
                     raise Exception(f"parameter `{param}` is required but missing")
 
             # Connect to the LAMP API server.
-            if not 'LAMP_ACCESS_KEY' in os.environ or not 'LAMP_SECRET_KEY' in os.environ:
-                raise Exception(f"You configure `LAMP_ACCESS_KEY` and `LAMP_SECRET_KEY` (and optionally `LAMP_SERVER_ADDRESS`) to use Cortex.")
-            LAMP.connect(os.getenv('LAMP_ACCESS_KEY'), os.getenv('LAMP_SECRET_KEY'),
-                         os.getenv('LAMP_SERVER_ADDRESS', 'api.lamp.digital'))
+            _connect()
+
+            # Serve the events from a memoized result covering this window, if any.
+            memoized = not kwargs.get('stream') and kwargs.get('recursive', True)
+            if memoized:
+                _event = _memo_get('raw', name, kwargs)
+                if _event is not None:
+                    return _event
             
             # Find a valid local cache directory
             cache = kwargs.get('cache')
+            cache_dir = None
 
             if cache is None or cache:
                 if kwargs.get('cache_dir') is not None:
@@ -69,62 +115,58 @@ def raw_feature(name, dependencies):
                     assert os.path.exists(cache_dir), "Default caching directory could not be used, specify an alternative locatiton as a keyword argument: 'cache', or as an enviornmental variable: 'CORTEX_CACHE_DIR'"
                 log.info(f"Cortex caching directory set to: {cache_dir}")   
 
-                log.info(f"Processing raw feature \"{name}\"...")
-
-                # local data caching TODO: combine pickle window with API data
-                found = False
-                for file in [f for f in os.listdir(cache_dir) if f[-7:] == '.cortex']:  # .lamp
-                    path = cache_dir + '/' + file
-                    
-                    if not re.match('^' + name.split('.')[1], file):
-                        continue
-                        
-                    _, rest = re.split('^'+name.split('.')[1]+'_', file)
-                    saved = dict(zip(['id', 'start', 'end'], re.split('.cortex$', rest)[0].split('_')))
-                    saved['name'] = name.split('.')[1]
-                    try:
-                        saved['start'] = int(saved['start'])
-                        saved['end'] = int(saved['end'])
-                    except:
-                        continue
-                        
-                    if saved['start'] <= kwargs['start'] and saved['end'] >= kwargs['end'] and saved['id'] == kwargs['id']:
-                        if file.split('.')[-1] == 'cortex': #if no compression extension, use standard pkl loading
-                            _result = pickle.load(path, 
-                                                  set_default_extension=False,
-                                                  compression=None)
-                        else: 
-                            _result = pickle.load(path)
-                        found = True
+            log.info(f"Processing raw feature \"{name}\"...")
+
+            # Streamed data is yielded in chunks as it is loaded instead of being returned at once.
+            if kwargs.get('stream'):
+                return {'timestamp': kwargs['start'],
+                        'duration': kwargs['end'] - kwargs['start'],
+                        'data': _stream(func, name, cache_dir, args, kwargs)}
+
+            if cache_dir is not None:
+                # Local data caching: serve what the cached segments cover, and fetch only the
+                # missing gaps, caching them merged with the small cached segments next to them.
+                with closing(_cache_index(cache_dir)) as index:
+                    segments, gaps = _cache_segments(index, cache_dir, name.split('.')[-1], kwargs['id'],
+                                                     kwargs['start'], kwargs['end'])
+
+                    covering = [s for s in segments if s[1] <= kwargs['start'] and s[2] >= kwargs['end']]
+                    _result = None
+                    if covering:
                         log.info('Using saved raw data...')
-                        break
-                            
-                if not found:
-                    log.info('No saved raw data found, getting new...')
-                    _result = func(*args, **kwargs)
-                    pickle_path = (cache_dir + '/' +
-                                   name.split('.')[-1] + '_' + 
-                                   kwargs['id'] + '_' +
-                                   str(kwargs['start']) + '_' +
-                                   str(kwargs['end']) + '.cortex')
-                    
-                    if os.getenv('CORTEX_CACHE_COMPRESSION') is not None:
-                        assert os.getenv('CORTEX_CACHE_COMPRESSION') in ['gz', 'bz2', 'lzma', 'zip'], f"Compression method for caching does not exist."
-                        pickle_path += '.' + os.getenv('CORTEX_CACHE_COMPRESSION')
-                    
-                    pickle.dump(_result, 
-                                pickle_path, 
-                                compression=kwargs.get('compression'), 
-                                set_default_extension=False)
-                    
-                    log.info(f"Saving raw data as \"{pickle_path}\"...")
+                        try:
+                            _result = _cache_load(cache_dir, covering[-1][0], kwargs['start'], kwargs['end'],
+                                                  frame=kwargs.get('as_frame'))
+                        except FileNotFoundError:
+                            # Another process merged it into a new segment since it was looked up.
+                            log.info('Saved raw data was moved, looking it up again...')
+                    if _result is None:
+                        if segments:
+                            log.info(f"Using saved raw data, getting {len(gaps)} missing interval(s)...")
+                        else:
+                            log.info('No saved raw data found, getting new...')
+                        # The pieces come oldest first; keep the API's newest-first ordering.
+                        fetch = lambda start, end: [func(*args, **{**kwargs, 'start': start, 'end': end})[::-1]]
+                        _result = [r for data in _cache_pieces(index, cache_dir, name.split('.')[-1], kwargs['id'],
+                                                               kwargs['start'], kwargs['end'], fetch)
+                                   for r in data][::-1]
             else:
                 _result = func(*args, **kwargs)
 
+            if kwargs.get('as_frame'):
+                if not isinstance(_result, pd.DataFrame):
+                    _result = _frame(name.split('.')[-1], _result)
+                _data = _result[(_result['timestamp'] >= kwargs['start']) &
+                                (_result['timestamp'] <= kwargs['end'])].reset_index(drop=True)
+            else:
+                _data = [r for r in _result if r['timestamp'] >= kwargs['start'] and
+                         r['timestamp'] <= kwargs['end']]
+
             _event = {'timestamp': kwargs['start'],
                       'duration': kwargs['end'] - kwargs['start'],
-                      'data': [r for r in _result if r['timestamp'] >= kwargs['start'] and
-                               r['timestamp'] <= kwargs['end']]}
+                      'data': _data}
+            if memoized:
+                _memo_set('raw', name, kwargs, _event)
             return _event
 
         # When we register/save the function, make sure we save the decorated and not the RAW function.
@@ -133,10 +175,184 @@ def raw_feature(name, dependencies):
         return _wrapper2
     return _wrapper1
 
+def _stream(func, name, cache_dir, args, kwargs):
+    """
+    Helper function that yields raw feature data oldest first, as DataFrames of `chunk_size` rows,
+    fetching the gaps in the cache a page at a time
+    """
+    feature, chunk_size = name.split('.')[-1], kwargs.get('chunk_size') or STREAM_CHUNK_SIZE
+    index = _cache_index(cache_dir) if cache_dir is not None else None
+    try:
+        buffer = []
+        for data in _cache_pieces(index, cache_dir, feature, kwargs['id'], kwargs['start'], kwargs['end'],
+                                  lambda start, end: _stream_pages(func, args, kwargs, start, end)):
+            buffer += data
+            while len(buffer) >= chunk_size:
+                yield _frame(feature, buffer[:chunk_size])
+                buffer = buffer[chunk_size:]
+        if buffer:
+            yield _frame(feature, buffer)
+    finally:
+        if index is not None:
+            index.close()
+
+def _cache_pieces(index, cache_dir, name, id, start, end, fetch):
+    """
+    Helper function that yields the raw feature data in [start, end] oldest first, piece by piece
+
+    Each cached segment overlapping (or next to) the time interval is loaded at most once, and
+    only the gaps between them are fetched, with `fetch(start, end)`, which returns pages of
+    events oldest first. Fetched data is cached in segments of up to STREAM_SEGMENT_SIZE events,
+    merged with the small cached segments next to it; larger segments are left as they are, and
+    time intervals without any events are not cached on their own.
+    """
+    if index is None:
+        yield from fetch(start, end)
+        return
+    segments, gaps = _cache_segments(index, cache_dir, name, id, start, end)
+    pieces = sorted(segments + [(None, _start, _end, None) for _start, _end in gaps], key=lambda p: p[1])
+
+    # The data not yet cached (oldest first), the time interval it covers, and the small cached
+    # segments merged into it.
+    pending = {'start': None, 'end': None, 'data': [], 'files': []}
+    covered = None
+    for i, (file, _start, _end, count) in enumerate(pieces):
+        if file is not None:
+            # A segment can be merged into the pending data if the data covers all of it from its
+            # start (the segments looked up again below may start before the data does).
+            if pending['start'] is not None:
+                mergeable = _start >= pending['start']
+            else:
+                mergeable = (covered is None or _start > covered) and i + 1 < len(pieces) and pieces[i + 1][0] is None
+            small = count is None or count < STREAM_SEGMENT_SIZE
+            if not (mergeable and small) and (_end < start or _start > end):
+                # A large segment next to the interval has nothing in it to read or merge.
+                _stream_save(index, cache_dir, name, id, pending)
+                data = None
+            else:
+                # Large segments are read only within the interval (which skips the rest of them,
+                # if stored column-by-column).
+                try:
+                    data = _cache_load(cache_dir, file, *((None, None) if small else (start, end)))
+                except FileNotFoundError:
+                    # Another process merged the segment into a new one since it was looked up, so
+                    # look up what covers its part of the interval now, and continue with that.
+                    with index:
+                        index.execute("DELETE FROM cache WHERE file = ?", (file,))
+                    _start, _end = max(_start, start, covered + 1 if covered is not None else start), min(_end, end)
+                    if _start <= _end:
+                        more, gaps = _cache_segments(index, cache_dir, name, id, _start, _end)
+                        pieces[i + 1:i + 1] = sorted([p for p in more if p[0] != file] +
+                                                     [(None, s, e, None) for s, e in gaps], key=lambda p: p[1])
+                    continue
+            if data is not None:
+                data = [r for r in reversed(data) if covered is None or r['timestamp'] > covered]
+                if mergeable and small and len(data) < STREAM_SEGMENT_SIZE:
+                    pending['start'] = _start if pending['start'] is None else pending['start']
+                    pending['data'] += data
+                    pending['files'].append(file)
+                    if len(pending['data']) >= STREAM_SEGMENT_SIZE:
+                        _stream_save(index, cache_dir, name, id, pending, partial=True)
+                else:
+                    _stream_save(index, cache_dir, name, id, pending)
+                data = [r for r in data if r['timestamp'] >= start and r['timestamp'] <= end]
+                if data:
+                    yield data
+        else:
+            # A segment looked up again may have covered (part of) this gap already.
+            _start = _start if covered is None else max(_start, covered + 1)
+            if _start > _end:
+                continue
+            pending['start'] = _start if pending['start'] is None else pending['start']
+            for page in fetch(_start, _end):
+                pending['data'] += page
+                if len(pending['data']) >= STREAM_SEGMENT_SIZE:
+                    _stream_save(index, cache_dir, name, id, pending, partial=True)
+                yield page
+        pending['end'] = _end if pending['start'] is not None else None
+        covered = _end if covered is None else max(covered, _end)
+    _stream_save(index, cache_dir, name, id, pending)
+
+def _stream_pages(func, args, kwargs, start, end):
+    """
+    Helper function that pages forward through the raw feature data in [start, end], oldest first,
+    asking for the oldest events (a negative limit) after the previous page each time, and drops
+    the events repeated at the boundary between consecutive pages
+    """
+    limit = abs(kwargs.get('limit') or STREAM_PAGE_SIZE)
+    cursor, seen = start, 0
+    while cursor <= end:
+        page = sorted(func(*args, **{**kwargs, 'start': cursor, 'end': end, 'limit': -limit, 'recursive': False}),
+                      key=lambda r: r['timestamp'])
+        repeated = 0
+        while repeated < min(seen, len(page)) and page[repeated]['timestamp'] == cursor:
+            repeated += 1
+        if repeated == len(page) == limit:
+            # More than a page of events share this timestamp; the API can't page through them.
+            cursor, seen = cursor + 1, 0
+            continue
+        if repeated == len(page):
+            break
+        yield page[repeated:]
+        if len(page) < limit:
+            break
+        last = page[-1]['timestamp']
+        seen = (seen if last == cursor else 0) + sum(1 for r in page if r['timestamp'] == last)
+        cursor = last
+
+def _stream_save(index, cache_dir, name, id, pending, partial=False):
+    """
+    Helper function that caches the data pending in `_cache_pieces`, replacing the segments merged
+    into it, and empties `pending`; if `partial`, only segments of STREAM_SEGMENT_SIZE events are
+    saved, split where the timestamp changes, and the rest is kept pending, since more events at
+    its last timestamp may follow
+    """
+    data = pending['data']
+    while data:
+        if partial:
+            # Split where the timestamp last changes within a segment's worth of events (or, if
+            # it doesn't, where it first changes after that).
+            if len(data) < STREAM_SEGMENT_SIZE:
+                break
+            changes = lambda indices: (i for i in indices if data[i - 1]['timestamp'] != data[i]['timestamp'])
+            split = next(changes(range(min(STREAM_SEGMENT_SIZE, len(data) - 1), 0, -1)), None) or \
+                next(changes(range(STREAM_SEGMENT_SIZE + 1, len(data))), None)
+            if split is None:
+                break
+            _end = data[split]['timestamp'] - 1
+        else:
+            split, _end = len(data), pending['end']
+        file = _cache_save(cache_dir, name, id, pending['start'], _end, data[:split][::-1])
+        _index_cache_file(index, file, split)
+        log.info(f"Saving raw data as \"{cache_dir + '/' + file}\"...")
+        for old in pending['files']:
+            if old != file:
+                try:
+                    os.remove(cache_dir + '/' + old)
+                except FileNotFoundError:
+                    # Another process sharing the cache merged it into a segment of its own.
+                    pass
+                with index:
+                    index.execute("DELETE FROM cache WHERE file = ?", (old,))
+        pending['files'] = []
+        if not partial:
+            break
+        data = data[split:]
+        pending['start'] = _end + 1
+    if partial:
+        pending['data'] = data
+    else:
+        pending.update({'start': None, 'end': None, 'data': [], 'files': []})
+
 # Primary features.
-def primary_feature(name, dependencies, attach):
+def primary_feature(name, dependencies, attach, incremental=False):
     """
     Some explanation of how to use this decorator goes here.
+
+    Features with `attach` and `incremental` set resume where they were last computed to: the
+    function gets the `state` it returned last time (or None), and returns a (result, state)
+    tuple, where the state has the 'end' timestamp up to which the result is complete. The state
+    is saved in the `<name>.state` attachment, and only results after it are computed.
     """
     def _wrapper1(func):
         def _wrapper2(*args, **kwargs):
@@ -156,10 +372,11 @@ def primary_feature(name, dependencies, attach):
                     raise Exception(f"parameter `{param}` is required but missing")
             
             # Connect to the LAMP API server.
-            if not 'LAMP_ACCESS_KEY' in os.environ or not 'LAMP_SECRET_KEY' in os.environ:
-                raise Exception(f"You must configure `LAMP_ACCESS_KEY` and `LAMP_SECRET_KEY` (and optionally `LAMP_SERVER_ADDRESS`) to use Cortex.")
-            LAMP.connect(os.getenv('LAMP_ACCESS_KEY'), os.getenv('LAMP_SECRET_KEY'),
-                        os.getenv('LAMP_SERVER_ADDRESS', 'api.lamp.digital'))
+            _connect()
+
+            _event = _memo_get('primary', name, kwargs)
+            if _event is not None:
+                return _event
             
             log.info(f"Processing primary feature \"{name}\"...")
 
@@ -167,24 +384,36 @@ def primary_feature(name, dependencies, attach):
 
             #Get previously calculated primary feature results from attachments, if you do attach.
             if attach:
+                state = None
                 try: 
                    attachments = LAMP.Type.get_attachment(kwargs['id'], name)['data']
-                   # remove last in case interval still open 
-                   attachments.remove(max(attachments, key=lambda x: x['end']))
-                   _from = max(a['end'] for a in attachments)
+                   if incremental:
+                       # resume after the end of the saved state
+                       state = LAMP.Type.get_attachment(kwargs['id'], name + '.state')['data']
+                       if not isinstance(attachments, list):
+                           raise ValueError(f"\"{name}\" was reset")
+                       _from = state['end'] + 1
+                   else:
+                       # remove last in case interval still open 
+                       attachments.remove(max(attachments, key=lambda x: x['end']))
+                       _from = max(a['end'] for a in attachments)
                    log.info(f"Using saved \"{name}\"...")
                 except LAMP.ApiException: 
                    attachments = []
+                   state = None
                    _from = 0 
                    log.info(f"No saved \"{name}\" found...")
                 except Exception:
                     attachments = []
+                    state = None
                     _from = 0 
                     log.info(f"Saved \"{name}\" could not be parsed, discarding...")
 
                 start=kwargs.pop('start')
                 if _from > kwargs['end']:
                     _result=[]
+                elif incremental:
+                    _result, state = func(*args, **{**kwargs, 'start':_from, 'state':state})
                 else:
                     _result = func(*args, **{**kwargs, 'start':_from})
 
@@ -196,22 +425,42 @@ def primary_feature(name, dependencies, attach):
                 # Upload new features as attachment.
                 log.info(f"Saving primary feature \"{name}\"...") 
                 LAMP.Type.set_attachment(kwargs['id'], 'me', attachment_key=name, body=_body_new)
+                if incremental and _from <= kwargs['end']:
+                    LAMP.Type.set_attachment(kwargs['id'], 'me', attachment_key=name + '.state', body=state)
             else:
                 _result = func(*args, **kwargs)
                 _event = {'timestamp':kwargs['start'], 'duration': kwargs['end'] - kwargs['start'], 'data':_result}
 
+            # Saved results are returned from `start` on, so a shorter time interval is served
+            # the results from its start on.
+            _memo_set('primary', name, {**kwargs, 'start': _event['timestamp']}, _event,
+                      slicer=(lambda data, start, end: [b for b in data if b['start'] >= start]) if attach else None)
             return _event
 
         # When we register/save the function, make sure we save the decorated and not the RAW function.
         _wrapper2.__name__ = func.__name__
-        __features__.append({ 'name': name, 'type': 'primary', 'dependencies': dependencies, 'callable': _wrapper2 })
+        __features__.append({ 'name': name, 'type': 'primary', 'dependencies': dependencies, 'callable': _wrapper2,
+                              'attach': attach })
         return _wrapper2
     return _wrapper1
 
 # Secondary features.
-def secondary_feature(name, dependencies):
+def secondary_feature(name, dependencies, batched=True, vectorized=False):
     """
     Some explanation of how to use this decorator goes here.
+
+    If `batched`, the raw feature dependencies, and the primary ones saved as attachments, are
+    loaded once for the whole time interval, and the feature function's calls to them for each
+    window are served slices of that data. Other primary features can't be sliced (their results
+    for a window depend on all the data in it), so they are still computed for each window.
+
+    If `vectorized`, the feature function is called once for the whole time interval with the
+    window edges as `bins` (each window is [bins[i], bins[i+1])), and returns a dict of arrays
+    with one value per window, i.e. `{'call_number': _bincount(timestamps, bins)}`.
+
+    Otherwise, calling the feature with `workers=<n>` evaluates the windows in a pool of n
+    processes, each given a contiguous run of windows (with the dependencies loaded, if
+    `batched`, into the cache the workers share before they start).
     """
     def _wrapper1(func):
         def _wrapper2(*args, **kwargs):
@@ -227,35 +476,205 @@ def secondary_feature(name, dependencies):
                 *getargspec(func)[0][:-len(getargspec(func)[3] or ()) or None]
             ]
             for param in params:
-                if kwargs.get(param, None) is None:
+                if kwargs.get(param, None) is None and not (vectorized and param == 'bins'):
                     raise Exception(f"parameter `{param}` is required but missing")
 
             # Connect to the LAMP API server.
-            if not 'LAMP_ACCESS_KEY' in os.environ or not 'LAMP_SECRET_KEY' in os.environ:
-                raise Exception(f"You must configure `LAMP_ACCESS_KEY` and `LAMP_SECRET_KEY` (and optionally `LAMP_SERVER_ADDRESS`) to use Cortex.")
-            LAMP.connect(os.getenv('LAMP_ACCESS_KEY'), os.getenv('LAMP_SECRET_KEY'),
-                        os.getenv('LAMP_SERVER_ADDRESS', 'api.lamp.digital'))
+            _connect()
+
+            workers = kwargs.pop('workers', None)
+            _event = _memo_get('secondary', name, kwargs)
+            if _event is not None:
+                return _event
             
             log.info(f"Processing secondary feature \"{name}\"...")
 
             timestamp_list = list(range(kwargs['start'], kwargs['end'], kwargs['resolution']))
+            windows = [*zip(timestamp_list[:-1], timestamp_list[1:])]
             data = []
-            for window in reversed([*zip(timestamp_list[:-1], timestamp_list[1:])]):
-                window_start, window_end = window[0], window[1]
-                _result = func(**{**kwargs, 'start':window_start, 'end':window_end})
-                data.append(_result)
+            if vectorized and windows:
+                with memoize():
+                    _result = func(**{**kwargs, 'start': timestamp_list[0], 'end': timestamp_list[-1],
+                                      'bins': np.array(timestamp_list)})
+                _result = {k: v.tolist() if isinstance(v, np.ndarray) else list(v) for k, v in _result.items()}
+                data = [{'timestamp': window[0], **{k: v[i] for k, v in _result.items()}}
+                        for i, window in enumerate(windows)]
+            elif not vectorized and workers is not None and workers > 1 and len(windows) > 1:
+                size = -(-len(windows) // workers)
+                groups = [windows[i:i + size] for i in range(0, len(windows), size)]
+                if batched and kwargs.get('cache') is not False:
+                    # Fill the cache (and attachments) once here, so that the workers sharing it
+                    # only read what they load.
+                    _secondary_preload(next(f for f in __features__ if f['name'] == name and f['type'] == 'secondary'),
+                                       windows[0][0], windows[-1][1], kwargs)
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    for _data in pool.map(_secondary_windows, [name] * len(groups), groups,
+                                          [kwargs] * len(groups), [batched] * len(groups)):
+                        data += _data
+            elif not vectorized:
+                data = _secondary_windows(name, windows, kwargs, batched)
                 
             # TODO: Require primary feature dependencies to be primary features (or raw features?)!
             data = sorted(data,key=lambda x: x['timestamp']) if data else []
             _event = {'timestamp': kwargs['start'], 'duration': kwargs['end'] - kwargs['start'], 'resolution':kwargs['resolution'], 'data': data}
 
+            _memo_set('secondary', name, kwargs, _event)
             return _event
         # When we register/save the function, make sure we save the decorated and not the RAW function.
         _wrapper2.__name__ = func.__name__
+        _wrapper2.__wrapped__ = func
         __features__.append({ 'name': name, 'type': 'secondary', 'dependencies': dependencies, 'callable': _wrapper2 })
         return _wrapper2
     return _wrapper1
 
+def _secondary_windows(name, windows, kwargs, batched):
+    """
+    Helper function that evaluates the secondary feature `name` for each of `windows`, loading its
+    raw dependencies once for all of them if `batched`; the feature is looked up by name, since the
+    decorated function can't be pickled and sent to a worker process
+    """
+    feature = next(f for f in __features__ if f['name'] == name and f['type'] == 'secondary')
+    data = []
+    with memoize():
+        if batched and len(windows) > 1:
+            _secondary_preload(feature, windows[0][0], windows[-1][1], kwargs)
+        for window in reversed(windows):
+            window_start, window_end = window[0], window[1]
+            _result = feature['callable'].__wrapped__(**{**kwargs, 'start':window_start, 'end':window_end})
+            data.append(_result)
+    return data
+
+def _secondary_preload(feature, start, end, kwargs):
+    """
+    Helper function that loads the raw dependencies of a secondary feature, and the primary ones
+    saved as attachments, for [start, end], to be memoized (or cached) for its windows
+    """
+    for dep in feature['dependencies']:
+        if any(f['callable'] is dep and (f['type'] == 'raw' or f['type'] == 'primary' and f.get('attach'))
+               for f in __features__):
+            dep(id=kwargs['id'], start=start, end=end,
+                **{k: kwargs[k] for k in ('cache', 'cache_dir') if k in kwargs})
+
+def _bincount(timestamps, bins, weights=None):
+    """
+    Helper function for vectorized secondary features that counts the events (or sums their
+    `weights`) falling in each window [bins[i], bins[i+1]), in one pass over all windows
+    """
+    timestamps = np.asarray(timestamps)
+    idx = np.searchsorted(bins, timestamps, side='right') - 1
+    inside = (idx >= 0) & (idx < len(bins) - 1)
+    if weights is None:
+        return np.bincount(idx[inside], minlength=len(bins) - 1)
+    weights = np.asarray(weights)[inside]
+    sums = np.bincount(idx[inside], weights=weights, minlength=len(bins) - 1)
+    return sums.astype(weights.dtype) if weights.dtype.kind in 'iu' else sums
+
+def _connect():
+    """
+    Helper function that connects to the LAMP API server once per process; the connection, and
+    the pool of HTTP connections it keeps open, is reused until the credentials change
+    """
+    if not 'LAMP_ACCESS_KEY' in os.environ or not 'LAMP_SECRET_KEY' in os.environ:
+        raise Exception(f"You must configure `LAMP_ACCESS_KEY` and `LAMP_SECRET_KEY` (and optionally `LAMP_SERVER_ADDRESS`) to use Cortex.")
+
+    # A forked worker process must not share the parent's open sockets, so it reconnects.
+    key = (os.getpid(), os.getenv('LAMP_ACCESS_KEY'), os.getenv('LAMP_SECRET_KEY'),
+           os.getenv('LAMP_SERVER_ADDRESS', 'api.lamp.digital'))
+    with _connection_lock:
+        if _connection['key'] != key:
+            LAMP.connect(*key[1:])
+            _connection['key'] = key
+
+@contextmanager
+def memoize():
+    """
+    Compute each feature at most once within this scope (per thread), for the same parameters.
+
+    Raw features are also served from a memoized result for a longer time interval, so a raw
+    feature requested for [start, end] up front serves any window within it. Nested scopes
+    share the outermost scope's results, which are discarded when it exits.
+    """
+    outer = getattr(_memo, 'results', None)
+    _memo.results = {} if outer is None else outer
+    try:
+        yield
+    finally:
+        _memo.results = outer
+
+def _memo_key(kind, name, kwargs):
+    """
+    Helper function that identifies a feature call by everything except its time interval
+    """
+    ignored = {'raw': _MEMO_IGNORED, 'primary': _MEMO_IGNORED_PRIMARY}.get(kind, ('start', 'end'))
+    return name, repr(sorted((k, v) for k, v in kwargs.items() if k not in ignored))
+
+def _memo_get(kind, name, kwargs):
+    """
+    Helper function that returns a copy of the memoized result of a feature call, if any
+    """
+    results = getattr(_memo, 'results', None)
+    if results is None:
+        return None
+    for start, end, _event, slicer in results.get(_memo_key(kind, name, kwargs), []):
+        if kind == 'raw' and isinstance(_event['data'], pd.DataFrame) and not kwargs.get('as_frame'):
+            # The typed columns of a DataFrame don't give back the same dicts.
+            continue
+        if start == kwargs['start'] and end == kwargs['end']:
+            data = _event['data']
+        elif slicer is not None and start <= kwargs['start'] and end >= kwargs['end']:
+            data = slicer(_event['data'], kwargs['start'], kwargs['end'])
+        else:
+            continue
+        if kind == 'raw' and kwargs.get('as_frame') and not isinstance(data, pd.DataFrame):
+            data = _frame(name.split('.')[-1], data)
+        log.debug(f"Using memoized \"{name}\"...")
+        return {**_event, 'timestamp': kwargs['start'], 'duration': kwargs['end'] - kwargs['start'],
+                'data': data.copy()}
+    return None
+
+def _memo_set(kind, name, kwargs, _event, slicer=None):
+    """
+    Helper function that memoizes the result of a feature call, if a `memoize()` scope is active;
+    raw feature results (or others, given a `slicer(data, start, end)`) also serve the calls for
+    shorter time intervals within theirs
+    """
+    results = getattr(_memo, 'results', None)
+    if results is not None:
+        # The caller gets `_event` itself, so a copy of its data is kept.
+        _event = {**_event, 'data': _event['data'].copy()}
+        if kind == 'raw':
+            timestamps = _memo_timestamps(_event['data'])
+            slicer = lambda data, start, end: _memo_slice(data, timestamps, start, end)
+        results.setdefault(_memo_key(kind, name, kwargs), []).append((kwargs['start'], kwargs['end'],
+                                                                      _event, slicer))
+
+def _memo_timestamps(data):
+    """
+    Helper function that returns the timestamps of raw feature data in ascending order, if the
+    data is ordered newest first (as returned by raw features), or None otherwise
+    """
+    if isinstance(data, pd.DataFrame):
+        timestamps = data['timestamp'].to_numpy(dtype='float64')[::-1]
+    else:
+        timestamps = np.fromiter((r['timestamp'] for r in data), dtype='float64', count=len(data))[::-1]
+    return timestamps if np.all(timestamps[:-1] <= timestamps[1:]) else None
+
+def _memo_slice(data, timestamps, start, end):
+    """
+    Helper function that slices raw feature data (a list or DataFrame) to [start, end], by binary
+    search on its sorted `timestamps` if given
+    """
+    if timestamps is None:
+        if isinstance(data, pd.DataFrame):
+            return data[(data['timestamp'] >= start) & (data['timestamp'] <= end)].reset_index(drop=True)
+        return [r for r in data if r['timestamp'] >= start and r['timestamp'] <= end]
+    # The data is newest first, so the positions found in `timestamps` are counted from its end.
+    lo = len(data) - np.searchsorted(timestamps, end, side='right')
+    hi = len(data) - np.searchsorted(timestamps, start, side='left')
+    if isinstance(data, pd.DataFrame):
+        return data.iloc[lo:hi].reset_index(drop=True)
+    return data[lo:hi]
+
 def delete_attach(id, features=None):
     """
     Deletes all saved primary features for a participant (requires LAMP-core 2021.4.7 or later)
@@ -278,13 +697,16 @@ def delete_cache(id, features=None, cache_dir=None):
     :param cache_dir (str): path to cache dir, where data will be deleleted
     """
     cache_dir = cache_finder(cache_dir)
-    
+
     #Delete all 'features' in cache_dir for participant
-    for file in [f for f in os.listdir(cache_dir) if f[-7:] == '.cortex']:  # .lamp
-        path = cache_dir + '/' + file
-        saved = dict(zip(['name', 'id', 'start', 'end'], file.split('.')[0].split('_')))
-        if saved['name'] in features and saved['id'] == id:
-            os.remove(path)
+    with closing(_cache_index(cache_dir)) as index:
+        for file, name in index.execute("SELECT file, name FROM cache WHERE id = ?", (id,)).fetchall():
+            if features is not None and name not in features:
+                continue
+            if os.path.exists(os.path.join(cache_dir, file)):
+                os.remove(os.path.join(cache_dir, file))
+            with index:
+                index.execute("DELETE FROM cache WHERE file = ?", (file,))
 
 def export_cache(cache_dir=None, export_dir=None):
     """
@@ -293,43 +715,193 @@ def export_cache(cache_dir=None, export_dir=None):
     :param export_dir (str): path to export directory 
     """
     cache_dir = cache_finder(cache_dir)
-    #Export as *.tar.gz
-    tar = tarfile.open('cache_' + str(int(time.time())*1000) + '.lamp', 'w:gz') #check if override?
     if export_dir is None:
         export_dir = os.path.expanduser(cache_dir)
     else:
-        export_dir = os.path.expanduser()
-        
-    tar.add(cache_dir, 'cache_' + str(int(time.time())*1000) + '.lamp')
+        export_dir = os.path.expanduser(export_dir)
+
+    #Export as *.tar.gz; the index is rebuilt on import, so it is not exported
+    export_name = 'cache_' + str(int(time.time())*1000) + '.lamp'
+    tar = tarfile.open(os.path.join(export_dir, export_name), 'w:gz') #check if override?
+    with closing(_cache_index(cache_dir)) as index:
+        for (file,) in index.execute("SELECT file FROM cache").fetchall():
+            tar.add(os.path.join(cache_dir, file), export_name + '/' + file)
     tar.close()
-    
+
 def import_cache(cache_dir=None, import_dir=None):
     """
     Imports cached raw features from *.tar.gz (saved as *.lamp)
     :param cache_dir (str): path to cache dir, where data will be 
     :param import_dir (str): path to import directory 
     """
-    #Export as *.tar.gz
+    cache_dir = cache_finder(cache_dir)
     if import_dir is not None:
         assert os.path.exists(import_dir), "Import cache could not be found. Please provide a existing path to import_dir."
         try:
             cache = tarfile.open(import_dir, 'r:gz') #check if override?
         except tarfile.ReadError:
-            raise "Cache file was found but could not be read. Please check that it is of proper type *.tz"
-            
+            raise Exception("Cache file was found but could not be read. Please check that it is of proper type *.tz")
+
     else:
-        cache_dir = cache_finder(cache_dir)
         #find any cache in the folder
+        cache = None
         for f in os.listdir(cache_dir):
-            if f.endswith('cortex'):
+            if f.endswith('.lamp'):
                 try:
                     cache = tarfile.open(os.path.join(cache_dir, f), 'r:gz')
-                    return cache
+                    break
                 except:
-                    log.info("Found a file with extension '.cortex' in cache_dir, but unable to read.")
-                    
-        raise Exception("No cache found in cache_dir. Please provide a cache to import via 'import_dir' or provide a 'cache_dir' which contains a importable cache.")
-                    
+                    log.info("Found a file with extension '.lamp' in cache_dir, but unable to read.")
+
+        if cache is None:
+            raise Exception("No cache found in cache_dir. Please provide a cache to import via 'import_dir' or provide a 'cache_dir' which contains a importable cache.")
+
+    # Unpack the cached files flat into cache_dir and add them to the index.
+    with closing(_cache_index(cache_dir)) as index:
+        for member in cache.getmembers():
+            member.name = os.path.basename(member.name)
+            if member.isfile() and _CACHE_FILE.match(member.name):
+                cache.extract(member, cache_dir)
+                _index_cache_file(index, member.name)
+    cache.close()
+
+def rebuild_cache_index(cache_dir=None):
+    """
+    Rebuilds the index of cached raw features from the files in the cache directory
+    :param cache_dir (str): path to cache dir, where data will be indexed
+    """
+    cache_dir = cache_finder(cache_dir)
+    with closing(_cache_index(cache_dir)) as index:
+        with index:
+            index.execute("DELETE FROM cache")
+        for file in os.listdir(cache_dir):
+            _index_cache_file(index, file)
+    log.info(f"Rebuilt cache index for \"{cache_dir}\"...")
+
+def _cache_segments(index, cache_dir, name, id, start, end):
+    """
+    Helper function that finds the cached segments of raw feature data overlapping (or next to)
+    [start, end] as (file, start, end, number of events), oldest first, and the gaps they leave
+    in [start, end]
+    """
+    segments = []
+    for file, _start, _end, count in index.execute("SELECT file, start, end, count FROM cache WHERE name = ? AND id = ? "
+                                            "AND start <= ? AND end >= ? ORDER BY start",
+                                            (name, id, end + 1, start - 1)).fetchall():
+        if not os.path.exists(cache_dir + '/' + file):
+            # The file was removed behind our back; drop it from the index.
+            with index:
+                index.execute("DELETE FROM cache WHERE file = ?", (file,))
+            continue
+        segments.append((file, _start, _end, count))
+
+    gaps, cursor = [], start
+    for _, _start, _end, _ in segments:
+        if _start > cursor:
+            gaps.append((cursor, min(_start - 1, end)))
+        cursor = max(cursor, _end + 1)
+    if cursor <= end:
+        gaps.append((cursor, end))
+    return segments, gaps
+
+def _cache_load(cache_dir, file, start=None, end=None, frame=False):
+    """
+    Helper function that loads cached raw feature data, optionally only within [start, end],
+    as a list of dicts or (if `frame`, and stored column-by-column) as a DataFrame
+    """
+    path = cache_dir + '/' + file
+    if file.split('.')[-1] == 'parquet':
+        # Only the row groups overlapping [start, end] are read; numeric columns load without copies.
+        filters = [f for f in [('timestamp', '>=', start), ('timestamp', '<=', end)] if f[2] is not None]
+        df = pd.read_parquet(path, engine='pyarrow', filters=filters or None).iloc[::-1]
+        if not frame:
+            return df.to_dict('records')
+        schema = RAW_SCHEMA.get(_CACHE_FILE.match(file)['name'], {})
+        return df.astype({k: v for k, v in schema.items() if k in df.columns}).reset_index(drop=True)
+    if file.split('.')[-1] == 'cortex': #if no compression extension, use standard pkl loading
+        return pickle.load(path, set_default_extension=False, compression=None)
+    return pickle.load(path)
+
+def _cache_save(cache_dir, name, id, start, end, data):
+    """
+    Helper function that saves raw feature data to the cache and returns the file name; the file
+    is written under a temporary (hidden) name and then renamed, so that other processes sharing
+    the cache never load it half-written
+    """
+    file = name + '_' + id + '_' + str(start) + '_' + str(end) + '.cortex'
+    temp = f".{os.getpid()}.{threading.get_ident()}."
+    if os.getenv('CORTEX_CACHE_COMPRESSION') is not None:
+        assert os.getenv('CORTEX_CACHE_COMPRESSION') in ['gz', 'bz2', 'lzma', 'zip'], f"Compression method for caching does not exist."
+
+    cache_format = os.getenv('CORTEX_CACHE_FORMAT', 'pickle')
+    assert cache_format in ['pickle', 'parquet'], f"Format for caching does not exist."
+    if cache_format == 'parquet' and name in RAW_SCHEMA:
+        try:
+            import pyarrow
+        except ImportError:
+            raise Exception("The 'parquet' caching format requires `pyarrow` to be installed.")
+
+        # Store rows oldest-first so each row group covers a narrow timestamp range.
+        schema = {k: 'float64' if v.startswith('float') else v for k, v in RAW_SCHEMA[name].items()}
+        df = pd.DataFrame.from_records(data, columns=None if data else list(schema))
+        df = df.astype({k: v for k, v in schema.items() if k in df.columns}).iloc[::-1]
+        try:
+            df.to_parquet(cache_dir + '/' + temp + file + '.parquet', engine='pyarrow', index=False,
+                          compression='gzip' if os.getenv('CORTEX_CACHE_COMPRESSION') == 'gz' else 'snappy',
+                          row_group_size=CACHE_ROW_GROUP_SIZE)
+            os.replace(cache_dir + '/' + temp + file + '.parquet', cache_dir + '/' + file + '.parquet')
+            return file + '.parquet'
+        except (pyarrow.ArrowException, TypeError, ValueError):
+            log.info(f"Raw data could not be stored as columns, saving as pickle instead...")
+            if os.path.exists(cache_dir + '/' + temp + file + '.parquet'):
+                os.remove(cache_dir + '/' + temp + file + '.parquet')
+
+    if os.getenv('CORTEX_CACHE_COMPRESSION') is not None:
+        file += '.' + os.getenv('CORTEX_CACHE_COMPRESSION')
+    pickle.dump(data,
+                cache_dir + '/' + temp + file,
+                compression='infer' if os.getenv('CORTEX_CACHE_COMPRESSION') else None,
+                set_default_extension=False)
+    os.replace(cache_dir + '/' + temp + file, cache_dir + '/' + file)
+    return file
+
+def _frame(name, data):
+    """
+    Helper function that builds a DataFrame of raw feature data, typed by RAW_SCHEMA if possible
+    """
+    schema = RAW_SCHEMA.get(name, {'timestamp': 'int64'})
+    df = pd.DataFrame.from_records(data, columns=None if len(data) else list(schema))
+    return df.astype({k: v for k, v in schema.items() if k in df.columns})
+
+def _cache_index(cache_dir):
+    """
+    Helper function that opens (and creates, if needed) the index of cached raw features,
+    adopting any files already present in the cache directory
+    """
+    path = os.path.join(cache_dir, CACHE_INDEX)
+    exists = os.path.exists(path)
+    index = sqlite3.connect(path, timeout=60)
+    with index:
+        index.execute("CREATE TABLE IF NOT EXISTS cache (file TEXT PRIMARY KEY, name TEXT, id TEXT, start INTEGER, end INTEGER, count INTEGER)")
+        index.execute("CREATE INDEX IF NOT EXISTS cache_range ON cache (name, id, start, end)")
+        if 'count' not in [column[1] for column in index.execute("PRAGMA table_info(cache)")]:
+            index.execute("ALTER TABLE cache ADD COLUMN count INTEGER")
+    if not exists:
+        for file in os.listdir(cache_dir):
+            _index_cache_file(index, file)
+    return index
+
+def _index_cache_file(index, file, count=None):
+    """
+    Helper function that adds a cached raw feature file to the index, if it is one, with the
+    number of events in it (if known)
+    """
+    match = _CACHE_FILE.match(file)
+    if match is None or file.startswith('.'):
+        return
+    with index:
+        index.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)",
+                      (file, match['name'], match['id'], int(match['start']), int(match['end']), count))
 
 def cache_finder(cache_dir):
     """
@@ -365,6 +937,12 @@ def _main():
                              help='the server address for the LAMP API Server (can also be set using the environment variable LAMP_SERVER_ADDRESS)')
     subparsers = superparser.add_subparsers(title="features", dest='_feature', required=True,
                                             description="Available features for processing")
+
+    # Add a sub-parser to index a caching directory populated by an older Cortex or copied in by hand.
+    parser = subparsers.add_parser('rebuild_cache_index')
+    parser.add_argument(f"--cache-dir", dest='cache_dir', type=str,
+                        help='path to the caching directory (defaults to CORTEX_CACHE_DIR or ~/.cache/cortex)')
+
     funcs = {f['callable'].__name__: f['callable'] for f in all_features()}
     for name, func in funcs.items():
 
@@ -397,6 +975,9 @@ def _main():
         os.environ['LAMP_SECRET_KEY'] = kwargs.pop('_secret_key')
     if kwargs['_server_address'] is not None:
         os.environ['LAMP_SERVER_ADDRESS'] = kwargs.pop('_server_address')
+    if kwargs['_feature'] == 'rebuild_cache_index':
+        rebuild_cache_index(kwargs['cache_dir'])
+        return
     _result = funcs[kwargs['_feature']](**{k: v for k, v in kwargs.items() if not k.startswith('_')})
     
     # Format and print the result to console (use bash redirection to output to a file).
@@ -0,0 +1,233 @@
+from ..feature_types import log, _memo_get, _memo_set
+from ..raw.accelerometer import accelerometer
+from ..raw.fetch import fetch_events
+
+import numpy as np
+import datetime
+import LAMP
+
+# Accelerometer readings are summarized in bins of this many milliseconds (aligned to UTC midnight).
+BIN_SIZE = 10 * 60 * 1000
+MS_PER_DAY = 86400000
+BINS_PER_DAY = MS_PER_DAY // BIN_SIZE
+
+
+def accelerometer_bins(**kwargs):
+    """
+    Summarize accelerometer readings in 10 minute bins, for the sleep and activity features.
+
+    The readings are streamed, and the magnitude of each is computed for a whole chunk at once.
+    Within a `memoize()` scope, the bins are computed once per participant and time interval.
+
+    :param kwargs: The parameters to get the accelerometer data with (id, start, end, ...).
+    :return (dict): The start (UTC timestamp) of each bin with readings, in ascending order, and the
+    mean magnitude, number and sum of squared magnitudes of the readings in it, as arrays under
+    'timestamp', 'magnitude', 'count' and 'sumsq'.
+    """
+    key = {'id': kwargs['id'], 'start': kwargs['start'], 'end': kwargs['end']}
+    _event = _memo_get('bins', 'accelerometer_bins', key)
+    if _event is not None:
+        return _event['data']
+
+    first = kwargs['start'] // BIN_SIZE
+    size = max(0, kwargs['end'] // BIN_SIZE - first + 1)
+    total, count, sumsq = np.zeros(size), np.zeros(size, dtype='int64'), np.zeros(size)
+    for acc in accelerometer(**{**kwargs, 'stream': True})['data']:
+        xyz = acc[['x', 'y', 'z']].to_numpy(dtype='float64')
+        idx = acc['timestamp'].to_numpy() // BIN_SIZE - first
+        squared = (xyz * xyz).sum(axis=1)
+        total += np.bincount(idx, weights=np.sqrt(squared), minlength=size)
+        count += np.bincount(idx, minlength=size)
+        sumsq += np.bincount(idx, weights=squared, minlength=size)
+
+    found = np.nonzero(count)[0]
+    bins = {'timestamp': (found + first) * BIN_SIZE,
+            'magnitude': total[found] / count[found],
+            'count': count[found],
+            'sumsq': sumsq[found]}
+    _memo_set('bins', 'accelerometer_bins', key, {'data': bins})
+    return bins
+
+
+class AccelerometerProfile():
+    """
+    The accelerometer readings of a participant up to `end`, summarized by 10 minute time of day:
+    the sum, number and sum of squares of the reading magnitudes in each of the 144 bins of a day.
+    """
+    def __init__(self, end=0, total=None, count=None, sumsq=None):
+        self.end = end
+        self.total = np.zeros(BINS_PER_DAY) if total is None else np.asarray(total, dtype='float64')
+        self.count = np.zeros(BINS_PER_DAY, dtype='int64') if count is None else np.asarray(count, dtype='int64')
+        self.sumsq = np.zeros(BINS_PER_DAY) if sumsq is None else np.asarray(sumsq, dtype='float64')
+
+    @property
+    def magnitude(self):
+        """
+        The mean magnitude in each bin, or NaN for bins without readings.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.total / self.count
+
+    @property
+    def std(self):
+        """
+        The standard deviation of the magnitudes in each bin, or NaN for bins without readings.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(np.maximum(self.sumsq / self.count - self.magnitude ** 2, 0))
+
+    def add(self, bins):
+        """
+        Add binned readings (as returned by `accelerometer_bins`) to the profile.
+        """
+        slot = (bins['timestamp'] % MS_PER_DAY) // BIN_SIZE
+        self.total += np.bincount(slot, weights=bins['magnitude'] * bins['count'], minlength=BINS_PER_DAY)
+        self.count += np.bincount(slot, weights=bins['count'], minlength=BINS_PER_DAY).astype('int64')
+        self.sumsq += np.bincount(slot, weights=bins['sumsq'], minlength=BINS_PER_DAY)
+
+    def merge(self, other):
+        """
+        Add the readings of another profile to this one.
+        """
+        self.total += other.total
+        self.count += other.count
+        self.sumsq += other.sumsq
+        self.end = max(self.end, other.end)
+
+    def copy(self):
+        """
+        A copy of the profile, which can be updated independently.
+        """
+        return AccelerometerProfile(self.end, self.total.copy(), self.count.copy(), self.sumsq.copy())
+
+    def records(self):
+        """
+        The bins with readings, as {'time': datetime.time, 'magnitude', 'count'} dicts in time order.
+        """
+        magnitude = self.magnitude
+        return [{'time': datetime.time(hour=i * BIN_SIZE // 3600000, minute=i * BIN_SIZE // 60000 % 60),
+                 'magnitude': float(magnitude[i]),
+                 'count': int(self.count[i])} for i in np.nonzero(self.count)[0]]
+
+    def to_attachment(self):
+        """
+        Serialize the profile for the `cortex.sleep_periods.reduced` attachment.
+        """
+        return {'end': self.end, 'total': self.total.tolist(), 'count': self.count.tolist(),
+                'sumsq': self.sumsq.tolist()}
+
+    @classmethod
+    def from_attachment(cls, body):
+        """
+        Deserialize a profile from the `cortex.sleep_periods.reduced` attachment; the older list of
+        {'time': {'hour', 'minute'}, 'magnitude', 'count'} dicts is also accepted, with the sum of
+        squares of each bin estimated from its mean.
+        """
+        if 'total' in body:
+            return cls(body['end'], body['total'], body['count'], body['sumsq'])
+        profile = cls(body['end'])
+        for x in body['data']:
+            if x['magnitude'] and x['count']:
+                i = (x['time']['hour'] * 3600000 + x['time']['minute'] * 60000) // BIN_SIZE
+                profile.total[i] += x['magnitude'] * x['count']
+                profile.count[i] += x['count']
+                profile.sumsq[i] += x['magnitude'] ** 2 * x['count']
+        return profile
+
+
+def accelerometer_profile(**kwargs):
+    """
+    Get the participant's accelerometer profile up to `end`, updating the one saved in the
+    `cortex.sleep_periods.reduced` attachment with the readings since it was saved. Within a
+    `memoize()` scope, the profile is updated once per participant and `end`.
+
+    :param kwargs: The parameters to get the accelerometer data with (id, end, ...).
+    :return (AccelerometerProfile): The participant's profile.
+    """
+    key = {'id': kwargs['id'], 'start': 0, 'end': kwargs['end']}
+    _event = _memo_get('profile', 'accelerometer_profile', key)
+    if _event is not None:
+        return _event['data']
+
+    try:
+        profile = AccelerometerProfile.from_attachment(
+            LAMP.Type.get_attachment(kwargs['id'], 'cortex.sleep_periods.reduced')['data'])
+        log.info("Using saved reduced data...")
+    except Exception:
+        profile = AccelerometerProfile()
+        log.info("No saved reduced data found, starting new...")
+
+    if profile.end < kwargs['end']:  # update reduced data
+        start = profile.end + 1
+        if not profile.end:
+            # Start from the participant's oldest reading (the oldest event is returned first when
+            # given a negative limit), rather than streaming from 1970.
+            oldest = fetch_events("SensorEvent", kwargs['id'], 0, kwargs['end'],
+                                  origin="lamp.accelerometer", limit=-1, recursive=False)
+            start = oldest[0]['timestamp'] if oldest else kwargs['end'] + 1
+        if start <= kwargs['end']:
+            profile.add(accelerometer_bins(**{**kwargs, 'start': start}))
+        profile.end = kwargs['end']
+        LAMP.Type.set_attachment(kwargs['id'], 'me',
+                                 attachment_key='cortex.sleep_periods.reduced',
+                                 body=profile.to_attachment())
+        log.info("Saving reduced data...")
+    _memo_set('profile', 'accelerometer_profile', key, {'data': profile.copy()})
+    return profile
+
+
+def expected_sleep_period(profile, first=datetime.time(18, 0), last=datetime.time(3, 30), step=30, hours=8):
+    """
+    Find the expected sleep period in an accelerometer profile: of the windows of `hours` hours
+    starting every `step` minutes from `first` to `last`, the one with the lowest mean magnitude.
+
+    The mean of every window is read off a circular prefix sum over the profile's bins, so finer
+    steps and several sleep lengths cost no more than the default 20 candidate bed times.
+
+    :param profile (AccelerometerProfile): The participant's accelerometer profile.
+    :param first (datetime.time): The earliest bed time considered.
+    :param last (datetime.time): The latest bed time considered.
+    :param step (int): The minutes between the bed times considered (a multiple of 10).
+    :param hours (float or list): The length(s) of the sleep period considered, in hours.
+    :return (dict): The expected 'bed' and 'wake' times and mean 'accelerometer_magnitude' over the
+    period (the first found if tied), or None for each if the profile has no readings.
+    """
+    minutes = BIN_SIZE // 60000
+    start = (first.hour * 60 + first.minute) // minutes
+    stride = step // minutes
+    starts = (start + stride * np.arange(((last.hour * 60 + last.minute) // minutes - start) % BINS_PER_DAY // stride + 1)) % BINS_PER_DAY
+    # Windows include the bin at their wake time, i.e. 49 bins for 8 hours.
+    lengths = (np.round(np.atleast_1d(hours) * 60 / minutes) + 1).astype(int)
+
+    total = np.concatenate([[0], np.cumsum(np.tile(profile.total, 2))])
+    count = np.concatenate([[0], np.cumsum(np.tile(profile.count, 2))])
+    window_total = total[starts[:, None] + lengths[None, :]] - total[starts[:, None]]
+    window_count = count[starts[:, None] + lengths[None, :]] - count[starts[:, None]]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(window_count > 0, window_total / window_count, np.inf)
+
+    best = np.argmin(mean)
+    if mean.flat[best] == np.inf:
+        return {'bed': None, 'wake': None, 'accelerometer_magnitude': None}
+    bed, length = starts[best // len(lengths)], lengths[best % len(lengths)]
+    wake = (bed + length - 1) % BINS_PER_DAY
+    return {'bed': datetime.time(hour=bed * minutes // 60, minute=bed * minutes % 60),
+            'wake': datetime.time(hour=wake * minutes // 60, minute=wake * minutes % 60),
+            'accelerometer_magnitude': float(mean.flat[best])}
+
+
+def _awake(timestamp, bed_time, wake_time):
+    """
+    Whether each timestamp is outside the expected sleep period, as the activity features count it:
+    before the bed time or after the wake time for bed times from 00:00 to 04:00, between the wake
+    and bed times for bed times from 18:00 to 23:30, and never for other bed times.
+    """
+    def ms(t):
+        return (t.hour * 60 + t.minute) * 60000
+
+    time, bed, wake = np.asarray(timestamp) % MS_PER_DAY, ms(bed_time), ms(wake_time)
+    if datetime.time(0, 0) <= bed_time <= datetime.time(4, 0):
+        return (time < bed) | (time > wake)
+    if datetime.time(18, 0) <= bed_time <= datetime.time(23, 30):
+        return (wake < time) & (time < bed)
+    return np.zeros(len(time), dtype=bool)
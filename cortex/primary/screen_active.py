@@ -1,51 +1,120 @@
 from ..feature_types import primary_feature
 from ..raw.screen_state import screen_state
 
-import pandas as pd
+import numpy as np
+
+# Screen states that turn the screen on or off; two "on" events less than DEBOUNCE ms apart count
+# as one, the later one.
+ON_EVENTS = [1, 3]
+OFF_EVENTS = [0, 2]
+DEBOUNCE = 1000
+
 
 @primary_feature(
     name="cortex.screen_active",
     dependencies=[screen_state],
-    attach=True
+    attach=True,
+    incremental=True
 )
-def screen_active(**kwargs):
+def screen_active(state=None, **kwargs):
     """
     Builds bout of screen activitty
+
+    :param state (dict): the state saved when the bouts were last computed, to resume from (optional)
+    :return (tuple): the bouts, each with (start, end, duration), and the state to resume from
     """
-    _screen_state = list(reversed(screen_state(**kwargs)['data']))
+    segmenter = BoutSegmenter.from_attachment(state) if state else BoutSegmenter()
+    _screen_state = screen_state(**kwargs)['data']
 
-    on_events = [1, 3]
-    off_events = [0, 2]
     #Ensure state is present; convert value if not
-    for _event in _screen_state:
-        if 'state' not in _event:
-            if 'data' not in _event:
-                _event['state'] = _event['value']
-            else:
-                _event['state'] = _event['data']['value']
-
-    #Initialize
-    _screen_active = []
-    start = True #if looking for start 
-    bout = {}
-    for i in range(len(_screen_state) - 1):
-        elapsed = _screen_state[i+1]['timestamp'] - _screen_state[i]['timestamp']
-        if elapsed < 1000 and _screen_state[i+1]['state'] in on_events and _screen_state[i]['state'] in on_events:
-            continue
-        elif start and _screen_state[i]['state'] in on_events:
-            bout['start'] = _screen_state[i]['timestamp']
-            start = False 
-        elif not start and _screen_state[i]['state'] in off_events:
-            bout['end'] = _screen_state[i]['timestamp']
-            bout['duration'] = bout['end'] - bout['start']
-            _screen_active.append(bout)
-
-            bout = {}
-            start = True
-    
-    if not start and _screen_state[-1]['state'] in off_events:
-            bout['end'] = _screen_state[-1]['timestamp']
-            bout['duration'] = bout['end'] - bout['start']
-            _screen_active.append(bout)
-            
-    return _screen_active
+    start, end = segmenter.add([_event['timestamp'] for _event in reversed(_screen_state)],
+                               [_value(_event) for _event in reversed(_screen_state)])
+    segmenter.end = kwargs['end']
+    _screen_active = [{'start': int(s), 'end': int(e), 'duration': int(e - s)} for s, e in zip(start, end)]
+    return _screen_active, segmenter.to_attachment()
+
+
+def _value(_event):
+    """
+    The screen state of an event, which older events store as its 'value'.
+    """
+    if 'state' in _event:
+        return _event['state']
+    if 'data' not in _event:
+        return _event['value']
+    return _event['data']['value']
+
+
+class BoutSegmenter():
+    """
+    Finds bouts of screen activity, from an "on" event to the next "off" event.
+
+    Events are added in time order, all at once or in chunks; the last event (which can't start a
+    bout until the next one shows it isn't a repeated "on") and the start of the bout still open
+    at the end of a chunk are carried over, so the bouts found don't depend on the chunking.
+    """
+    def __init__(self, end=0, last=None, start=None):
+        # The time up to which events were added, the last event added ('timestamp', 'state'),
+        # and the start of the open bout, if any.
+        self.end = end
+        self.last = last
+        self.start = start
+
+    def add(self, timestamp, state):
+        """
+        Add screen state events, in ascending time order.
+
+        Every event that counts is either "on" or "off", and the screen is on after it exactly if
+        it is "on", so the bouts start and end where that flag changes between consecutive events.
+
+        :param timestamp (list): The UTC timestamps of the events.
+        :param state (list): The screen states of the events.
+        :return (tuple): The start and end timestamps of the bouts completed by these events.
+        """
+        if len(timestamp) == 0:
+            return np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64')
+        last = {'timestamp': int(timestamp[-1]), 'state': _python(state[-1])}
+        timestamp = np.asarray(timestamp, dtype='int64')
+        state = np.asarray(state)
+        if self.last is not None:
+            timestamp = np.concatenate([[self.last['timestamp']], timestamp])
+            state = np.concatenate([np.asarray([self.last['state']]), state])
+
+        on, off = np.isin(state, ON_EVENTS), np.isin(state, OFF_EVENTS)
+        # An "on" event followed by another within DEBOUNCE ms is ignored, and the last event can
+        # only end a bout, since it might be the first of such a pair.
+        counts = on | off
+        counts[:-1] &= ~((np.diff(timestamp) < DEBOUNCE) & on[:-1] & on[1:])
+        counts[-1] &= off[-1]
+
+        index = np.flatnonzero(counts)
+        flag = on[index]
+        previous = np.r_[self.start is not None, flag][:-1]
+        starts = timestamp[index[flag & ~previous]]
+        ends = timestamp[index[~flag & previous]]
+        if self.start is not None:
+            starts = np.r_[self.start, starts]
+
+        self.last = last
+        self.start = int(starts[-1]) if len(starts) > len(ends) else None
+        return starts[:len(ends)], ends
+
+    def to_attachment(self):
+        """
+        Serialize the segmenter for the `cortex.screen_active.state` attachment.
+        """
+        return {'end': self.end, 'last': self.last, 'start': self.start}
+
+    @classmethod
+    def from_attachment(cls, body):
+        """
+        Deserialize a segmenter from the `cortex.screen_active.state` attachment.
+        """
+        return cls(body['end'], body['last'], body['start'])
+
+
+def _python(value):
+    """
+    Convert a NumPy scalar to the Python value, to save it in an attachment.
+    """
+    return value.item() if isinstance(value, np.generic) else value
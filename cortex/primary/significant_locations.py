@@ -1,19 +1,28 @@
 from ..feature_types import primary_feature, log
 from ..raw.gps import gps
-from sklearn.cluster import KMeans
-import pandas as pd
+from sklearn.cluster import KMeans, MiniBatchKMeans
 import numpy as np
-import math
 from sklearn.cluster import DBSCAN
+from sklearn.neighbors import BallTree
 import LAMP 
 
+# GPS fixes are reduced with DBSCAN this many at a time, to bound its memory use, and clusters
+# are merged into the nearest reduced point if it is closer than MERGE_DISTANCE (km).
+REDUCE_CHUNK_SIZE = 30000
+MERGE_DISTANCE = 20
+EARTH_RADIUS = 6371
+
+# The centroids fitted in this process, by participant and fit parameters, and the saved model
+# they were read from or saved as.
+_models = {}
+
 
 @primary_feature(
     name='cortex.significant_locations',
     dependencies=[gps],
     attach=False
 )
-def significant_locations(k_max=10, eps=1e-5, **kwargs):
+def significant_locations(k_max=10, eps=1e-5, minibatch=False, max_points=None, **kwargs):
     """
     Get the coordinates of significant locations visited by the participant in the
     specified timeframe using the KMeans clustering method.
@@ -25,6 +34,8 @@ def significant_locations(k_max=10, eps=1e-5, **kwargs):
     to coalesce multiple SigLocs into one. 
 
     :param k_max (int): The maximum KMeans clusters to test (FIXME).
+    :param minibatch (bool): Choose the clusters with MiniBatchKMeans (see `fit_locations`).
+    :param max_points (int): Fit the clusters to a weighted sample of at most this many reduced points.
     :return latitude (float): The latitude of the SigLoc centroid.
     :return longitude (float): The longitude of the SigLoc centroid.
     :return radius (float): The radius of the SigLoc centroid (in meters).
@@ -33,140 +44,260 @@ def significant_locations(k_max=10, eps=1e-5, **kwargs):
     :return duration (int): The duration of time spent by the participant in the centroid.
     """
 
-    # Calculates straight-line (not great-circle) distance between two GPS points on 
-    # Earth in kilometers; equivalent to roughly ~55% - 75% of the Haversian (great-circle)
-    # distance. 110.25 is conversion metric marking the length of a spherical degree.
-    # 
-    # https://jonisalonen.com/2014/computing-distance-between-coordinates-can-be-simple-and-fast/
-    def euclid(g0, g1):
-        def _euclid(lat, lng, lat0, lng0): # degrees -> km
-            return 110.25 * ((((lat - lat0) ** 2) + (((lng - lng0) * np.cos(lat0)) ** 2)) ** 0.5)
-        return _euclid(g0[0], g0[1], g1[0], g1[1])
+    model = location_model(k_max=k_max, eps=eps, minibatch=minibatch, max_points=max_points, **kwargs)
+    if model is None: return []
 
+    #Get gps data for this window 
+    newdf = gps(**{**kwargs, 'as_frame': True})['data']
+    if len(newdf) == 0: return []
+    count, duration, radius = _window_locations(model['centroids'], newdf, np.array([kwargs['start'], kwargs['end'] + 1]))
+    
+    # Add proportion of GPS within each centroid and return output.
+    return [{
+        'start':kwargs['start'], 
+        'end':kwargs['end'],
+        'latitude': center[0],
+        'longitude': center[1],
+        'rank': idx, #significant locations in terms of prevelance (0 being home)
+        'radius': radius[0, idx] if count[0, idx] > 0 else None,
+        'proportion': count[0, idx] / count[0].sum(),
+        'duration': int(duration[0, idx]) #props[props == idx].size * 200 #EXPECTED duration in ms
+    } for idx, center in enumerate(model['centroids'])]
+
+
+def location_model(k_max=10, eps=1e-5, minibatch=False, max_points=None, **kwargs):
+    """
+    Get the significant location model of a participant, fitted to their GPS data up to `end`.
 
+    The model is saved with the reduced data in the `cortex.significant_locations.reduced`
+    attachment, and kept in this process for as long as the attachment holds it; it is only
+    updated (by reducing the GPS data since it was saved and choosing k again, starting the fit
+    with the saved k from the saved centroids) for an `end` after the one it was fitted to or
+    other fit parameters, so windows before that only need their own GPS fixes assigned to its
+    centroids.
+
+    :param k_max (int): The maximum KMeans clusters to test.
+    :param eps (float): The DBSCAN neighborhood size used to reduce GPS data, in degrees.
+    :param minibatch (bool): Fit with MiniBatchKMeans (see `fit_locations`).
+    :param max_points (int): Fit to a weighted sample of at most this many reduced points.
+    :param kwargs: The parameters to get the GPS data with (id, end, ...).
+    :return (dict): The 'end' up to which the model is valid, the 'k_max' it was fitted with, its
+    'centroids' (as [latitude, longitude] rows, ranked), and the 'saved' (end, centroids) of the
+    attachment, or None without any GPS data.
+    """
+    params = {'k_max':k_max, 'eps':eps, 'minibatch':minibatch, 'max_points':max_points}
 
     #Get DB scan metadata fir
     try:
         reduced_data = LAMP.Type.get_attachment(kwargs['id'], 'cortex.significant_locations.reduced')['data']#['data']
+        if not isinstance(reduced_data, dict):
+            raise ValueError("reduced data was reset")
     except:
         reduced_data = {'end':0, 'data':[]}
+    if reduced_data.get('eps', eps) != eps:
+        # The saved points were reduced with another eps, so the GPS data is reduced again.
+        reduced_data = {'end':0, 'data':[]}
+
+    # Reuse the model fitted in this process with the same parameters, if the saved model hasn't
+    # been rewritten (or reset) since.
+    key = (kwargs['id'], *params.values())
+    model = _models.get(key)
+    if (model is not None and model['end'] >= kwargs['end'] and
+            model['saved'] == (reduced_data['end'], reduced_data.get('centroids'))):
+        return model
 
     reduced_data_end = reduced_data['end']
-    new_reduced_data = reduced_data['data'].copy()
+    points = _points(reduced_data['data'])
+    updated = False
 
     if reduced_data_end < kwargs['end']: #update reduced data by getting new gps data and running dbscan
         ### DBSCAN ###
-        _gps = gps(**{**kwargs, 'start':reduced_data_end})['data']
-        df = pd.DataFrame.from_dict(_gps)
-        if len(df) == 0: return []
-        
-        #To prevent memory issues, limit size of db scan and perform iteratively
-        cut_df = np.split(df, [30000*i for i in range(math.ceil(len(df) / 30000))])
-        for d in cut_df:
-            
-            if len(d) == 0: continue
-            
-            d.reset_index(drop=True)
-            new_reduced_data = reduced_data['data'].copy()
-            dbscan = DBSCAN(eps=eps)
-            props = dbscan.fit_predict(d[['latitude', 'longitude']].values)
-            db_points = []
-            for l in np.unique(props):
-                db_lats, db_longs = [d.iloc[i]['latitude'] for i in range(len(d)) if props[i] == l], [d.iloc[i]['longitude'] for i in range(len(d)) if props[i] == l]
-                db_duration = [d.iloc[i]['timestamp'] for i in range(len(d)) if props[i] == l]
-                if l == -1:
-                    db_points += [{'latitude':db_lats[i],
-                    'longitude':db_longs[i],
-                    'count':1} for i in range(len(db_lats))]
-                else:
-                    lat_mean, long_mean = np.mean(db_lats), np.mean(db_longs)
-                    if len(reduced_data['data']) == 0:
-                        db_points += [{'latitude':lat_mean, 
-                                      'longitude':long_mean, 
-                                  'count':len(db_lats)}]
-
-                    else:
-                        min_dist_index = np.argmin([euclid((loc['latitude'], loc['longitude']), (lat_mean, long_mean)) for loc in reduced_data['data']])
-                        if euclid((reduced_data['data'][min_dist_index]['latitude'], reduced_data['data'][min_dist_index]['longitude']), 
-                              (lat_mean, long_mean)) < 20:
-                              new_reduced_data[min_dist_index]['count'] += len(db_lats)
-                        else:
-                            db_points += [{'latitude':lat_mean, 
-                                          'longitude':long_mean, 
-                                      'count':len(db_lats)}]
-
-            #Add new db points
-            new_reduced_data += db_points
-            reduced_data = {'end':kwargs['end'], 'data':new_reduced_data}
+        df = gps(**{**kwargs, 'start':reduced_data_end, 'as_frame': True})['data']
+        if len(df) > 0:
+            points = reduce_locations(df['latitude'].to_numpy(), df['longitude'].to_numpy(), points, eps=eps)
+            reduced_data = {**reduced_data, 'end':kwargs['end'],
+                            'data':[{'latitude':float(lat), 'longitude':float(lng), 'count':int(count)}
+                                    for lat, lng, count in zip(*points)]}
+            updated = True
+       ### ###
 
+    if len(points[0]) == 0: return None
+    if updated or any(reduced_data.get(k) != v for k, v in params.items()) or reduced_data.get('centroids') is None:
+        # k is chosen again; the saved centroids only seed the fit with their k.
+        init = reduced_data.get('centroids') if reduced_data.get('k_max') == k_max else None
+        centroids = fit_locations(*points, k_max=k_max, init=init, minibatch=minibatch, max_points=max_points)
+        reduced_data = {**reduced_data, **params, 'centroids':centroids.tolist()}
         LAMP.Type.set_attachment(kwargs['id'], 'me', attachment_key='cortex.significant_locations.reduced', body=reduced_data)
-                            
-       ### ###
-    
-    # Prepare input parameters.
-    expanded_data = []
-    for point in reduced_data['data']:
-           expanded_data.extend([{'latitude':point['latitude'], 'longitude':point['longitude']} for _ in range(point['count'])])
 
-    df = pd.DataFrame.from_dict(expanded_data)
-    df2 = df[['latitude', 'longitude']].values
-    K_clusters = range(1, min(k_max, len(df)))
-    kmeans = [KMeans(n_clusters=i) for i in K_clusters]
+    # No GPS data was found since the reduced data's end, so the model is also valid up to `end`.
+    model = {'end':max(reduced_data['end'], kwargs['end']), 'k_max':k_max,
+             'centroids':np.array(reduced_data['centroids']),
+             'saved':(reduced_data['end'], reduced_data['centroids'])}
+    _models[key] = model
+    return model
+
+
+def _window_locations(centroids, gps_data, bins):
+    """
+    Assign GPS fixes to the nearest significant location, and summarize each location's visits
+    in each window [bins[i], bins[i+1]).
+
+    :param centroids (np.ndarray): The significant locations, as [latitude, longitude] rows.
+    :param gps_data (pd.DataFrame): The GPS data, newest first.
+    :param bins (np.ndarray): The window edges.
+    :return (tuple): Arrays with a row per window and a column per location: the number of fixes,
+    the time spent (the total duration of runs of consecutive fixes at the location, in ms) and
+    the mean distance of the fixes from the location (in meters, NaN without fixes).
+    """
+    gps_data = gps_data.iloc[::-1]
+    timestamp = gps_data['timestamp'].to_numpy()
+    window = np.searchsorted(bins, timestamp, side='right') - 1
+    inside = (window >= 0) & (window < len(bins) - 1)
+    timestamp, window = timestamp[inside], window[inside]
+    coords = gps_data[['latitude', 'longitude']].to_numpy()[inside]
+
+    k, size = len(centroids), (len(bins) - 1) * len(centroids)
+    label = _nearest(centroids, coords)
+    cell = window * k + label
+    count = np.bincount(cell, minlength=size)
+
+    # Calculates straight-line (not great-circle) distance between two GPS points on 
+    # Earth in kilometers; equivalent to roughly ~55% - 75% of the Haversian (great-circle)
+    # distance. 110.25 is conversion metric marking the length of a spherical degree.
+    # 
+    # https://jonisalonen.com/2014/computing-distance-between-coordinates-can-be-simple-and-fast/
+    center = centroids[label]
+    distance = 110.25 * ((((center[:, 0] - coords[:, 0]) ** 2) +
+                          (((center[:, 1] - coords[:, 1]) * np.cos(coords[:, 0])) ** 2)) ** 0.5) * 1000
+    with np.errstate(invalid='ignore', divide='ignore'):
+        radius = np.bincount(cell, weights=distance, minlength=size) / count
+
+    # A run ends where the next fix is at another location or in another window.
+    duration = np.zeros(size, dtype='int64')
+    if len(cell) > 0:
+        change = cell[1:] != cell[:-1]
+        first, last = np.flatnonzero(np.r_[True, change]), np.flatnonzero(np.r_[change, True])
+        np.add.at(duration, cell[first], timestamp[last] - timestamp[first])
+
+    shape = (len(bins) - 1, k)
+    return count.reshape(shape), duration.reshape(shape), radius.reshape(shape)
+
+
+def _points(data):
+    """
+    Unpack reduced points saved as {'latitude', 'longitude', 'count'} dicts into arrays.
+    """
+    return (np.array([p['latitude'] for p in data], dtype='float64'),
+            np.array([p['longitude'] for p in data], dtype='float64'),
+            np.array([p['count'] for p in data], dtype='int64'))
+
+
+def reduce_locations(latitude, longitude, points=None, eps=1e-5):
+    """
+    Reduce GPS fixes to weighted points with DBSCAN, merging them into previously reduced points.
+
+    Each DBSCAN cluster becomes one point at its mean, counting its fixes, and is merged into the
+    nearest existing point within MERGE_DISTANCE km (found with a haversine ball tree); noise
+    fixes are kept as points of their own. The means are computed for all clusters at once, so
+    the cost is dominated by DBSCAN itself.
+
+    :param latitude (np.ndarray): The latitudes of the fixes.
+    :param longitude (np.ndarray): The longitudes of the fixes.
+    :param points (tuple): The latitude, longitude and count arrays of the points reduced so far.
+    :param eps (float): The DBSCAN neighborhood size, in degrees.
+    :return (tuple): The latitude, longitude and count arrays of the reduced points.
+    """
+    lats, lngs, counts = points if points is not None else _points([])
+    for i in range(0, len(latitude), REDUCE_CHUNK_SIZE):
+        coords = np.stack([latitude[i:i + REDUCE_CHUNK_SIZE], longitude[i:i + REDUCE_CHUNK_SIZE]], axis=1)
+        labels = DBSCAN(eps=eps).fit_predict(coords)
+        noise = labels == -1
+        count = np.bincount(labels[~noise])
+        lat_mean = np.bincount(labels[~noise], weights=coords[~noise, 0]) / count
+        lng_mean = np.bincount(labels[~noise], weights=coords[~noise, 1]) / count
+
+        new = np.ones(len(count), dtype=bool)
+        if len(lats) > 0 and len(count) > 0:
+            tree = BallTree(np.radians(np.stack([lats, lngs], axis=1)), metric='haversine')
+            dist, nearest = tree.query(np.radians(np.stack([lat_mean, lng_mean], axis=1)), k=1)
+            near = dist[:, 0] * EARTH_RADIUS < MERGE_DISTANCE
+            counts = counts.copy()
+            np.add.at(counts, nearest[near, 0], count[near])
+            new = ~near
+
+        # Noise fixes are added first, then the clusters not merged, as the labels are ordered.
+        lats = np.concatenate([lats, coords[noise, 0], lat_mean[new]])
+        lngs = np.concatenate([lngs, coords[noise, 1], lng_mean[new]])
+        counts = np.concatenate([counts, np.ones(noise.sum(), dtype='int64'), count[new]])
+    return lats, lngs, counts
+
+
+def fit_locations(latitude, longitude, count, k_max=10, init=None, minibatch=False, max_points=None):
+    """
+    Cluster reduced points with KMeans, weighting each point by its count.
+
+    k is chosen by fitting k = 1, 2, ... below `k_max` until the score stops improving, and the
+    model fitted at that k is kept; if `init` is given, the fit with as many clusters as it has is
+    warm started from those centroids, so a model refitted to a little more data can keep them.
+
+    :param latitude (np.ndarray): The latitudes of the reduced points.
+    :param longitude (np.ndarray): The longitudes of the reduced points.
+    :param count (np.ndarray): The number of GPS fixes each point stands for.
+    :param k_max (int): The maximum KMeans clusters to test.
+    :param init (list): The centroids to start the fit with the same k from, as [latitude,
+    longitude] pairs (optional).
+    :param minibatch (bool): Fit with MiniBatchKMeans, for many reduced points; the points are
+    resampled in proportion to their counts first, as with `max_points`.
+    :param max_points (int): Fit to a weighted sample of at most this many points (optional).
+    :return (np.ndarray): The centroids, as [latitude, longitude] rows, from the most visited to
+    the least.
+    """
+    X = np.stack([latitude, longitude], axis=1)
+    _X, _count = X, count
+    if max_points is not None and len(X) > max_points:
+        _X, _count = _coreset(X, count, max_points)
+    elif minibatch:
+        # Mini-batches are drawn uniformly, so points are first drawn in proportion to their counts.
+        _X, _count = _coreset(X, count, len(X))
+    _KMeans = MiniBatchKMeans if minibatch else KMeans
 
     # Determine number of clusters to score.
     log.info(f'Calculating number of clusters to score with k_max={k_max}...')
-    score = [kmeans[i].fit(df2).score(df2) for i in range(len(kmeans))]
-    for i in range(len(score)):
-        if i == len(score) - 1:
-            k = i + 1
-            break
-        elif abs(score[i + 1] - score[i] < .01):
-            k = i + 1
+    kmeans, score = None, None
+    for k in range(1, min(k_max, int(count.sum()), len(_X) + 1)):
+        if init is not None and k == len(init):
+            _kmeans = _KMeans(n_clusters=k, init=np.array(init), n_init=1)
+        else:
+            _kmeans = _KMeans(n_clusters=k)
+        _kmeans.fit(_X, sample_weight=_count)
+        _score = _kmeans.score(_X, sample_weight=_count)
+        if kmeans is not None and _score - score < .01:
             break
+        kmeans, score = _kmeans, _score
+    if kmeans is None:
+        kmeans = _KMeans(n_clusters=1).fit(_X, sample_weight=_count)
+    log.info(f'Computed KMeans++ with k={len(kmeans.cluster_centers_)}...')
 
-    # Compute KMeans clusters. 
-    log.info(f'Computing KMeans++ with k={k}...')
-    kmeans = KMeans(n_clusters=k, init='k-means++')
-    kmeans.fit(df2)
+    # Rank the clusters by the number of fixes in them.
+    weight = np.bincount(_nearest(kmeans.cluster_centers_, X), weights=count,
+                         minlength=len(kmeans.cluster_centers_))
+    return kmeans.cluster_centers_[np.argsort(-weight, kind='stable')]
 
-    #Get gps data for this window 
-    _gps = gps(**kwargs)['data']
-    newdf = pd.DataFrame.from_dict(_gps)
-    newdf_coords = newdf[['latitude', 'longitude']].values
-    props = kmeans.predict(newdf_coords)
-    newdf.loc[:, 'cluster'] = props
-            
-    #Helper to get location duration
-    def _location_duration(df, cluster):
-        df = df[::-1].reset_index()
-        arr_ext = np.r_[False, df['cluster'] == cluster, False]
-        idx = np.flatnonzero(arr_ext[:-1] != arr_ext[1:])
-        idx_list = list(zip(idx[:-1:2], idx[1::2] - int(True)))
-
-        hometime_list = []
-        for tup in idx_list:
-            if tup[0] == tup[1]:
-                continue
-            duration = df['timestamp'][tup[1]] - df['timestamp'][tup[0]] 
-
-            hometime_list.append(duration)
-
-        return sum(hometime_list)
-    
-    # Add proportion of GPS within each centroid and return output.
-    return [{
-        'start':kwargs['start'], 
-        'end':kwargs['end'],
-        'latitude': center[0],
-        'longitude': center[1],
-        'rank': idx, #significant locations in terms of prevelance (0 being home)
-        'radius': np.mean(euclid(center,
 
-            # Transpose the points within the centroid and calculate the mean euclidean
-            # distance (in km) from the center-point and convert that to meters.
-            np.transpose(newdf_coords[np.argwhere(props == idx)].reshape((-1, 2)))
-        ) * 1000) if props[props == idx].size > 0 else None,
-        'proportion': props[props == idx].size / props.size,
-        'duration': _location_duration(newdf, idx) #props[props == idx].size * 200 #EXPECTED duration in ms
-    } for idx, center in enumerate(kmeans.cluster_centers_)]
+def _coreset(X, count, max_points):
+    """
+    A weighted sample of `max_points` draws from the points, in proportion to their counts; each
+    point drawn is weighted by its share of the total count, so the weights sum to it.
+    """
+    draws = np.random.default_rng().choice(len(X), size=max_points, p=count / count.sum())
+    index, draws = np.unique(draws, return_counts=True)
+    return X[index], draws * count.sum() / max_points
+
 
+def _nearest(centroids, coords):
+    """
+    The index of the nearest centroid to each of the coordinates, as KMeans would predict.
+    """
+    if len(coords) == 0:
+        return np.zeros(0, dtype=int)
+    return np.argmin(((coords[:, None, :] - centroids[None, :, :]) ** 2).sum(axis=2), axis=1)
@@ -1,88 +1,129 @@
 from ..feature_types import primary_feature, log
 from ..raw.gps import gps
 import numpy as np
-import pandas as pd
-import time
-from geopy import distance
-import datetime
+
+# A fix is "stationary" if it was reached from the previous fix below this speed (km/h), or
+# after more than this many hours.
+SPEED_THRESHOLD = 10.0
+TIME_THRESHOLD = 600
 
 
 @primary_feature(
     name="cortex.trips",
     dependencies=[gps],
-    attach=True
+    attach=True,
+    incremental=True
 )
-def trips(**kwargs):
+def trips(state=None, **kwargs):
     """
     :param id (string):
     :param start (int):
     :param end (int):
-    :return (list): all trips in the given timeframe; each one has (start, end) 
+    :param state (dict): the state saved when trips were last computed, to resume from (optional)
+    :return (tuple): all trips in the given timeframe; each one has (start, end), and the state to
+    resume from
+    """
+    segmenter = TripSegmenter.from_attachment(state) if state else TripSegmenter()
+    df = gps(**{**kwargs, 'as_frame': True})['data'].iloc[::-1]
+    log.info(f'Labeling GPS')
+    _trips = segmenter.add(df['timestamp'].to_numpy(), df['latitude'].to_numpy(),
+                           df['longitude'].to_numpy())
+    segmenter.end = kwargs['end']
+    return _trips, segmenter.to_attachment()
+
+
+def _haversine_np(lon1, lat1, lon2, lat2):
+    """
+    Source: https://stackoverflow.com/questions/42877802/pandas-dataframe-join-items-in-range-based-on-their-geo-coordinates-longitude
+
+    """
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+
+    a = np.sin(dlat/2.0)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2.0)**2
+
+    c = 2 * np.arcsin(np.sqrt(a))
+    km = 6367 * c
+    return km
+
+
+class TripSegmenter():
     """
-    ### Helper functions ###
-    
-    def haversine_np(lon1, lat1, lon2, lat2):
+    Splits GPS fixes into trips: runs of consecutive fixes that are all stationary or all moving.
+
+    Fixes are added in time order, all at once or in chunks; the last fix and the trip still open
+    at the end of a chunk are carried over, so the trips found don't depend on the chunking.
+    """
+    def __init__(self, end=0, last=None, trip=None):
+        # The time up to which fixes were added, the last fix added ('timestamp', 'latitude',
+        # 'longitude'), and the open trip ('start', 'latitude', 'longitude' and 'distance' so far,
+        # and whether it is 'stationary').
+        self.end = end
+        self.last = last
+        self.trip = trip
+
+    def add(self, timestamp, latitude, longitude):
+        """
+        Add GPS fixes, in ascending time order.
+
+        The distance travelled up to every fix is a cumulative sum, and the trips are the runs of
+        equal stationary flags, so the cost is linear in the number of fixes.
+
+        :param timestamp (np.ndarray): The UTC timestamps of the fixes.
+        :param latitude (np.ndarray): The latitudes of the fixes.
+        :param longitude (np.ndarray): The longitudes of the fixes.
+        :return (list): The trips completed by these fixes, as dicts with the 'start' and 'end'
+        timestamps, the 'latitude' and 'longitude' of the first fix, and the 'distance' (km).
         """
-        Source: https://stackoverflow.com/questions/42877802/pandas-dataframe-join-items-in-range-based-on-their-geo-coordinates-longitude 
+        if len(timestamp) == 0:
+            return []
+        timestamp = np.asarray(timestamp, dtype='int64')
+        latitude = np.asarray(latitude, dtype='float64')
+        longitude = np.asarray(longitude, dtype='float64')
+        if self.last is not None:
+            timestamp = np.concatenate([[self.last['timestamp']], timestamp])
+            latitude = np.concatenate([[self.last['latitude']], latitude])
+            longitude = np.concatenate([[self.last['longitude']], longitude])
 
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dt = np.diff(timestamp) / (1000*3600)
+            # The coordinates are passed in the order the original implementation used.
+            dx = _haversine_np(latitude[:-1], longitude[:-1], latitude[1:], longitude[1:])
+            stationary = (dx / dt < SPEED_THRESHOLD) | (dt > TIME_THRESHOLD)
+
+        # The first fix starts a moving trip, unless it is the last fix of the previous chunk.
+        stationary = np.concatenate([[self.trip is not None and self.trip['stationary']], stationary])
+        distance = np.concatenate([[0, 0], np.cumsum(np.nan_to_num(dx))])
+        first = np.flatnonzero(np.concatenate([[True], stationary[1:] != stationary[:-1]]))
+        stop = np.append(first[1:], len(timestamp))
+
+        start, lat, lng = timestamp[first], latitude[first], longitude[first]
+        trip_distance = distance[stop] - distance[first]
+        if self.trip is not None:
+            # The first run continues the open trip.
+            start[0], lat[0], lng[0] = self.trip['start'], self.trip['latitude'], self.trip['longitude']
+            trip_distance[0] += self.trip['distance']
+
+        trips = [{'start': int(start[i]), 'end': int(timestamp[stop[i] - 1]),
+                  'latitude': float(lat[i]), 'longitude': float(lng[i]),
+                  'distance': float(trip_distance[i])} for i in range(len(first) - 1)]
+        self.last = {'timestamp': int(timestamp[-1]), 'latitude': float(latitude[-1]),
+                     'longitude': float(longitude[-1])}
+        self.trip = {'start': int(start[-1]), 'latitude': float(lat[-1]), 'longitude': float(lng[-1]),
+                     'distance': float(trip_distance[-1]), 'stationary': bool(stationary[-1])}
+        return trips
+
+    def to_attachment(self):
         """
-        lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
-
-        dlon = lon2 - lon1
-        dlat = lat2 - lat1
-
-        a = np.sin(dlat/2.0)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2.0)**2
-
-        c = 2 * np.arcsin(np.sqrt(a))
-        km = 6367 * c
-        return km
-
-    def euclid_distance1(lat, lng, lat0, lng0): # degrees -> km
-        '''
-        Using this for convenience over GeoPy because it doesn't support our vectorized operations w/ Pandas
-        '''
-        return 110.25 * ((((lat - lat0) ** 2) + (((lng - lng0) * np.cos(lat0)) ** 2)) ** 0.5)
-    
-    def total_distance(df,col, idx1, idx2):
-        return df[col][idx1:idx2].sum()
-    
-    def end_timestamp(df, idx2, col='timestamp'):
-        idx  = idx2 - 1
-        return df['timestamp'][idx]
-    
-    def get_trips(gps_data):
+        Serialize the segmenter for the `cortex.trips.state` attachment.
         """
-        Get trips for a given GPS DataFrame
+        return {'end': self.end, 'last': self.last, 'trip': self.trip}
 
-        :param gps_data (pd.DataFrame): Dataframe of raw GPS data
-        
-        :return (list): list of dicts, where each dict is a trip, with the following keys: 'start', 'end', 'latitude', 'longitude','distance'
+    @classmethod
+    def from_attachment(cls, body):
         """
-        SPEED_THRESHOLD = 10.0
-        TIME_THRESHOLD = 600
-    
-        gps_data['dt'] = (gps_data['timestamp'] - gps_data['timestamp'].shift()) / (1000*3600)
-        gps_data['dx'] = haversine_np(
-            gps_data.latitude.shift(fill_value=0), gps_data.longitude.shift(fill_value=0),
-            gps_data.loc[1:, 'latitude'], gps_data.loc[1:, 'longitude']
-        )
-        gps_data['speed'] = gps_data['dx'] / gps_data['dt']
-        gps_data['stationary'] = ((gps_data['speed'] < SPEED_THRESHOLD) | (gps_data['dt'] > TIME_THRESHOLD))
-        gps_data['stationary_1'] = gps_data['stationary'].shift()
-        gps_data['idx'] = gps_data.index
-        new = gps_data[gps_data['stationary'] != gps_data['stationary_1']]
-        new['idx_shift'] = new['idx'].shift(-1, fill_value=0)
-        new[new['stationary'] == False]
-        new = new[new['idx_shift'] != 0]
-        new['distance'] = new.apply(lambda row: total_distance(gps_data, 'dx', row['idx'], row['idx_shift']), axis=1)
-        new['end'] = new.apply(lambda row: end_timestamp(gps_data, row['idx_shift']), axis=1)
-        new = new[['timestamp', 'end', 'latitude', 'longitude', 'distance']]
-        new.columns = ['start', 'end', 'latitude', 'longitude','distance']
-        return list(new.T.to_dict().values())
-
-    ### ####
-    
-    df = pd.DataFrame.from_dict(list(reversed(gps(**kwargs)['data'])))
-    log.info(f'Labeling GPS')
-    labeled_gps = get_trips(df)
-    return labeled_gps
\ No newline at end of file
+        Deserialize a segmenter from the `cortex.trips.state` attachment.
+        """
+        return cls(body['end'], body['last'], body['trip'])
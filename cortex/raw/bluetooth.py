@@ -1,5 +1,5 @@
 from ..feature_types import raw_feature
-import LAMP
+from .fetch import fetch_events
 
 
 @raw_feature(
@@ -17,20 +17,7 @@ def bluetooth(resolution=None, limit=20000, cache=True, recursive=True, **kwargs
     :return bt_address (str): Address of Bluetooth event
     """
 
-    data = LAMP.SensorEvent.all_by_participant(kwargs['id'],
-                                               origin="lamp.bluetooth",
-                                               _from=kwargs['start'],
-                                               to=kwargs['end'],
-                                               _limit=limit)['data']
-    while data and recursive:
-        to = data[-1]['timestamp']
-        data_next = LAMP.SensorEvent.all_by_participant(kwargs['id'],
-                                                        origin="lamp.bluetooth",
-                                                        _from=kwargs['start'],
-                                                        to=to,
-                                                        _limit=limit)['data']
-        if not data_next: break
-        if data_next[-1]['timestamp'] == to: break
-        data += data_next
+    data = fetch_events("SensorEvent", kwargs['id'], kwargs['start'], kwargs['end'],
+                        origin="lamp.bluetooth", limit=limit, recursive=recursive)
 
     return [{'timestamp': x['timestamp'], **x['data']} for x in data]
@@ -0,0 +1,161 @@
+from ..feature_types import log
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import threading
+import urllib3
+import math
+import time
+import os
+import LAMP
+
+# The number of requests made concurrently while fetching a single event stream.
+FETCH_WORKERS = int(os.getenv('CORTEX_FETCH_WORKERS', 4))
+
+# The most time shards fetched per worker; each shard is paged through by one worker.
+SHARDS_PER_WORKER = 4
+
+# Page sizes are halved (down to FETCH_MIN_LIMIT) when a request takes longer than
+# FETCH_SLOW seconds, and doubled back up to the requested limit when it is 4x faster.
+FETCH_SLOW = 10.0
+FETCH_MIN_LIMIT = 1000
+
+# Failed requests are retried FETCH_RETRIES times, waiting 1s, 2s, 4s, ... in between.
+FETCH_RETRIES = 3
+
+# Timing of the most recent requests, summarized by `fetch_metrics()`.
+_metrics = deque(maxlen=10000)
+_metrics_lock = threading.Lock()
+
+
+def fetch_events(api, id, start, end, origin=None, limit=20000, recursive=True, workers=FETCH_WORKERS):
+    """
+    Get all events bounded by time interval, newest first.
+
+    The newest page is requested first. If the time interval holds more than one page,
+    the rest of it is split into time shards which are paged through concurrently.
+
+    :param api (str): The kind of event to get ("SensorEvent" or "ActivityEvent").
+    :param id (str): The participant id.
+    :param start (int): The UTC timestamp of the start of the time interval.
+    :param end (int): The UTC timestamp of the end of the time interval.
+    :param origin (str): The sensor or activity to get events for (i.e. "lamp.gps"), if any.
+    :param limit (int): The number of events to request per page.
+    :param recursive (bool): Whether to page through the whole time interval, or get one page.
+    :param workers (int): The number of pages to request at once.
+    :return (list): The events, ordered by descending timestamp.
+    """
+    # The page size is shared, and adapted, by all the shards' requests.
+    pace = {'limit': limit, 'min': min(limit, FETCH_MIN_LIMIT), 'max': limit, 'lock': threading.Lock()}
+    page = _request(api, id, origin, start, end, limit)
+    if not recursive or not page:
+        return page
+    if len(page) < limit:
+        return _fetch(api, id, origin, start, end, pace, page)
+
+    # Skip the time before the participant's oldest event (the API returns the oldest
+    # events first when given a negative limit) when splitting the rest into shards.
+    oldest, last = _request(api, id, origin, start, end, -1), page[-1]['timestamp']
+    first = oldest[0]['timestamp'] if oldest and start <= oldest[0]['timestamp'] <= last else start
+
+    # Size the shards so they hold about as many pages as there are shards, judging by
+    # the time covered by the first page.
+    pages = (last - first + 1) / (page[0]['timestamp'] - last + 1)
+    count = max(1, min(workers * SHARDS_PER_WORKER, math.ceil(pages)))
+    width = math.ceil((last - first + 1) / count)
+    shards = [(s, min(s + width - 1, last)) for s in range(first, last + 1, width)]
+
+    # Shards don't overlap, so events at `last` are only taken from the newest shard.
+    data = [x for x in page if x['timestamp'] > last]
+    log.info(f"Fetching \"{origin or api}\" in {len(shards)} shard(s)...")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for shard in reversed(list(pool.map(lambda s: _fetch(api, id, origin, s[0], s[1], pace), shards))):
+            data += shard
+    return data
+
+
+def fetch_metrics():
+    """
+    Summarize the timing of the most recent requests made to the LAMP API server.
+
+    :return (list): For each kind of event and origin, the number of requests and events
+    fetched, the total and slowest request time (in seconds), and the number of retries.
+    """
+    summary = {}
+    with _metrics_lock:
+        for m in _metrics:
+            s = summary.setdefault((m['api'], m['origin']), {'api': m['api'], 'origin': m['origin'],
+                                                              'requests': 0, 'events': 0, 'seconds': 0.0,
+                                                              'slowest': 0.0, 'retries': 0})
+            s['requests'] += 1
+            s['events'] += m['events']
+            s['seconds'] += m['seconds']
+            s['slowest'] = max(s['slowest'], m['seconds'])
+            s['retries'] += m['retries']
+    return list(summary.values())
+
+
+def _fetch(api, id, origin, start, end, pace, data=None):
+    """
+    Page backwards through all events in [start, end], starting after the page `data`
+    if given, and drop the events repeated at the boundary between consecutive pages.
+    """
+    if data is None:
+        data = _request(api, id, origin, start, end, _limit(pace), pace)
+    while data:
+        to, seen = data[-1]['timestamp'], 0
+        while seen < len(data) and data[-1 - seen]['timestamp'] == to:
+            seen += 1
+        limit = _limit(pace)
+        data_next = _request(api, id, origin, start, to, limit, pace)
+        repeated = [i for i in range(min(seen, len(data_next))) if data_next[i]['timestamp'] == to]
+        if len(repeated) == len(data_next) == limit:
+            # More than a page of events share this timestamp; the API can't page through them.
+            data_next, repeated = _request(api, id, origin, start, to - 1, _limit(pace), pace), []
+        data_next = data_next[len(repeated):]
+        if not data_next: break
+        data += data_next
+    return data
+
+
+def _request(api, id, origin, start, end, limit, pace=None):
+    """
+    Request one page of events, retrying failed requests with exponential backoff, and
+    adapt the page size in `pace` to how long the request took.
+    """
+    params = {'_from': start, 'to': end, '_limit': limit}
+    if origin is not None:
+        params['origin'] = origin
+
+    for retry in range(FETCH_RETRIES + 1):
+        t0 = time.time()
+        try:
+            data = getattr(LAMP, api).all_by_participant(id, **params)['data']
+            break
+        except (LAMP.ApiException, urllib3.exceptions.HTTPError, OSError) as e:
+            if isinstance(e, LAMP.ApiException) and e.status is not None and e.status < 500 and e.status != 429:
+                raise
+            if retry == FETCH_RETRIES:
+                raise
+            log.info(f"Request for \"{origin or api}\" failed ({e.__class__.__name__}), retrying in {2 ** retry}s...")
+            time.sleep(2 ** retry)
+    elapsed = time.time() - t0
+
+    with _metrics_lock:
+        _metrics.append({'api': api, 'origin': origin, 'events': len(data), 'seconds': elapsed, 'retries': retry})
+    log.debug(f"Fetched {len(data)} \"{origin or api}\" event(s) in {elapsed:.2f}s")
+
+    if pace is not None and len(data) == limit:
+        with pace['lock']:
+            if elapsed > FETCH_SLOW:
+                pace['limit'] = max(pace['min'], min(pace['limit'], limit // 2))
+            elif elapsed < FETCH_SLOW / 4:
+                pace['limit'] = min(pace['max'], max(pace['limit'], limit * 2))
+    return data
+
+
+def _limit(pace):
+    """
+    The current page size in `pace`, which requests from other shards may be adapting.
+    """
+    with pace['lock']:
+        return pace['limit']
@@ -1,4 +1,5 @@
 from ..feature_types import raw_feature
+from .fetch import fetch_events
 import LAMP
 
 
@@ -6,7 +7,7 @@ import LAMP
     name="lamp.jewels_b",
     dependencies=["lamp.jewels_b"]
 )
-def jewels_b(resolution=None, limit=20000, cache=True, **kwargs):
+def jewels_b(resolution=None, limit=20000, cache=True, recursive=True, **kwargs):
 
     jewels_b_ids = [activity['id'] for activity in
                     LAMP.Activity.all_by_participant(kwargs['id'])['data']
@@ -18,28 +19,8 @@ def jewels_b(resolution=None, limit=20000, cache=True, **kwargs):
                   'activity_name': 'lamp.jewels_b',
                   'static_data': res['static_data'],
                   'temporal_slices': res['temporal_slices']}
-                 for res in LAMP.ActivityEvent.all_by_participant(kwargs['id'],
-                                                                  _from=kwargs['start'],
-                                                                  to=kwargs['end'],
-                                                                  _limit=limit)['data']
+                 for res in fetch_events("ActivityEvent", kwargs['id'], kwargs['start'], kwargs['end'],
+                                         limit=limit, recursive=recursive)
                  if res['activity'] in jewels_b_ids]
 
-    while _jewels_b:
-        kwargs['end'] = _jewels_b[-1]['timestamp']
-        _jewels_b_next = [{'timestamp': res['timestamp'],
-                           'duration': res['duration'],
-                           'activity':res['activity'],
-                           'activity_name':'lamp.jewels_b',
-                           'static_data':res['static_data'],
-                           'temporal_slices':res['temporal_slices']}
-                          for res in LAMP.ActivityEvent.all_by_participant(kwargs['id'],
-                                                                           _from=kwargs['start'],
-                                                                           to=kwargs['end'],
-                                                                           _limit=limit)['data']
-                          if res['activity'] in jewels_b_ids]
-
-        if not _jewels_b_next: break
-        if _jewels_b_next[-1]['timestamp'] == kwargs['end']: break
-        print('append')
-        _jewels_b += _jewels_b_next
     return _jewels_b
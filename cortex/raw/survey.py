@@ -1,4 +1,5 @@
 from ..feature_types import raw_feature, log
+from .fetch import fetch_events
 import LAMP
 
 
@@ -6,12 +7,12 @@ import LAMP
     name='lamp.survey',
     dependencies=['lamp.survey']
 )
-def survey(replace_ids=True, limit=2147483647, cache=True, **kwargs):
+def survey(replace_ids=True, limit=20000, cache=True, recursive=True, **kwargs):
     """
     Get survey events for participant
 
     :param replace_ids (bool): TODO.
-    :param limit (int): TODO.
+    :param limit (int): The number of events to request per page.
     :return timestamp (int): TODO.
     :return survey (str): TODO.
     :return item (str): TODO.
@@ -23,31 +24,11 @@ def survey(replace_ids=True, limit=2147483647, cache=True, **kwargs):
     # TODO: Once the API Server supports filtering origin by an ActivitySpec, we won't need this.
     activities = LAMP.Activity.all_by_participant(kwargs['id'])['data']
     surveys = {x['id']: x for x in activities if x['spec'] == 'lamp.survey'}
-    raw = LAMP.ActivityEvent.all_by_participant(kwargs['id'],
-                                                # origin="lamp.survey" TODO: backend not implemented
-                                                _from=kwargs['start'],
-                                                to=kwargs['end'],
-                                                _limit=limit)['data']
+    raw = fetch_events("ActivityEvent", kwargs['id'], kwargs['start'], kwargs['end'],
+                       # origin="lamp.survey" TODO: backend not implemented
+                       limit=limit, recursive=recursive)
     
-    def remove_duplicate_activity_events(raw_data):
-        # Here, we remove any duplicates from raw data
-        # by generating a new list, then replacing the old one.
-        raw_minus_duplicates = []
-        for index, event in enumerate(raw_data):
-            #get a list of all duplicate elements
-            duplicates = list(filter(lambda x: x['temporal_slices']==event['temporal_slices'],raw_minus_duplicates))
-            #if we find a duplicate
-            if not len(duplicates)==0:
-                # we choose the event with a longer duration to be the true event
-                true_event = duplicates[0] if duplicates[0]['duration']>=event['duration'] else event
-                # and replace the old event with the new one
-                raw_minus_duplicates[raw_minus_duplicates.index(duplicates[0])] =  true_event    
-            else:
-                # if we didn't find a duplicate, we just add the new event to the growing list
-                raw_minus_duplicates.append(event)
-        return raw_minus_duplicates
-    
-    raw = remove_duplicate_activity_events(raw)
+    raw = _remove_duplicate_activity_events(raw)
 
     # Unpack the temporal slices and flatten the dict, including the timestamp and survey.
     # Computing a per-event survey score requires a `groupby('timestamp', 'survey')` call.
@@ -63,3 +44,37 @@ def survey(replace_ids=True, limit=2147483647, cache=True, **kwargs):
             and len(x['temporal_slices']) > 0
         for y in x['temporal_slices']
     ]
+
+
+def _remove_duplicate_activity_events(raw_data):
+    """
+    Remove duplicate ActivityEvents (with equal temporal slices), keeping the one with the
+    longest duration (the earliest if tied) in the place of the first.
+
+    Events are looked up by a hashable fingerprint of their temporal slices, so this is linear
+    in the number of events.
+    """
+    raw_minus_duplicates = []
+    position = {}
+    for event in raw_data:
+        key = _freeze(event['temporal_slices'])
+        if key in position:
+            # we choose the event with a longer duration to be the true event
+            if event['duration'] > raw_minus_duplicates[position[key]]['duration']:
+                raw_minus_duplicates[position[key]] = event
+        else:
+            position[key] = len(raw_minus_duplicates)
+            raw_minus_duplicates.append(event)
+    return raw_minus_duplicates
+
+
+def _freeze(value):
+    """
+    A hashable fingerprint of a JSON value, equal for equal values: dicts become frozensets of
+    their items, and lists tuples.
+    """
+    if isinstance(value, dict):
+        return frozenset((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
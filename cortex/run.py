@@ -1,15 +1,18 @@
 import os
 import time
 from functools import reduce
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
 
 import pandas as pd
 import altair as alt
 
 import LAMP
+# The feature modules are imported for the features they register, which `run` looks up by name
+# (and `_bounds` searches all raw features of).
 import cortex.raw as raw
 import cortex.primary as primary
 import cortex.secondary as secondary
-from cortex.feature_types import all_features
+from cortex.feature_types import all_features, memoize, log, _connect
 
 # Convenience to avoid extra imports/time-mangling nonsense...
 def now():
@@ -18,62 +21,184 @@ def now():
 # Convenience to avoid mental math...
 MS_PER_DAY = 86400000 # (1000 ms * 60 sec * 60 min * 24 hr * 1 day)
 
-def run(id_or_set, features, start=None, end=None, resolution=MS_PER_DAY):
+# The number of participants computed at once by `run`; more than one runs them in a process pool.
+RUN_WORKERS = int(os.getenv('CORTEX_RUN_WORKERS', 1))
+
+def run(id_or_set, features, start=None, end=None, resolution=MS_PER_DAY, workers=RUN_WORKERS, **kwargs):
+    """
+    Compute features for every participant in a Researcher, Study, or list of ids.
+
+    Each participant is computed as a separate job, one after another in this process,
+    or (if `workers` is more than 1) in a pool of `workers` processes.
+    The features are computed in dependency order, and every feature (including the
+    dependencies shared by several of them) is computed at most once per participant
+    and time window. A feature that fails is logged and left out of the results
+    instead of aborting the whole run.
+
+    :param id_or_set (str/list): A Researcher, Study, or Participant id, or a list of ids.
+    :param features (list): The names of the features to compute.
+    :param start (int): The UTC timestamp to start from; if None, each participant's first event.
+    :param end (int): The UTC timestamp to end at; if None, each participant's last event.
+    :param resolution (int): The time window (in ms) secondary features are computed for.
+    :param workers (int): The number of jobs to run at once; if 1, jobs run in this process.
+    :param kwargs: Any other parameters are passed through to the features.
+    :return (dict): For each feature, a DataFrame of the results of all participants.
+    """
     # Connect to the LAMP API server.
-    if not 'LAMP_ACCESS_KEY' in os.environ or not 'LAMP_SECRET_KEY' in os.environ:
-        raise Exception(f"You configure `LAMP_ACCESS_KEY` and `LAMP_SECRET_KEY` (and optionally `LAMP_SERVER_ADDRESS`) to use Cortex.")
-    LAMP.connect(os.getenv('LAMP_ACCESS_KEY'), os.getenv('LAMP_SECRET_KEY'),
-                 os.getenv('LAMP_SERVER_ADDRESS', 'api.lamp.digital'))
+    _connect()
     
     #1. Check id to generate list of participants (put into "generate_id_list"?)
     participants = generate_ids(id_or_set)
     func_list = {f['callable'].__name__: f for f in all_features()}
     
-    #TODO allow for raw, primary, and secondary to be used at once
-#     fns = map(lambda feature_group: [getattr(mod, mod_name) 
-#                                      for mod_name, mod in getmembers(feature_group, ismodule) 
-#                                      if mod_name in features],
-#               [raw, primary, secondary])
+    # Make sure we aren't calling non-existant feature functions.
+    features = [f for f in features if f in func_list.keys()]
+    if len(features) == 0 or len(participants) == 0:
+        return {f: pd.DataFrame() for f in features}
     
+    with _executor(workers) as pool:
+        # Find each participant's start and end, if not given.
+        bounds, failures = {}, []
+        for participant, job in [(p, pool.submit(_bounds, p, start, end)) for p in participants]:
+            try:
+                bounds[participant] = job.result()
+            except Exception as e:
+                log.error(f"Could not find the start and end for participant {participant}: {e!r}")
+                failures += [(f, participant) for f in features]
+
+        # Fan out one job per participant, computing the features in dependency order.
+        order = _schedule(features)
+        jobs = {pool.submit(_job, order, participant, *bounds[participant], resolution, kwargs): participant
+                for participant in participants
+                if bounds.get(participant) is not None}
+        _done = {}
+        for job in as_completed(jobs):
+            participant = jobs[job]
+            try:
+                _frames, _errors = job.result()
+            except Exception as e:
+                _frames, _errors = {}, {f: repr(e) for f in features}
+            for f, e in _errors.items():
+                log.error(f"Feature \"{f}\" failed for participant {participant}: {e}")
+                failures.append((f, participant))
+            _done.update({(f, participant): frame for f, frame in _frames.items()})
+
+    # Collect the results once, in the order they were requested.
     _results = {}
     for f in features:
-        
-        # Make sure we aren't calling non-existant feature functions.
-        if f not in func_list.keys():
-            continue
-        _results[f] = pd.DataFrame()
-        
-        # Iterate all participants in the list
-        for participant in participants:
-            
-            #Find start, end 
-            # FIXME: Seems to not work correctly in every case?
-            if start is None:
-                start = min([getattr(mod, mod_name)(id=participant, start=0, end=int(time.time())*1000, cache=False, recursive=False, limit=-1)['data'][0]['timestamp']
-                                  for mod_name, mod in getmembers(raw, ismodule)
-                                  if len(getattr(mod, mod_name)(id=participant, start=0, end=int(time.time())*1000, cache=False, recursive=False, limit=-1)['data']) > 0])
-            if end is None:
-                end = max([getattr(mod, mod_name)(id=participant, start=0, end=int(time.time())*1000, cache=False, recursive=False, limit=1)['data'][0]['timestamp']
-                            for mod_name, mod in getmembers(raw, ismodule)
-                            if len(getattr(mod, mod_name)(id=participant, start=0, end=int(time.time())*1000, cache=False, recursive=False, limit=1)['data']) > 0])
-            
-            #TODO only for raw function; allow resolution/other params to be passed if secondary, etc
-            _res = func_list[f]['callable'](
-                     id=participant,
-                     start=start,
-                     end=end,
-                     #resolution=MS_PER_DAY
-                   )
+        _frames = [_done[(f, participant)] for participant in participants
+                   if (f, participant) in _done and _done[(f, participant)].shape[0] > 0]
+        _results[f] = pd.concat(_frames) if len(_frames) > 0 else pd.DataFrame()
+
+    if len(failures) > 0:
+        log.error(f"{len(failures)} of {len(features) * len(participants)} job(s) failed: " +
+                  ", ".join(f"{f} ({participant})" for f, participant in failures))
+    return _results
+
+def _executor(workers):
+    """
+    A process pool of `workers` processes, or for a single worker, one that runs jobs in this process.
+    """
+    if workers is not None and workers <= 1:
+        return _InProcessExecutor()
+    return ProcessPoolExecutor(max_workers=workers)
+
+class _InProcessExecutor():
+    """
+    An executor that runs each job in this process and thread as soon as it is submitted.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+def _bounds(participant, start=None, end=None):
+    """
+    Fill in a missing start or end with the participant's first or last raw event.
+
+    :return (tuple): The start and end, or None if the participant has no data at all.
+    """
+    if start is not None and end is not None:
+        return start, end
+    _raw = [f['callable'] for f in all_features() if f['type'] == 'raw']
+    t = now()
+    if start is None:
+        first = [r['data'][0]['timestamp'] for r in (fn(id=participant, start=0, end=t, cache=False, recursive=False, limit=-1) for fn in _raw)
+                 if len(r['data']) > 0]
+        if len(first) == 0: return None
+        start = min(first)
+    if end is None:
+        last = [r['data'][0]['timestamp'] for r in (fn(id=participant, start=0, end=t, cache=False, recursive=False, limit=1) for fn in _raw)
+                if len(r['data']) > 0]
+        if len(last) == 0: return None
+        end = max(last)
+    return start, end
+
+def _schedule(features):
+    """
+    Order the features so that each comes after the features it depends on.
+
+    The dependency graph is built from the `dependencies` declared to the feature
+    decorators: primary and secondary features list the decorated functions they use,
+    while raw features only list their own data sources.
+
+    :param features (list): The names of the features to compute.
+    :return (list): The names of the features, in an order that respects their dependencies.
+    """
+    registry = {f['callable'].__name__: f for f in all_features()}
+    names = {id(f['callable']): n for n, f in registry.items()}
+    order, visiting = [], set()
+    def visit(n):
+        if n in order: return
+        if n in visiting:
+            raise Exception(f"features depending on each other: {n}")
+        visiting.add(n)
+        for dep in registry[n]['dependencies']:
+            if id(dep) in names:
+                visit(names[id(dep)])
+        visiting.remove(n)
+        order.append(n)
+    for f in features:
+        visit(f)
+    requested = set(features)
+    return [n for n in order if n in requested]
+
+def _job(features, participant, start, end, resolution, kwargs):
+    """
+    Compute the features for one participant, each as a DataFrame with an 'id' column.
+
+    The features are looked up by name, since the decorated functions can't be pickled
+    and sent to another process. Features are memoized for the duration of the job, so
+    the dependencies they share are only computed once.
+
+    :return (tuple): The DataFrame of each feature computed, and the error of each that failed.
+    """
+    registry = {f['callable'].__name__: f for f in all_features()}
+    _frames, _errors = {}, {}
+    with memoize():
+        for feature in features:
+            try:
+                params = {'resolution': resolution} if registry[feature]['type'] == 'secondary' else {}
+                _res = registry[feature]['callable'](id=participant, start=start, end=end, **{**params, **kwargs})
+            except Exception as e:
+                _errors[feature] = repr(e) # exceptions may not be picklable
+                continue
             _res2 = pd.DataFrame.from_dict(_res['data'])
             if _res2.shape[0] > 0:
-                # If no data exists, don't bother appending the df.
                 _res2.insert(0, 'id', participant) # prepend 'id' column
+            if 'timestamp' in _res2:
                 _res2.timestamp = pd.to_datetime(_res2.timestamp, unit='ms') # convert to datetime
-                _results[f] = pd.concat([_results[f], _res2])
-            
-    #TODO: convert and concat all dicts in each _results[str(f)] to pd.DataFrame
-            
-    return _results
+            _frames[feature] = _res2
+    return _frames, _errors
 
 # Helper function to generate a plot directly from a Cortex DF.
 # FIXME: currently only allows plotting first one; should be alt.layer()'ed charts.
@@ -2,16 +2,25 @@ from ..feature_types import secondary_feature
 from ..raw.calls import calls
 
 import numpy as np
+import pandas as pd
 
 MS_IN_A_DAY = 86400000
 @secondary_feature(
     name='cortex.feature.call_degree',
-    dependencies=[calls]
+    dependencies=[calls],
+    vectorized=True
 )
-def call_degree(resolution=MS_IN_A_DAY, **kwargs):
+def call_degree(bins, resolution=MS_IN_A_DAY, **kwargs):
     """
     How many phone numbers you were connecting with
     """
-    _calls = calls(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'])['data']
-    _call_degree = np.unique([call['call_trace'] for call in _calls]).size
-    return {'timestamp':kwargs['start'], 'call_degree': _call_degree}
\ No newline at end of file
+    _calls = calls(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'], as_frame=True)['data']
+    if len(_calls) == 0:
+        return {'call_degree': np.zeros(len(bins) - 1, dtype=int)}
+    # Count each (window, phone number) pair once.
+    window = np.searchsorted(bins, _calls['timestamp'].to_numpy(), side='right') - 1
+    trace = pd.factorize(_calls['call_trace'])[0]
+    inside = (window >= 0) & (window < len(bins) - 1)
+    pairs = np.unique(np.stack([window[inside], trace[inside]], axis=1), axis=0)
+    _call_degree = np.bincount(pairs[:, 0], minlength=len(bins) - 1)
+    return {'call_degree': _call_degree}
\ No newline at end of file
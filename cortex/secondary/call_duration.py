@@ -1,4 +1,4 @@
-from ..feature_types import secondary_feature, log
+from ..feature_types import secondary_feature, log, _bincount
 from ..raw.calls import calls
 
 import numpy as np
@@ -6,16 +6,20 @@ import numpy as np
 MS_IN_A_DAY = 86400000
 @secondary_feature(
     name='cortex.feature.call_duration',
-    dependencies=[calls]
+    dependencies=[calls],
+    vectorized=True
 )
-def call_duration(resolution=MS_IN_A_DAY, incoming=True, **kwargs):
+def call_duration(bins, resolution=MS_IN_A_DAY, incoming=True, **kwargs):
     """
     Time spent talking on the phone
     """
     INCOMING_DICT = {True: 1, False:2}
     label = INCOMING_DICT[incoming] 
     log.info(f'Loading raw calls data...')
-    _calls = calls(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'])['data']
+    _calls = calls(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'], as_frame=True)['data']
     log.info(f'Computing call duration...')
-    _call_duration = np.sum([call['call_duration'] for call in _calls if call['call_type'] == label])
-    return {'timestamp':kwargs['start'], 'call_duration': _call_duration}
\ No newline at end of file
+    if len(_calls) == 0:
+        return {'call_duration': np.zeros(len(bins) - 1)}
+    _calls = _calls[_calls['call_type'] == label]
+    _call_duration = _bincount(_calls['timestamp'], bins, weights=_calls['call_duration'])
+    return {'call_duration': _call_duration}
\ No newline at end of file
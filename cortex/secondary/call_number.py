@@ -1,4 +1,4 @@
-from ..feature_types import secondary_feature
+from ..feature_types import secondary_feature, _bincount
 from ..raw.calls import calls
 
 import numpy as np
@@ -6,14 +6,18 @@ import numpy as np
 MS_IN_A_DAY = 86400000
 @secondary_feature(
     name='cortex.feature.call_number',
-    dependencies=[calls]
+    dependencies=[calls],
+    vectorized=True
 )
-def call_number(resolution=MS_IN_A_DAY, incoming=True, **kwargs):
+def call_number(bins, resolution=MS_IN_A_DAY, incoming=True, **kwargs):
     """
     Number of calls made
     """
     INCOMING_DICT = {True: 1, False:2}
     label = INCOMING_DICT[incoming] 
-    _calls = calls(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'])['data']
-    _call_number = len([call for call in _calls if call['call_type'] == label])
-    return {'timestamp':kwargs['start'], 'call_number': _call_number}
\ No newline at end of file
+    _calls = calls(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'], as_frame=True)['data']
+    if len(_calls) == 0:
+        return {'call_number': np.zeros(len(bins) - 1, dtype=int)}
+    _calls = _calls[_calls['call_type'] == label]
+    _call_number = _bincount(_calls['timestamp'], bins)
+    return {'call_number': _call_number}
\ No newline at end of file
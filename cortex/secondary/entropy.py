@@ -1,21 +1,28 @@
 from ..feature_types import secondary_feature, log
-from ..primary.significant_locations import significant_locations
+from ..primary.significant_locations import significant_locations, location_model, _window_locations
+from ..raw.gps import gps
+
+import numpy as np
 
 MS_IN_A_DAY = 86400000
 @secondary_feature(
     name='cortex.feature.entropy',
-    dependencies=[significant_locations]
+    dependencies=[significant_locations],
+    vectorized=True
 )
-def entropy(resolution=MS_IN_A_DAY, **kwargs):
+def entropy(bins, resolution=MS_IN_A_DAY, **kwargs):
     """
     Calculate entropy 
     """
     #log.info(f'Loading significant locations data...')
-    _significant_locations = significant_locations(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'])
-    if len(_significant_locations['data']) == 0:
-        _entropy = None
+    _gps = gps(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'], as_frame=True)['data']
+    model = location_model(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'])
+    if model is None:
+        return {'entropy': [None] * (len(bins) - 1)}
+    count, _, _ = _window_locations(model['centroids'], _gps, bins)
     #log.info(f'Computing entropy...')
-    _entropy = sum([loc['proportion'] * math.log(loc['proportion']) for loc in _significant_locations['data']])
-    if _entropy == 0: #no sig locs
-        _entropy = None
-    return {'timetamp':kwargs['start'], 'entropy': _entropy}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        proportion = count / count.sum(axis=1, keepdims=True)
+        _entropy = np.where(count > 0, proportion * np.log(proportion), 0).sum(axis=1)
+    # no sig locs
+    return {'entropy': [float(e) if e != 0 else None for e in _entropy]}
@@ -1,19 +1,22 @@
 from ..feature_types import secondary_feature, log
-from ..primary.significant_locations import significant_locations
-
-import math
-import datetime
-import pandas as pd
+from ..primary.significant_locations import significant_locations, location_model, _window_locations
+from ..raw.gps import gps
 
 MS_IN_A_DAY = 86400000
 @secondary_feature(
     name='cortex.feature.hometime',
-    dependencies=[significant_locations]
+    dependencies=[significant_locations],
+    vectorized=True
 )
-def hometime(resolution=MS_IN_A_DAY, **kwargs):
-    _significant_locations = significant_locations(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'])
-    if len(_significant_locations['data']) == 0:
-        _hometime = None
-    else:
-        _hometime = [loc['duration'] for loc in _significant_locations['data'] if loc['rank'] == 0][0]
-    return {'timestamp':kwargs['start'], 'hometime': _hometime}
+def hometime(bins, resolution=MS_IN_A_DAY, **kwargs):
+    """
+    Time spent at the most visited significant location in each window; the location model is
+    fitted (or loaded) once for the whole time interval, and each window's fixes assigned to it.
+    """
+    _gps = gps(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'], as_frame=True)['data']
+    model = location_model(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'])
+    if model is None:
+        return {'hometime': [None] * (len(bins) - 1)}
+    count, duration, _ = _window_locations(model['centroids'], _gps, bins)
+    _hometime = [int(d[0]) if c.sum() > 0 else None for c, d in zip(count, duration)]
+    return {'hometime': _hometime}
@@ -1,17 +1,17 @@
-from ..feature_types import secondary_feature
+from ..feature_types import secondary_feature, _bincount
 from ..primary.screen_active import screen_active
 
-import numpy as np
-
 MS_IN_A_DAY = 86400000
 @secondary_feature(
     name='cortex.feature.screen_duration',
-    dependencies=[screen_active]
+    dependencies=[screen_active],
+    vectorized=True
 )
-def screen_duration(resolution=MS_IN_A_DAY, **kwargs):
+def screen_duration(bins, resolution=MS_IN_A_DAY, **kwargs):
     """
     Screen active time
     """
-    _screen_active = screen_active(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'])
-    _screen_duration = np.sum([active_bout['duration'] for active_bout in _screen_active['data']])
-    return {'timestamp':kwargs['start'], 'screen_duration': _screen_duration}
\ No newline at end of file
+    _screen_active = screen_active(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'])['data']
+    _screen_duration = _bincount([active_bout['start'] for active_bout in _screen_active], bins,
+                                 weights=[active_bout['duration'] for active_bout in _screen_active])
+    return {'screen_duration': _screen_duration}
\ No newline at end of file
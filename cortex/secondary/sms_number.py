@@ -1,4 +1,4 @@
-from ..feature_types import secondary_feature
+from ..feature_types import secondary_feature, _bincount
 from ..raw.sms import sms
 
 import numpy as np
@@ -6,14 +6,18 @@ import numpy as np
 MS_IN_A_DAY = 86400000
 @secondary_feature(
     name='cortex.feature.sms_number',
-    dependencies=[sms]
+    dependencies=[sms],
+    vectorized=True
 )
-def sms_number(resolution=MS_IN_A_DAY, incoming=True, **kwargs):
+def sms_number(bins, resolution=MS_IN_A_DAY, incoming=True, **kwargs):
     """
-    Number of calls made
+    Number of texts sent or received
     """
     INCOMING_DICT = {True: 1, False:2}
     label = INCOMING_DICT[incoming] 
-    _sms = sms(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'])['data']
-    _sms_number = len([sms for sms in _sms if call['call_type'] == label])
-    return {'timestamp':kwargs['start'], 'call_number': _call_number}
\ No newline at end of file
+    _sms = sms(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'], as_frame=True)['data']
+    if len(_sms) == 0:
+        return {'sms_number': np.zeros(len(bins) - 1, dtype=int)}
+    _sms = _sms[_sms['call_type'] == label]
+    _sms_number = _bincount(_sms['timestamp'], bins)
+    return {'sms_number': _sms_number}
\ No newline at end of file
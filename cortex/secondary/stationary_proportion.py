@@ -1,29 +1,27 @@
-from ..feature_types import secondary_feature, log
+from ..feature_types import secondary_feature, log, _bincount
 from ..raw.accelerometer import accelerometer
-import pandas as pd
+import numpy as np
 
 @secondary_feature(
     name='cortex.feature.stationary_proportion',
-    dependencies=[accelerometer]
+    dependencies=[accelerometer],
+    vectorized=True
 )
-def stationary_proportion(g=9.57, eps=.1, col='z', **kwargs):
+def stationary_proportion(bins, g=9.57, eps=.1, col='z', **kwargs):
     """
     Compute the proportion of "stationary" accelerometer readings.
     An accelerometer reading is "stationary" if the z component is close to gravitational acceleration (9.81 m/s^2)
     g : float
         Gravitational acceleration constant
     eps : float
-        Epsilon; used to create an epsilon-neighborhood around g 
+        Epsilon; used to create an epsilon-neighborhood around g
     col : string
         Column name
     """
     #log.info(f'Loading Accelerometer data for 1st trajectory...')
-    acc = accelerometer(**kwargs)['data']
-    if acc:
-        acc = pd.DataFrame(acc)[['x', 'y', 'z']]
-        n = len(acc)
-        ct = len(acc[(acc[col] >= g - eps) & (acc[col] <= g + eps)])
-        stationary_proportion = round(ct/n, 5)
-    else:
-        stationary_proportion = []
-    return {'timestamp':kwargs['start'], 'stationary_proportion': stationary_proportion}
\ No newline at end of file
+    n, ct = np.zeros(len(bins) - 1), np.zeros(len(bins) - 1)
+    for acc in accelerometer(**{**kwargs, 'stream': True})['data']:
+        n += _bincount(acc['timestamp'], bins)
+        ct += _bincount(acc['timestamp'][(acc[col] >= g - eps) & (acc[col] <= g + eps)], bins)
+    stationary_proportion = [round(float(c/t), 5) if t else [] for c, t in zip(ct, n)]
+    return {'stationary_proportion': stationary_proportion}
\ No newline at end of file
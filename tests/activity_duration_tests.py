@@ -0,0 +1,80 @@
+import unittest
+import datetime
+import sys, os
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from cortex.secondary.active_duration import _active_bins
+from cortex.secondary.sedentary_duration import _sedentary_bins
+from cortex.primary.accelerometer_bins import AccelerometerProfile, MS_PER_DAY
+from tests.fixtures import accelerometer_bins, accelerometer_profile, wake_time
+
+
+def legacy_activity_count(bins, reduced_data, bed_time, wake_time, active=True):
+    """
+    The active (or sedentary) bin count as it was before it was vectorized.
+    """
+    accelDf = pd.DataFrame({'Time': pd.to_datetime(bins['timestamp'], unit='ms'),
+                            'magnitude': bins['magnitude']})
+    df10min = pd.DataFrame.from_dict(reduced_data).sort_values(by='time')
+
+    def counts(df, t):
+        mean = df10min.loc[df10min['time'] == t.time(), 'magnitude'].values[0]
+        return df['magnitude'].abs().mean() >= mean if active else df['magnitude'].abs().mean() < mean
+
+    activity_count = 0
+    for t, df in accelDf.groupby(pd.Grouper(key='Time', freq='10min')):
+        # Ignore block if can't map to mean value
+        if len(df10min.loc[df10min['time'] == t.time(), 'magnitude'].values) == 0:
+            continue
+
+        if datetime.time(0, 0) <= bed_time <= datetime.time(4, 0):
+            if t.time() < bed_time or t.time() > wake_time:
+                if counts(df, t):
+                    activity_count += 1
+        elif datetime.time(18, 0) <= bed_time <= datetime.time(23, 30):
+            if wake_time < t.time() < bed_time:
+                if counts(df, t):
+                    activity_count += 1
+    return activity_count
+
+
+class TestActivityDuration(unittest.TestCase):
+
+    def assertSameCounts(self, bins, profile, bed_time, wake_time):
+        self.assertEqual(_active_bins(bins, profile.magnitude, bed_time, wake_time),
+                         legacy_activity_count(bins, profile.records(), bed_time, wake_time, active=True))
+        self.assertEqual(_sedentary_bins(bins, profile.magnitude, bed_time, wake_time),
+                         legacy_activity_count(bins, profile.records(), bed_time, wake_time, active=False))
+
+    def test_same_as_legacy(self):
+        for seed in range(3):
+            bins = accelerometer_bins(seed, days=7)
+            profile = accelerometer_profile(bins)
+            for bed_time in [datetime.time(18, 0), datetime.time(22, 30), datetime.time(23, 30),
+                             datetime.time(0, 0), datetime.time(2, 30), datetime.time(4, 0),
+                             datetime.time(12, 0)]:
+                with self.subTest(seed=seed, bed_time=bed_time):
+                    self.assertSameCounts(bins, profile, bed_time, wake_time(bed_time))
+
+    def test_missing_baseline(self):
+        # Bins for times of day without a baseline are ignored.
+        bins = accelerometer_bins(4, days=3)
+        profile = AccelerometerProfile()
+        profile.add({k: v[:len(v) // 2] for k, v in bins.items()})
+        self.assertSameCounts(bins, profile, datetime.time(23, 0), datetime.time(7, 0))
+        self.assertSameCounts(bins, profile, datetime.time(1, 0), datetime.time(9, 0))
+
+    def test_active_and_sedentary_split(self):
+        # Every bin outside the sleep period with a baseline is either active or sedentary.
+        bins = accelerometer_bins(5, days=7, gaps=0)
+        profile = accelerometer_profile(bins)
+        bed_time, wake_time = datetime.time(22, 0), datetime.time(6, 0)
+        hour = (bins['timestamp'] % MS_PER_DAY) / 3600000
+        self.assertEqual(_active_bins(bins, profile.magnitude, bed_time, wake_time) +
+                         _sedentary_bins(bins, profile.magnitude, bed_time, wake_time),
+                         int(((hour > 6) & (hour < 22)).sum()))
+
+
+if __name__ == '__main__':
+    unittest.main()
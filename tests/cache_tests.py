@@ -0,0 +1,245 @@
+import unittest
+import sys, os
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from tests.fake_lamp import FakeLAMPTestCase, sensor_events
+from cortex.raw.gps import gps
+from cortex.raw.accelerometer import accelerometer
+from cortex.feature_types import rebuild_cache_index, _cache_index
+import cortex.feature_types
+
+DAY = 86400000
+
+
+def load_gps(cache_dir, start, end):
+    return gps(id='U1', start=start, end=end, cache_dir=cache_dir)['data']
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class TestCache(FakeLAMPTestCase):
+
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        timestamp = np.sort(rng.integers(0, 10 * DAY, 5000))
+        self.api = self.serve(sensor_events('lamp.gps', timestamp,
+                                            latitude=rng.normal(42.3, .01, 5000).tolist(),
+                                            longitude=rng.normal(-71.1, .01, 5000).tolist(),
+                                            altitude=[0.0] * 5000, accuracy=[5.0] * 5000))
+
+    def fetch(self, start, end, **kwargs):
+        return gps(id='U1', start=start, end=end, cache_dir=self.cache_dir, **kwargs)['data']
+
+    def segments(self):
+        index = _cache_index(self.cache_dir)
+        try:
+            return index.execute("SELECT name, start, end FROM cache ORDER BY start").fetchall()
+        finally:
+            index.close()
+
+    def test_uncached_same_as_no_cache(self):
+        self.assertEqual(self.fetch(DAY, 3 * DAY), self.fetch(DAY, 3 * DAY, cache=False))
+        self.assertEqual(self.segments(), [('gps', DAY, 3 * DAY)])
+
+    def test_covered_window_served_from_cache(self):
+        self.fetch(DAY, 5 * DAY)
+        expected = self.fetch(2 * DAY, 3 * DAY, cache=False)
+        self.api.calls.clear()
+        self.assertEqual(self.fetch(2 * DAY, 3 * DAY), expected)
+        self.assertEqual(self.api.calls, [])
+
+    def test_gaps_fetched_only(self):
+        self.fetch(2 * DAY, 4 * DAY)
+        self.fetch(6 * DAY, 7 * DAY)
+        self.api.calls.clear()
+        actual = self.fetch(DAY, 8 * DAY)
+        gaps = [(DAY, 2 * DAY - 1), (4 * DAY + 1, 6 * DAY - 1), (7 * DAY + 1, 8 * DAY)]
+        self.assertTrue(all(any(s <= c['_from'] <= c['to'] <= e for s, e in gaps) for c in self.api.calls))
+        self.assertEqual(sorted({(c['_from'], c['to']) for c in self.api.calls} & set(gaps)), gaps)
+        self.assertEqual(actual, self.fetch(DAY, 8 * DAY, cache=False))
+        # The segments touching the window are compacted into one.
+        self.assertEqual(self.segments(), [('gps', DAY, 8 * DAY)])
+        self.assertEqual(len([f for f in os.listdir(self.cache_dir) if f.startswith('gps_')]), 1)
+
+    def test_segments_capped(self):
+        # Days fetched one after another are cached in segments of up to STREAM_SEGMENT_SIZE
+        # events; only the last, small segment is merged with the next day.
+        with mock.patch('cortex.feature_types.STREAM_SEGMENT_SIZE', 600):
+            files = []
+            for day in range(10):
+                self.assertEqual(self.fetch(day * DAY, (day + 1) * DAY),
+                                 self.fetch(day * DAY, (day + 1) * DAY, cache=False))
+                files.append({f for f in os.listdir(self.cache_dir) if f.startswith('gps_')})
+            index = _cache_index(self.cache_dir)
+            counts = [count for (count,) in index.execute("SELECT count FROM cache ORDER BY start")]
+            index.close()
+            self.assertLessEqual(max(counts), 600)
+            self.assertGreater(len(counts), 5)
+            self.assertEqual(sum(counts), len(self.fetch(0, 10 * DAY, cache=False)))
+            self.assertLessEqual(len(files[3] - files[-1]), 1)
+            expected = self.fetch(0, 10 * DAY, cache=False)
+            self.api.calls.clear()
+            self.assertEqual(self.fetch(0, 10 * DAY), expected)
+            self.assertEqual(self.api.calls, [])
+
+    def test_segment_merged_by_another_process(self):
+        # Another process sharing the cache merges the first segment loaded into one of its own
+        # after it is looked up, first while gaps are fetched, and then when one segment covers
+        # the window.
+        self.fetch(2 * DAY, 3 * DAY)
+        self.fetch(5 * DAY, 6 * DAY)
+        load, merged = cortex.feature_types._cache_load, []
+        def load_after_merge(cache_dir, file, *args, **kwargs):
+            if not merged:
+                merged.append(file)
+                with mock.patch.object(cortex.feature_types, '_cache_load', load):
+                    self.fetch(*other)
+            return load(cache_dir, file, *args, **kwargs)
+        for window, other in [((DAY, 8 * DAY), (DAY, 7 * DAY)), ((2 * DAY, 3 * DAY), (0, 9 * DAY))]:
+            with self.subTest(window=window), mock.patch.object(cortex.feature_types, '_cache_load', load_after_merge):
+                merged.clear()
+                self.assertEqual(self.fetch(*window), self.fetch(*window, cache=False))
+                self.assertNotIn(merged[0], os.listdir(self.cache_dir))
+        self.assertEqual(self.fetch(0, 9 * DAY), self.fetch(0, 9 * DAY, cache=False))
+        self.assertEqual(self.segments(), [('gps', 0, 9 * DAY)])
+
+    def test_processes_sharing_cache(self):
+        # Processes loading overlapping windows at once merge, replace and remove each other's
+        # segments; each still gets the same data as without the cache.
+        windows = [(day * DAY // 2, day * DAY // 2 + 2 * DAY) for day in range(16)]
+        expected = [self.fetch(start, end, cache=False) for start, end in windows]
+        for hour in range(0, 240, 7):
+            self.fetch(hour * DAY // 24, (hour + 2) * DAY // 24)
+        with ProcessPoolExecutor(max_workers=8) as pool:
+            for _ in range(2):
+                actual = list(pool.map(load_gps, [self.cache_dir] * len(windows), *zip(*windows)))
+                self.assertEqual(actual, expected)
+
+    def test_removed_file_fetched_again(self):
+        self.fetch(DAY, 2 * DAY)
+        for f in os.listdir(self.cache_dir):
+            if f.startswith('gps_'):
+                os.remove(os.path.join(self.cache_dir, f))
+        self.api.calls.clear()
+        self.assertEqual(self.fetch(DAY, 2 * DAY), self.fetch(DAY, 2 * DAY, cache=False))
+        self.assertEqual(self.api.calls[0]['_from'], DAY)
+        self.assertEqual(self.segments(), [('gps', DAY, 2 * DAY)])
+
+    def test_rebuild_index(self):
+        self.fetch(DAY, 2 * DAY)
+        self.fetch(5 * DAY, 6 * DAY)
+        os.remove(os.path.join(self.cache_dir, 'index.cortex.db'))
+        rebuild_cache_index(self.cache_dir)
+        self.assertEqual(self.segments(), [('gps', DAY, 2 * DAY), ('gps', 5 * DAY, 6 * DAY)])
+
+    @unittest.skipUnless(pyarrow, "requires pyarrow")
+    def test_parquet_round_trip(self):
+        with mock.patch.dict(os.environ, {'CORTEX_CACHE_FORMAT': 'parquet'}):
+            expected = self.fetch(DAY, 4 * DAY, cache=False)
+            self.assertEqual(self.fetch(DAY, 4 * DAY), expected)
+            self.assertTrue(any(f.endswith('.parquet') for f in os.listdir(self.cache_dir)))
+            self.api.calls.clear()
+            self.assertEqual(self.fetch(DAY, 4 * DAY), expected)
+            frame = self.fetch(2 * DAY, 3 * DAY, as_frame=True)
+            self.assertEqual(self.api.calls, [])
+        self.assertEqual(frame.to_dict('records'), self.fetch(2 * DAY, 3 * DAY, cache=False))
+        self.assertEqual(frame['timestamp'].dtype, 'int64')
+
+    @unittest.skipUnless(pyarrow, "requires pyarrow")
+    def test_parquet_precision(self):
+        # Cached accelerometer readings keep their values; only frames narrow them to float32.
+        self.serve(sensor_events('lamp.accelerometer', [DAY + 1, DAY + 2, DAY + 3], x=[0.1, -9.81, 1e-8],
+                                 y=[0.2, 0.0, 3.3], z=[0.3, 1.0, -0.7]))
+        expected = accelerometer(id='U1', start=DAY, end=2 * DAY, cache=False)['data']
+        with mock.patch.dict(os.environ, {'CORTEX_CACHE_FORMAT': 'parquet'}):
+            accelerometer(id='U1', start=DAY, end=2 * DAY, cache_dir=self.cache_dir)
+            self.assertTrue(any(f.startswith('accelerometer_') and f.endswith('.parquet')
+                                for f in os.listdir(self.cache_dir)))
+            actual = accelerometer(id='U1', start=DAY, end=2 * DAY, cache_dir=self.cache_dir)['data']
+            frame = accelerometer(id='U1', start=DAY, end=2 * DAY, cache_dir=self.cache_dir, as_frame=True)['data']
+        self.assertEqual(actual, expected)
+        self.assertEqual(actual[-1]['x'], 0.1)
+        self.assertEqual(list(frame.dtypes), ['int64'] + ['float32'] * 3)
+        pd.testing.assert_frame_equal(frame, accelerometer(id='U1', start=DAY, end=2 * DAY, cache=False,
+                                                           as_frame=True)['data'])
+
+    def test_as_frame(self):
+        records = self.fetch(DAY, 3 * DAY)
+        frame = self.fetch(DAY, 3 * DAY, as_frame=True)
+        self.assertIsInstance(frame, pd.DataFrame)
+        self.assertEqual(frame.to_dict('records'), records)
+        self.assertEqual(list(frame.dtypes), ['int64'] + ['float64'] * 4)
+        empty = self.fetch(20 * DAY, 21 * DAY, as_frame=True)
+        self.assertEqual((len(empty), list(empty.columns)), (0, list(frame.columns)))
+
+
+class TestStream(FakeLAMPTestCase):
+
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(1)
+        # Readings on days 10 to 20, with 30 sharing one timestamp, and none on days 13 to 15.
+        timestamp = np.sort(np.r_[rng.integers(10 * DAY, 20 * DAY, 20000), [12 * DAY] * 30])
+        timestamp = timestamp[(timestamp < 13 * DAY) | (timestamp >= 15 * DAY)]
+        self.api = self.serve(sensor_events('lamp.accelerometer', timestamp, x=rng.random(len(timestamp)).tolist(),
+                                            y=[0.0] * len(timestamp), z=list(range(len(timestamp)))))
+
+    def stream(self, start, end, **kwargs):
+        chunks = list(accelerometer(id='U1', start=start, end=end, cache_dir=self.cache_dir, stream=True,
+                                    limit=1000, chunk_size=3000, **kwargs)['data'])
+        self.assertTrue(all(len(c) == 3000 for c in chunks[:-1]))
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+
+    def expected(self, start, end):
+        return accelerometer(id='U1', start=start, end=end, cache=False, as_frame=True)['data'].iloc[::-1].reset_index(drop=True)
+
+    def test_stream_same_as_full_fetch(self):
+        for kwargs in [{}, {'cache': False}]:
+            with self.subTest(**kwargs):
+                actual = self.stream(11 * DAY, 18 * DAY, **kwargs)
+                pd.testing.assert_frame_equal(actual.sort_values(['timestamp', 'z'], ignore_index=True),
+                                              self.expected(11 * DAY, 18 * DAY).sort_values(['timestamp', 'z'], ignore_index=True))
+                self.assertTrue(actual['timestamp'].is_monotonic_increasing)
+
+    def test_stream_from_cache(self):
+        expected = self.stream(11 * DAY, 18 * DAY)
+        self.api.calls.clear()
+        pd.testing.assert_frame_equal(self.stream(11 * DAY, 18 * DAY), expected)
+        self.assertEqual(self.api.calls, [])
+
+    def test_stream_gaps_only(self):
+        self.stream(12 * DAY, 16 * DAY)
+        self.api.calls.clear()
+        actual = self.stream(0, 19 * DAY)
+        self.assertTrue(all(c['to'] < 12 * DAY or c['_from'] > 16 * DAY for c in self.api.calls))
+        pd.testing.assert_frame_equal(actual.sort_values(['timestamp', 'z'], ignore_index=True),
+                                      self.expected(0, 19 * DAY).sort_values(['timestamp', 'z'], ignore_index=True))
+
+    def test_stream_segments_capped(self):
+        with mock.patch('cortex.feature_types.STREAM_SEGMENT_SIZE', 3000):
+            expected = self.stream(0, 19 * DAY)
+            index = _cache_index(self.cache_dir)
+            counts = [count for (count,) in index.execute("SELECT count FROM cache ORDER BY start")]
+            index.close()
+            self.assertLessEqual(max(counts), 3000)
+            self.assertEqual(sum(counts), len(expected))
+            self.api.calls.clear()
+            pd.testing.assert_frame_equal(self.stream(0, 19 * DAY), expected)
+            self.assertEqual(self.api.calls, [])
+
+    def test_stream_nothing_cached_without_events(self):
+        # An empty year takes a single request, and isn't cached.
+        self.assertEqual(len(self.stream(100 * DAY, 465 * DAY)), 0)
+        self.assertEqual(len(self.api.calls), 1)
+        self.assertEqual([f for f in os.listdir(self.cache_dir) if f.startswith('accelerometer_')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
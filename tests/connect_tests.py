@@ -0,0 +1,69 @@
+import unittest
+import threading
+import time
+import sys, os
+from unittest import mock
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import LAMP
+from cortex.feature_types import _connect, _connection
+
+
+class TestConnect(unittest.TestCase):
+
+    def setUp(self):
+        for patcher in [mock.patch.dict(os.environ, {'LAMP_ACCESS_KEY': 'a', 'LAMP_SECRET_KEY': 'b'}),
+                        mock.patch.dict(_connection, {'key': None})]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        os.environ.pop('LAMP_SERVER_ADDRESS', None)
+        patcher = mock.patch.object(LAMP, 'connect')
+        self.connect = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_connects_once(self):
+        for _ in range(100):
+            _connect()
+        self.connect.assert_called_once_with('a', 'b', 'api.lamp.digital')
+
+    def test_reconnects_when_credentials_change(self):
+        _connect()
+        with mock.patch.dict(os.environ, {'LAMP_SECRET_KEY': 'c'}):
+            _connect()
+            _connect()
+        with mock.patch.dict(os.environ, {'LAMP_SERVER_ADDRESS': 'localhost'}):
+            _connect()
+        self.assertEqual(self.connect.call_args_list, [mock.call('a', 'b', 'api.lamp.digital'),
+                                                       mock.call('a', 'c', 'api.lamp.digital'),
+                                                       mock.call('a', 'b', 'localhost')])
+
+    def test_reconnects_after_fork(self):
+        # A forked worker has a new process id, and mustn't share the parent's connection.
+        _connect()
+        with mock.patch.object(os, 'getpid', return_value=os.getpid() + 1):
+            _connect()
+            _connect()
+        self.assertEqual(self.connect.call_count, 2)
+
+    def test_threads_share_one_connection(self):
+        self.connect.side_effect = lambda *args: time.sleep(.05)
+        barrier = threading.Barrier(16)
+        def work():
+            barrier.wait()
+            _connect()
+        threads = [threading.Thread(target=work) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.connect.assert_called_once()
+
+    def test_missing_credentials(self):
+        with mock.patch.dict(os.environ):
+            del os.environ['LAMP_SECRET_KEY']
+            with self.assertRaisesRegex(Exception, 'LAMP_SECRET_KEY'):
+                _connect()
+        self.connect.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import json
+import tempfile
+import shutil
+import unittest
+from unittest import mock
+import LAMP
+
+
+class FakeSensorEvent():
+    """
+    Serves SensorEvents from memory as the LAMP API does: newest first, or oldest first for a
+    negative `_limit`, and records the parameters of each request in `calls`. The exceptions in
+    `failures` are raised by the next requests, one each.
+    """
+    def __init__(self, events, failures=()):
+        self.events = sorted(events, key=lambda e: e['timestamp'], reverse=True)
+        self.failures = list(failures)
+        self.calls = []
+
+    def all_by_participant(self, id, origin=None, _from=0, to=None, _limit=1000):
+        self.calls.append({'origin': origin, '_from': _from, 'to': to, '_limit': _limit})
+        if self.failures:
+            raise self.failures.pop(0)
+        data = [{'timestamp': e['timestamp'], 'data': e['data']} for e in self.events
+                if e['origin'] == origin and _from <= e['timestamp'] <= to]
+        return {'data': data[::-1][:-_limit] if _limit < 0 else data[:_limit]}
+
+
+class FakeType():
+    """
+    Keeps attachments in memory as the LAMP API does, serialized as JSON, and records each request
+    in `calls` as ('get' or 'set', id, key). Missing attachments raise a 404 `LAMP.ApiException`.
+    """
+    def __init__(self, attachments=None):
+        self.attachments = {k: json.dumps(v) for k, v in (attachments or {}).items()}
+        self.calls = []
+
+    def get_attachment(self, id, attachment_key):
+        self.calls.append(('get', id, attachment_key))
+        if (id, attachment_key) not in self.attachments:
+            raise LAMP.ApiException(status=404, reason='Not Found')
+        return {'data': json.loads(self.attachments[(id, attachment_key)])}
+
+    def set_attachment(self, id, target, attachment_key=None, body=None):
+        self.calls.append(('set', id, attachment_key))
+        self.attachments[(id, attachment_key)] = json.dumps(body)
+        return {}
+
+
+def sensor_events(origin, timestamps, **data):
+    """
+    SensorEvents from `origin` at the given timestamps, with the i-th value of each keyword
+    argument in the data of the i-th event.
+    """
+    return [{'timestamp': int(t), 'origin': origin, 'data': {k: v[i] for k, v in data.items()}}
+            for i, t in enumerate(timestamps)]
+
+
+class FakeLAMPTestCase(unittest.TestCase):
+    """
+    A test case with the LAMP API replaced by `FakeSensorEvent`s and an empty caching directory
+    (also set as CORTEX_CACHE_DIR).
+    """
+    def setUp(self):
+        os.environ.setdefault('LAMP_ACCESS_KEY', 'test')
+        os.environ.setdefault('LAMP_SECRET_KEY', 'test')
+        patcher = mock.patch.object(LAMP, 'connect')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        # Features that don't pass a caching directory on use this one too.
+        patcher = mock.patch.dict(os.environ, {'CORTEX_CACHE_DIR': self.cache_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def serve(self, events, failures=()):
+        """
+        Serve these events from `LAMP.SensorEvent` for the rest of the test.
+        """
+        api = FakeSensorEvent(events, failures)
+        patcher = mock.patch.object(LAMP, 'SensorEvent', api, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return api
+
+    def store(self, attachments=None):
+        """
+        Keep attachments in memory in `LAMP.Type` for the rest of the test, starting from
+        `attachments` ({(id, key): body}).
+        """
+        api = FakeType(attachments)
+        patcher = mock.patch.object(LAMP, 'Type', api, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return api
@@ -0,0 +1,118 @@
+import unittest
+import sys, os
+from unittest import mock
+import numpy as np
+import urllib3
+import LAMP
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from tests.fake_lamp import FakeLAMPTestCase, sensor_events
+from cortex.raw import fetch
+from cortex.raw.fetch import fetch_events, fetch_metrics
+
+
+class TestFetchEvents(FakeLAMPTestCase):
+
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        # Readings over ~3 hours, with runs of repeated timestamps shorter than a page.
+        timestamp = np.r_[rng.integers(10**6, 10**7, 20000), [5 * 10**6] * 40, [10**6] * 20]
+        self.events = sensor_events('lamp.accelerometer', timestamp, x=list(range(len(timestamp))))
+        sleep = mock.patch.object(fetch.time, 'sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def expected(self, start, end):
+        """
+        The events in [start, end] as a single request for all of them returns them.
+        """
+        api = self.serve(self.events)
+        return api.all_by_participant('U1', origin='lamp.accelerometer', _from=start, to=end,
+                                      _limit=len(self.events))['data']
+
+    def fetch(self, start=0, end=10**8, **kwargs):
+        return fetch_events("SensorEvent", 'U1', start, end, origin='lamp.accelerometer', **kwargs)
+
+    def assertSameEvents(self, actual, expected):
+        self.assertEqual([e['timestamp'] for e in actual], [e['timestamp'] for e in expected])
+        self.assertEqual(sorted(e['data']['x'] for e in actual), sorted(e['data']['x'] for e in expected))
+
+    def test_pages_same_as_one_request(self):
+        expected = self.expected(0, 10**8)
+        for limit in [100, 1000, 7777, 50000]:
+            for workers in [1, 4]:
+                api = self.serve(self.events)
+                with self.subTest(limit=limit, workers=workers):
+                    self.assertSameEvents(self.fetch(limit=limit, workers=workers), expected)
+                    self.assertTrue(all(abs(c['_limit']) <= limit for c in api.calls))
+
+    def test_window(self):
+        expected = self.expected(2 * 10**6, 5 * 10**6)
+        self.serve(self.events)
+        self.assertSameEvents(self.fetch(2 * 10**6, 5 * 10**6, limit=500), expected)
+
+    def test_shards(self):
+        # After the first page, the rest is split into shards, from the oldest event on.
+        api = self.serve(self.events)
+        self.fetch(limit=1000, workers=2)
+        self.assertEqual(api.calls[1]['_limit'], -1)
+        shard_starts = {c['_from'] for c in api.calls[2:]}
+        self.assertEqual(min(shard_starts), 10**6)
+        self.assertLessEqual(len(shard_starts), 2 * fetch.SHARDS_PER_WORKER)
+        self.assertGreater(len(shard_starts), 1)
+
+    def test_one_page(self):
+        api = self.serve(self.events)
+        self.assertSameEvents(self.fetch(limit=300, recursive=False), self.expected(0, 10**8)[:300])
+        self.assertEqual(len(api.calls), 1)
+
+    def test_empty(self):
+        api = self.serve([])
+        self.assertEqual(self.fetch(limit=100), [])
+        self.assertEqual(len(api.calls), 1)
+
+    def test_retries(self):
+        expected = self.expected(0, 10**8)
+        for failures in [[LAMP.ApiException(status=503), urllib3.exceptions.ProtocolError('reset'),
+                          OSError('timeout')],
+                         [LAMP.ApiException(status=429)]]:
+            self.sleep.reset_mock()
+            api = self.serve(self.events, failures)
+            with self.subTest(failures=failures):
+                self.assertSameEvents(self.fetch(limit=1000, workers=1), expected)
+                self.assertEqual([c.args[0] for c in self.sleep.call_args_list], [1, 2, 4][:len(failures)])
+                self.assertEqual(api.failures, [])
+
+    def test_retries_give_up(self):
+        self.serve(self.events, [LAMP.ApiException(status=503)] * (fetch.FETCH_RETRIES + 1))
+        with self.assertRaises(LAMP.ApiException):
+            self.fetch(limit=1000)
+        self.assertEqual(self.sleep.call_count, fetch.FETCH_RETRIES)
+
+    def test_client_errors_not_retried(self):
+        api = self.serve(self.events, [LAMP.ApiException(status=404)])
+        with self.assertRaises(LAMP.ApiException):
+            self.fetch(limit=1000)
+        self.assertEqual((len(api.calls), self.sleep.call_count), (1, 0))
+
+    def test_slow_requests_halve_the_page_size(self):
+        api = self.serve(self.events)
+        with mock.patch.object(fetch.time, 'time', side_effect=[0, fetch.FETCH_SLOW + 1] * 1000):
+            self.assertSameEvents(self.fetch(limit=4000, workers=1), self.expected(0, 10**8))
+        limits = [c['_limit'] for c in api.calls if c['_limit'] > 1]
+        self.assertEqual(limits[:3], [4000, 4000, 2000])
+        self.assertEqual(min(limits), fetch.FETCH_MIN_LIMIT)
+
+    def test_metrics(self):
+        api = self.serve(self.events, [LAMP.ApiException(status=503)])
+        fetch._metrics.clear()
+        self.fetch(limit=1000)
+        metrics, = fetch_metrics()
+        self.assertEqual((metrics['api'], metrics['origin']), ('SensorEvent', 'lamp.accelerometer'))
+        self.assertEqual((metrics['requests'], metrics['retries']), (len(api.calls) - 1, 1))
+        # Events repeated at the boundaries between pages are fetched twice.
+        self.assertGreaterEqual(metrics['events'], len(self.events))
+
+
+if __name__ == '__main__':
+    unittest.main()
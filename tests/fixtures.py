@@ -0,0 +1,35 @@
+import datetime
+import numpy as np
+from cortex.primary.accelerometer_bins import AccelerometerProfile, BIN_SIZE, MS_PER_DAY
+
+
+def accelerometer_bins(seed, days=14, gaps=0.2):
+    """
+    Random 10 minute accelerometer bins over `days` days from 2021-04-01, quieter at night
+    (23:00 to 07:00), with a fraction `gaps` of the bins missing, as `accelerometer_bins` returns.
+    """
+    rng = np.random.default_rng(seed)
+    timestamp = np.arange(1617235200000, 1617235200000 + days * MS_PER_DAY, BIN_SIZE)
+    timestamp = timestamp[rng.random(len(timestamp)) >= gaps]
+    hour = (timestamp % MS_PER_DAY) / 3600000
+    quiet = (hour >= 23) | (hour < 7)
+    magnitude = 9.8 + np.where(quiet, 0.1, 1.0) * rng.random(len(timestamp))
+    count = rng.integers(1, 50, len(timestamp))
+    return {'timestamp': timestamp, 'magnitude': magnitude, 'count': count,
+            'sumsq': magnitude ** 2 * count}
+
+
+def accelerometer_profile(bins):
+    """
+    The profile of these bins, as if they were all the participant's readings.
+    """
+    profile = AccelerometerProfile()
+    profile.add(bins)
+    return profile
+
+
+def wake_time(bed_time, hours=8):
+    """
+    The time of day `hours` after `bed_time`.
+    """
+    return (datetime.datetime.combine(datetime.date.today(), bed_time) + datetime.timedelta(hours=hours)).time()
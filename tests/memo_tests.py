@@ -0,0 +1,142 @@
+import unittest
+import sys, os
+from unittest import mock
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from tests.fake_lamp import FakeLAMPTestCase, sensor_events
+from cortex.raw.gps import gps
+from cortex.primary.trips import trips, TripSegmenter
+from cortex.feature_types import secondary_feature, memoize, _memo_slice, _memo_timestamps
+
+HOUR = 3600000
+
+
+def gps_count(**kwargs):
+    """
+    The number of GPS fixes in a window, loaded as a feature function would.
+    """
+    return {'timestamp': kwargs['start'],
+            'gps_count': len(gps(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'],
+                                 cache=kwargs.get('cache'))['data'])}
+
+
+def gps_spread(**kwargs):
+    """
+    The range of GPS latitudes in a window, loaded as a DataFrame.
+    """
+    df = gps(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'], as_frame=True)['data']
+    return {'timestamp': kwargs['start'], 'gps_spread': float(df['latitude'].max() - df['latitude'].min())}
+
+
+def trip_count(**kwargs):
+    """
+    The number of trips starting in a window.
+    """
+    _trips = trips(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'])['data']
+    return {'timestamp': kwargs['start'],
+            'trip_count': len([t for t in _trips if t['start'] < kwargs['end']])}
+
+
+batched_gps_count = secondary_feature('test.batched_gps_count', [gps])(gps_count)
+unbatched_gps_count = secondary_feature('test.unbatched_gps_count', [gps], batched=False)(gps_count)
+batched_gps_spread = secondary_feature('test.batched_gps_spread', [gps])(gps_spread)
+unbatched_gps_spread = secondary_feature('test.unbatched_gps_spread', [gps], batched=False)(gps_spread)
+batched_trip_count = secondary_feature('test.batched_trip_count', [trips])(trip_count)
+unbatched_trip_count = secondary_feature('test.unbatched_trip_count', [trips], batched=False)(trip_count)
+
+
+class TestMemo(FakeLAMPTestCase):
+
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        timestamp = np.r_[rng.integers(0, 48 * HOUR, 3000), [5 * HOUR] * 10]
+        self.api = self.serve(sensor_events('lamp.gps', timestamp, latitude=rng.random(len(timestamp)).tolist(),
+                                            longitude=rng.random(len(timestamp)).tolist()))
+
+    def fetch(self, start, end, **kwargs):
+        return gps(id='U1', start=start, end=end, cache=False, **kwargs)['data']
+
+    def test_windows_sliced_from_memo(self):
+        windows = [(0, HOUR), (5 * HOUR, 5 * HOUR), (5 * HOUR + 1, 6 * HOUR), (47 * HOUR, 48 * HOUR)]
+        expected = [self.fetch(start, end) for start, end in windows]
+        expected_frames = [self.fetch(start, end, as_frame=True) for start, end in windows]
+        self.api.calls.clear()
+        with memoize():
+            self.fetch(0, 48 * HOUR)
+            self.fetch(0, 48 * HOUR, as_frame=True)
+            calls = len(self.api.calls)
+            actual = [self.fetch(start, end) for start, end in windows]
+            actual_frames = [self.fetch(start, end, as_frame=True) for start, end in windows]
+            self.assertEqual(len(self.api.calls), calls)
+        self.assertEqual(actual, expected)
+        for a, e in zip(actual_frames, expected_frames):
+            pd.testing.assert_frame_equal(a, e)
+
+    def test_memo_scope(self):
+        with memoize():
+            self.fetch(0, 10 * HOUR)
+            with memoize():
+                calls = len(self.api.calls)
+                self.fetch(HOUR, 2 * HOUR)
+                self.assertEqual(len(self.api.calls), calls)
+            # A window outside the memoized one is fetched.
+            self.fetch(9 * HOUR, 11 * HOUR)
+            self.assertGreater(len(self.api.calls), calls)
+        calls = len(self.api.calls)
+        self.fetch(HOUR, 2 * HOUR)
+        self.assertGreater(len(self.api.calls), calls)
+
+    def test_memoized_copies(self):
+        with memoize():
+            self.fetch(0, 10 * HOUR).clear()
+            self.assertGreater(len(self.fetch(0, 10 * HOUR)), 0)
+
+    def test_slice_unordered(self):
+        # Data not ordered newest first is filtered instead.
+        data = [{'timestamp': t} for t in [5, 1, 9, 3, 7]]
+        self.assertIsNone(_memo_timestamps(data))
+        self.assertEqual(_memo_slice(data, None, 3, 7), [{'timestamp': t} for t in [5, 3, 7]])
+        ordered = sorted(data, key=lambda r: -r['timestamp'])
+        self.assertEqual(_memo_slice(ordered, _memo_timestamps(ordered), 3, 7),
+                         [{'timestamp': t} for t in [7, 5, 3]])
+
+    def test_batched_same_as_unbatched(self):
+        expected = unbatched_gps_count(id='U1', start=0, end=48 * HOUR, resolution=HOUR, cache=False)['data']
+        unbatched_calls = len(self.api.calls)
+        self.api.calls.clear()
+        actual = batched_gps_count(id='U1', start=0, end=48 * HOUR, resolution=HOUR, cache=False)['data']
+        self.assertEqual(actual, expected)
+        # The GPS data is fetched once for all windows, instead of once per window.
+        self.assertLess(len(self.api.calls), unbatched_calls // 10)
+
+    def test_batched_frames(self):
+        # Windows loaded as DataFrames are served from the data loaded for all windows.
+        expected = unbatched_gps_spread(id='U1', start=0, end=48 * HOUR, resolution=HOUR)['data']
+        unbatched_calls = len(self.api.calls)
+        self.api.calls.clear()
+        actual = batched_gps_spread(id='U1', start=0, end=48 * HOUR, resolution=HOUR)['data']
+        self.assertEqual(actual, expected)
+        self.assertLess(len(self.api.calls), unbatched_calls // 10)
+
+    def test_batched_attached_primary(self):
+        # Trips are computed and saved once for all windows, instead of loaded for each window.
+        timestamp = np.arange(0, 48 * HOUR, 60000)
+        moving = (timestamp // HOUR) % 3 == 0
+        self.serve(sensor_events('lamp.gps', timestamp, latitude=(42 + np.cumsum(moving * .01)).tolist(),
+                                 longitude=[-71.0] * len(timestamp)))
+        self.store()
+        expected = unbatched_trip_count(id='U1', start=0, end=48 * HOUR, resolution=HOUR)['data']
+        self.assertGreater(sum(r['trip_count'] for r in expected), 0)
+        store = self.store()
+        with mock.patch('cortex.primary.trips.TripSegmenter.add', autospec=True,
+                        side_effect=TripSegmenter.add) as add:
+            actual = batched_trip_count(id='U1', start=0, end=48 * HOUR, resolution=HOUR)['data']
+        self.assertEqual(actual, expected)
+        add.assert_called_once()
+        self.assertEqual(len([c for c in store.calls if c[0] == 'set']), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
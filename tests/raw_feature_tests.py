@@ -0,0 +1,55 @@
+import unittest
+import sys, os
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from tests.fake_lamp import FakeLAMPTestCase, sensor_events
+from cortex.raw.accelerometer import accelerometer
+from cortex.raw.bluetooth import bluetooth
+from cortex.raw.calls import calls
+from cortex.raw.gps import gps
+from cortex.raw.screen_state import screen_state
+from cortex.raw.sms import sms
+from cortex.raw.steps import steps
+from cortex.raw.wifi import wifi
+
+SENSORS = {'lamp.accelerometer': accelerometer, 'lamp.bluetooth': bluetooth, 'lamp.calls': calls,
+           'lamp.gps': gps, 'lamp.screen_state': screen_state, 'lamp.sms': sms, 'lamp.steps': steps,
+           'lamp.wifi': wifi}
+
+
+class TestRawFeatures(FakeLAMPTestCase):
+
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        self.events = []
+        for i, origin in enumerate(SENSORS):
+            timestamp = rng.integers(0, 10**7, 500 + 100 * i)
+            self.events += sensor_events(origin, timestamp, value=rng.random(len(timestamp)).tolist())
+        self.api = self.serve(self.events)
+
+    def test_same_as_one_request(self):
+        # Every sensor is paged through the shared fetcher, for its own origin only.
+        for origin, feature in SENSORS.items():
+            expected = self.api.all_by_participant('U1', origin=origin, _from=10**6, to=9 * 10**6,
+                                                   _limit=len(self.events))['data']
+            self.api.calls.clear()
+            actual = feature(id='U1', start=10**6, end=9 * 10**6, limit=60, cache=False)['data']
+            with self.subTest(origin=origin):
+                self.assertEqual(sorted((r['timestamp'], r['value']) for r in actual),
+                                 sorted((e['timestamp'], e['data']['value']) for e in expected))
+                self.assertEqual([r['timestamp'] for r in actual], [e['timestamp'] for e in expected])
+                self.assertEqual({c['origin'] for c in self.api.calls}, {origin})
+                self.assertGreater(len(self.api.calls), len(expected) // 60)
+
+    def test_one_page(self):
+        for origin, feature in SENSORS.items():
+            self.api.calls.clear()
+            actual = feature(id='U1', start=0, end=10**7, limit=60, recursive=False, cache=False)['data']
+            with self.subTest(origin=origin):
+                self.assertEqual(len(actual), 60)
+                self.assertEqual(len(self.api.calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
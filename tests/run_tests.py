@@ -0,0 +1,124 @@
+import unittest
+import sys, os
+from unittest import mock
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from tests.fake_lamp import FakeLAMPTestCase, sensor_events
+from cortex.raw.gps import gps
+from cortex.feature_types import secondary_feature, all_features
+from cortex.run import run, _schedule, _InProcessExecutor
+
+# `cortex.run` is also the name of the function the package exports.
+run_module = sys.modules['cortex.run']
+
+HOUR = 3600000
+
+
+@secondary_feature('test.gps_fixes', [gps], batched=False)
+def gps_fixes(**kwargs):
+    """
+    The number of GPS fixes in a window, loaded one window at a time.
+    """
+    return {'timestamp': kwargs['start'],
+            'gps_fixes': len(gps(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'])['data'])}
+
+
+@secondary_feature('test.gps_hours', [gps_fixes])
+def gps_hours(**kwargs):
+    """
+    Whether a window has any GPS fixes, from `gps_fixes`.
+    """
+    # The window's own (single-window) result, which ends one window past it.
+    fixes = gps_fixes(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'] + kwargs['resolution'],
+                      resolution=kwargs['resolution'])
+    return {'timestamp': kwargs['start'], 'gps_hours': int(fixes['data'][0]['gps_fixes'] > 0)}
+
+
+@secondary_feature('test.gps_count', [gps])
+def gps_count(**kwargs):
+    """
+    The number of GPS fixes in a window, from the GPS data loaded once for all windows.
+    """
+    return {'timestamp': kwargs['start'],
+            'gps_count': len(gps(id=kwargs['id'], start=kwargs['start'], end=kwargs['end'])['data'])}
+
+
+class TestSchedule(unittest.TestCase):
+
+    def test_dependencies_first(self):
+        registry = {f['callable'].__name__: f for f in all_features()}
+        names = list(reversed(list(registry)))
+        order = _schedule(names)
+        self.assertEqual(sorted(order), sorted(names))
+        for n in order:
+            for dep in registry[n]['dependencies']:
+                if callable(dep) and dep.__name__ in registry and registry[dep.__name__]['callable'] is dep:
+                    self.assertLess(order.index(dep.__name__), order.index(n), f"{dep.__name__} before {n}")
+
+    def test_requested_only(self):
+        self.assertEqual(_schedule(['gps_hours', 'gps']), ['gps', 'gps_hours'])
+        self.assertEqual(_schedule(['gps_hours']), ['gps_hours'])
+
+    def test_cycle(self):
+        a, b = lambda: None, lambda: None
+        a.__name__, b.__name__ = 'a', 'b'
+        features = [{'name': 'a', 'type': 'primary', 'dependencies': [b], 'callable': a},
+                    {'name': 'b', 'type': 'primary', 'dependencies': [a], 'callable': b}]
+        with mock.patch.object(run_module, 'all_features', return_value=features):
+            with self.assertRaisesRegex(Exception, 'depending on each other'):
+                _schedule(['a'])
+
+
+class TestWorkers(FakeLAMPTestCase):
+
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        timestamp = rng.integers(0, 24 * HOUR, 300)
+        self.serve(sensor_events('lamp.gps', timestamp, latitude=rng.random(300).tolist(),
+                                 longitude=rng.random(300).tolist()))
+
+    def test_secondary_windows_in_pool(self):
+        expected = gps_fixes(id='U1', start=0, end=24 * HOUR, resolution=HOUR)['data']
+        for workers in [1, 2, 5, 40]:
+            with self.subTest(workers=workers):
+                self.assertEqual(gps_fixes(id='U1', start=0, end=24 * HOUR, resolution=HOUR, workers=workers)['data'],
+                                 expected)
+
+    def test_batched_windows_in_pool_on_warm_cache(self):
+        # Workers share the cache, which holds scattered segments of the data they all load.
+        for hour in range(0, 24, 3):
+            gps(id='U1', start=hour * HOUR, end=hour * HOUR + HOUR)
+        expected = gps_count(id='U1', start=0, end=24 * HOUR, resolution=HOUR, cache=False)['data']
+        for workers in [8, 23]:
+            with self.subTest(workers=workers):
+                self.assertEqual(gps_count(id='U1', start=0, end=24 * HOUR, resolution=HOUR, workers=workers)['data'],
+                                 expected)
+
+    def test_run_in_pool(self):
+        with mock.patch.object(run_module, 'generate_ids', return_value=['U1', 'U2', 'U3']):
+            expected = run(['U1', 'U2', 'U3'], ['gps_hours', 'gps_fixes'], start=0, end=24 * HOUR,
+                           resolution=HOUR, workers=1)
+            actual = run(['U1', 'U2', 'U3'], ['gps_hours', 'gps_fixes'], start=0, end=24 * HOUR,
+                         resolution=HOUR, workers=3)
+        self.assertEqual(list(actual), ['gps_hours', 'gps_fixes'])
+        for f in actual:
+            with self.subTest(feature=f):
+                self.assertEqual(len(expected[f]), 3 * 23)
+                pd.testing.assert_frame_equal(actual[f], expected[f])
+
+    def test_run_in_process(self):
+        # With one worker, jobs run in this process, where failures are reported by feature.
+        with mock.patch.object(run_module, 'generate_ids', return_value=['U1']), \
+             mock.patch.object(run_module, 'ProcessPoolExecutor') as pool, \
+             mock.patch.object(sys.modules[__name__], 'gps_fixes', side_effect=ValueError):
+            results = run('U1', ['gps_fixes', 'gps_hours'], start=0, end=24 * HOUR, resolution=HOUR)
+        pool.assert_not_called()
+        self.assertIsInstance(run_module._executor(1), _InProcessExecutor)
+        self.assertEqual(len(results['gps_fixes']), 23)
+        self.assertTrue(results['gps_hours'].empty)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+import json
+import sys, os
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from cortex.primary.screen_active import BoutSegmenter
+
+
+def legacy_screen_active(_screen_state):
+    """
+    The bout extraction as it was before it was vectorized, for events in ascending time order.
+    """
+    on_events = [1, 3]
+    off_events = [0, 2]
+    _screen_active = []
+    start = True
+    bout = {}
+    for i in range(len(_screen_state) - 1):
+        elapsed = _screen_state[i+1]['timestamp'] - _screen_state[i]['timestamp']
+        if elapsed < 1000 and _screen_state[i+1]['state'] in on_events and _screen_state[i]['state'] in on_events:
+            continue
+        elif start and _screen_state[i]['state'] in on_events:
+            bout['start'] = _screen_state[i]['timestamp']
+            start = False
+        elif not start and _screen_state[i]['state'] in off_events:
+            bout['end'] = _screen_state[i]['timestamp']
+            bout['duration'] = bout['end'] - bout['start']
+            _screen_active.append(bout)
+            bout = {}
+            start = True
+    if not start and _screen_state[-1]['state'] in off_events:
+        bout['end'] = _screen_state[-1]['timestamp']
+        bout['duration'] = bout['end'] - bout['start']
+        _screen_active.append(bout)
+    return _screen_active
+
+
+class TestBoutSegmenter(unittest.TestCase):
+
+    def make_events(self, seed, n=2000):
+        """
+        Screen events with repeated "on" and "off" events, unknown states, and some events less
+        than a second apart.
+        """
+        rng = np.random.default_rng(seed)
+        timestamp = 1617235200000 + np.cumsum(rng.choice([0, 200, 999, 1000, 60000], n))
+        state = rng.choice([0, 1, 2, 3, 4], n, p=[.3, .3, .15, .15, .1])
+        return timestamp.tolist(), state.tolist()
+
+    def bouts(self, starts, ends):
+        return [{'start': int(s), 'end': int(e), 'duration': int(e - s)} for s, e in zip(starts, ends)]
+
+    def test_bouts_same_as_legacy(self):
+        for seed in range(10):
+            timestamp, state = self.make_events(seed, n=[2000, 1, 2, 3][seed % 4])
+            expected = legacy_screen_active([{'timestamp': t, 'state': s} for t, s in zip(timestamp, state)])
+            with self.subTest(seed=seed):
+                self.assertEqual(self.bouts(*BoutSegmenter().add(timestamp, state)), expected)
+
+    def test_bouts_chunked(self):
+        # Bouts open at the end of a chunk, and "on" events repeated across chunks, carry over.
+        timestamp, state = self.make_events(10)
+        expected = self.bouts(*BoutSegmenter().add(timestamp, state))
+        for size in [1, 2, 5, 77]:
+            segmenter, actual = BoutSegmenter(), []
+            for i in range(0, len(timestamp), size):
+                actual += self.bouts(*segmenter.add(timestamp[i:i + size], state[i:i + size]))
+            with self.subTest(size=size):
+                self.assertEqual(actual, expected)
+
+    def test_bouts_resumed_from_attachment(self):
+        timestamp, state = self.make_events(11)
+        expected = self.bouts(*BoutSegmenter().add(timestamp, state))
+        body, actual = None, []
+        for i in range(0, len(timestamp), 300):
+            segmenter = BoutSegmenter.from_attachment(json.loads(body)) if body else BoutSegmenter()
+            actual += self.bouts(*segmenter.add(timestamp[i:i + 300], state[i:i + 300]))
+            body = json.dumps(segmenter.to_attachment())
+        self.assertEqual(actual, expected)
+
+    def test_bouts_open(self):
+        segmenter = BoutSegmenter()
+        self.assertEqual(self.bouts(*segmenter.add([0, 5000, 9000], [1, 2, 3])), [{'start': 0, 'end': 5000, 'duration': 5000}])
+        self.assertEqual(self.bouts(*segmenter.add([], [])), [])
+        self.assertEqual(self.bouts(*segmenter.add([9500, 20000], [1, 0])), [{'start': 9500, 'end': 20000, 'duration': 10500}])
+
+
+if __name__ == '__main__':
+    unittest.main()
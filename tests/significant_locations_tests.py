@@ -0,0 +1,320 @@
+import unittest
+import sys, os
+import math
+import numpy as np
+import pandas as pd
+from unittest import mock
+from sklearn.cluster import DBSCAN
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from tests.fake_lamp import FakeLAMPTestCase, sensor_events
+from cortex.primary.significant_locations import (significant_locations, location_model, reduce_locations,
+                                                  fit_locations, _points, _nearest, _window_locations)
+from cortex.secondary.hometime import hometime
+from cortex.secondary.entropy import entropy
+
+DAY = 86400000
+MODEL = 'cortex.significant_locations.reduced'
+
+
+def legacy_reduce_locations(df, reduced_data, eps=1e-5):
+    """
+    The DBSCAN reduction as it was before it was vectorized.
+    """
+    def euclid(g0, g1):
+        def _euclid(lat, lng, lat0, lng0):
+            return 110.25 * ((((lat - lat0) ** 2) + (((lng - lng0) * np.cos(lat0)) ** 2)) ** 0.5)
+        return _euclid(g0[0], g0[1], g1[0], g1[1])
+
+    reduced_data = {'end': 0, 'data': [dict(p) for p in reduced_data]}
+    new_reduced_data = reduced_data['data'].copy()
+    cut_df = np.split(df, [30000*i for i in range(math.ceil(len(df) / 30000))])
+    for d in cut_df:
+        if len(d) == 0: continue
+        d = d.reset_index(drop=True)
+        new_reduced_data = reduced_data['data'].copy()
+        props = DBSCAN(eps=eps).fit_predict(d[['latitude', 'longitude']].values)
+        db_points = []
+        for l in np.unique(props):
+            db_lats, db_longs = [d.iloc[i]['latitude'] for i in range(len(d)) if props[i] == l], [d.iloc[i]['longitude'] for i in range(len(d)) if props[i] == l]
+            if l == -1:
+                db_points += [{'latitude': db_lats[i], 'longitude': db_longs[i], 'count': 1} for i in range(len(db_lats))]
+            else:
+                lat_mean, long_mean = np.mean(db_lats), np.mean(db_longs)
+                if len(reduced_data['data']) == 0:
+                    db_points += [{'latitude': lat_mean, 'longitude': long_mean, 'count': len(db_lats)}]
+                else:
+                    min_dist_index = np.argmin([euclid((loc['latitude'], loc['longitude']), (lat_mean, long_mean)) for loc in reduced_data['data']])
+                    if euclid((reduced_data['data'][min_dist_index]['latitude'], reduced_data['data'][min_dist_index]['longitude']),
+                              (lat_mean, long_mean)) < 20:
+                        new_reduced_data[min_dist_index]['count'] += len(db_lats)
+                    else:
+                        db_points += [{'latitude': lat_mean, 'longitude': long_mean, 'count': len(db_lats)}]
+        new_reduced_data += db_points
+        reduced_data = {'end': 0, 'data': new_reduced_data}
+    return reduced_data['data']
+
+
+def legacy_window_locations(centroids, newdf):
+    """
+    The per-location summary of a window as it was before it was vectorized.
+    """
+    def euclid(g0, g1):
+        def _euclid(lat, lng, lat0, lng0):
+            return 110.25 * ((((lat - lat0) ** 2) + (((lng - lng0) * np.cos(lat0)) ** 2)) ** 0.5)
+        return _euclid(g0[0], g0[1], g1[0], g1[1])
+
+    def _location_duration(df, cluster):
+        df = df[::-1].reset_index()
+        arr_ext = np.r_[False, df['cluster'] == cluster, False]
+        idx = np.flatnonzero(arr_ext[:-1] != arr_ext[1:])
+        idx_list = list(zip(idx[:-1:2], idx[1::2] - int(True)))
+        return sum(df['timestamp'][t[1]] - df['timestamp'][t[0]] for t in idx_list if t[0] != t[1])
+
+    newdf = newdf.copy()
+    newdf_coords = newdf[['latitude', 'longitude']].values
+    props = _nearest(centroids, newdf_coords)
+    newdf.loc[:, 'cluster'] = props
+    return [{
+        'radius': np.mean(euclid(center, np.transpose(newdf_coords[np.argwhere(props == idx)].reshape((-1, 2)))) * 1000) if props[props == idx].size > 0 else None,
+        'proportion': props[props == idx].size / props.size,
+        'duration': _location_duration(newdf, idx)
+    } for idx, center in enumerate(centroids)]
+
+
+class TestReduceLocations(unittest.TestCase):
+    PLACES = np.array([[42.36, -71.06], [40.71, -74.01], [41.82, -71.41], [44.48, -73.21]])
+
+    def make_gps(self, seed, n, places):
+        """
+        Fixes around a few places far apart, with a few scattered fixes in between.
+        """
+        rng = np.random.default_rng(seed)
+        coords = places[rng.integers(0, len(places), n)] + rng.normal(scale=1e-6, size=(n, 2))
+        scattered = rng.random(n) < .002
+        coords[scattered] = rng.uniform([40, -75], [45, -70], size=(scattered.sum(), 2))
+        return pd.DataFrame({'latitude': coords[:, 0], 'longitude': coords[:, 1]})
+
+    def assertSamePoints(self, actual, expected):
+        lats, lngs, counts = actual
+        self.assertEqual(counts.tolist(), [p['count'] for p in expected])
+        np.testing.assert_allclose(lats, [p['latitude'] for p in expected])
+        np.testing.assert_allclose(lngs, [p['longitude'] for p in expected])
+
+    def test_reduce_same_as_legacy(self):
+        df = self.make_gps(0, 5000, self.PLACES[:2])
+        actual = reduce_locations(df['latitude'].to_numpy(), df['longitude'].to_numpy())
+        self.assertSamePoints(actual, legacy_reduce_locations(df, []))
+
+    def test_reduce_merges_into_saved_points(self):
+        saved = legacy_reduce_locations(self.make_gps(1, 2000, self.PLACES[:2]), [])
+        df = self.make_gps(2, 4000, self.PLACES)
+        actual = reduce_locations(df['latitude'].to_numpy(), df['longitude'].to_numpy(), _points(saved))
+        self.assertSamePoints(actual, legacy_reduce_locations(df, saved))
+
+    def test_reduce_in_chunks(self):
+        # Points reduced from earlier chunks are merged into, as before.
+        df = self.make_gps(3, 32000, self.PLACES[1:])
+        actual = reduce_locations(df['latitude'].to_numpy(), df['longitude'].to_numpy())
+        self.assertSamePoints(actual, legacy_reduce_locations(df, []))
+
+    def test_reduce_nothing(self):
+        saved = [{'latitude': 42.36, 'longitude': -71.06, 'count': 3}]
+        actual = reduce_locations(np.array([]), np.array([]), _points(saved))
+        self.assertSamePoints(actual, saved)
+
+
+class TestFitLocations(unittest.TestCase):
+    PLACES = np.array([[42.36, -71.06], [42.40, -71.20], [42.30, -71.00]])
+
+    def make_points(self, seed, n=300):
+        rng = np.random.default_rng(seed)
+        which = rng.choice(3, n, p=[.2, .5, .3])
+        coords = self.PLACES[which] + rng.normal(scale=1e-4, size=(n, 2))
+        return coords[:, 0], coords[:, 1], rng.integers(1, 20, n)
+
+    def test_fit_ranks_by_weight(self):
+        lat, lng, count = self.make_points(0)
+        centroids = fit_locations(lat, lng, count)
+        self.assertEqual(len(centroids), 3)
+        weight = np.bincount(_nearest(centroids, np.stack([lat, lng], axis=1)), weights=count)
+        self.assertTrue(np.all(np.diff(weight) <= 0))
+        np.testing.assert_allclose(centroids, self.PLACES[[1, 2, 0]], atol=1e-3)
+
+    def test_fit_same_as_expanded(self):
+        # Weighting reduced points by their counts clusters them as if they were repeated.
+        lat, lng, count = self.make_points(1)
+        weighted = fit_locations(lat, lng, count)
+        expanded = fit_locations(np.repeat(lat, count), np.repeat(lng, count), np.ones(count.sum(), dtype=int))
+        np.testing.assert_allclose(weighted, expanded, atol=1e-6)
+
+    def test_fit_warm_start(self):
+        lat, lng, count = self.make_points(2)
+        centroids = fit_locations(lat, lng, count)
+        np.testing.assert_allclose(fit_locations(lat, lng, count, init=centroids.tolist()), centroids)
+
+    def test_fit_warm_start_chooses_k(self):
+        # Centroids fitted to one place don't keep k at 1 once the points cover three.
+        lat, lng, count = self.make_points(4)
+        one = fit_locations(lat[:1], lng[:1], count[:1])
+        self.assertEqual(len(one), 1)
+        np.testing.assert_allclose(fit_locations(lat, lng, count, init=one.tolist()),
+                                   self.PLACES[[1, 2, 0]], atol=1e-3)
+
+    def test_fit_minibatch_and_coreset(self):
+        lat, lng, count = self.make_points(3, n=3000)
+        for options in [{'minibatch': True}, {'max_points': 500}, {'minibatch': True, 'max_points': 500}]:
+            with self.subTest(**options):
+                centroids = fit_locations(lat, lng, count, **options)
+                np.testing.assert_allclose(centroids, self.PLACES[[1, 2, 0]], atol=1e-3)
+
+    def test_fit_one_point(self):
+        centroids = fit_locations(np.array([42.36]), np.array([-71.06]), np.array([4]))
+        np.testing.assert_allclose(centroids, [[42.36, -71.06]])
+
+
+class TestWindowLocations(unittest.TestCase):
+    CENTROIDS = np.array([[42.36, -71.06], [42.40, -71.20], [42.30, -71.00], [44.48, -73.21]])
+
+    def make_gps(self, seed, n=3000):
+        rng = np.random.default_rng(seed)
+        timestamp = np.cumsum(rng.integers(1, 600000, n))
+        which = np.repeat(rng.choice(3, n // 10 + 1), 10)[:n]
+        which = np.where(rng.random(n) < .1, rng.choice(3, n), which)
+        coords = self.CENTROIDS[which] + rng.normal(scale=1e-3, size=(n, 2))
+        return pd.DataFrame({'timestamp': timestamp, 'latitude': coords[:, 0], 'longitude': coords[:, 1]}).iloc[::-1]
+
+    def test_windows_same_as_legacy(self):
+        df = self.make_gps(0)
+        bins = np.linspace(df['timestamp'].min(), df['timestamp'].max() + 1, 8).astype('int64')
+        count, duration, radius = _window_locations(self.CENTROIDS, df, bins)
+        for i in range(len(bins) - 1):
+            window = df[(df['timestamp'] >= bins[i]) & (df['timestamp'] < bins[i + 1])]
+            expected = legacy_window_locations(self.CENTROIDS, window)
+            with self.subTest(window=i):
+                self.assertEqual(duration[i].tolist(), [e['duration'] for e in expected])
+                np.testing.assert_allclose(count[i] / count[i].sum(), [e['proportion'] for e in expected])
+                self.assertEqual(np.isnan(radius[i]).tolist(), [e['radius'] is None for e in expected])
+                np.testing.assert_allclose(radius[i][count[i] > 0], [e['radius'] for e in expected if e['radius'] is not None])
+
+    def test_windows_empty(self):
+        df = self.make_gps(1, n=100)
+        count, duration, radius = _window_locations(self.CENTROIDS, df, np.array([0, 1, 2]))
+        self.assertEqual(count.tolist(), [[0] * 4] * 2)
+        self.assertEqual(duration.tolist(), [[0] * 4] * 2)
+
+
+class TestLocationModel(FakeLAMPTestCase):
+    PLACES = np.array([[42.36, -71.06], [42.40, -71.20], [42.30, -71.00]])
+
+    def setUp(self):
+        super().setUp()
+        # Fixes every 5 minutes for 4 days, an hour at a time at one of a few places, none on the
+        # edge between two days.
+        rng = np.random.default_rng(0)
+        timestamp = np.arange(0, 4 * DAY, 300000) + rng.integers(1, 60000, 4 * 288)
+        which = np.repeat(rng.choice(3, 4 * 24, p=[.5, .3, .2]), 12)
+        coords = self.PLACES[which] + rng.normal(scale=1e-4, size=(len(timestamp), 2))
+        self.serve(sensor_events('lamp.gps', timestamp, latitude=coords[:, 0].tolist(),
+                                 longitude=coords[:, 1].tolist()))
+        self.attachments = self.store()
+        self.module = sys.modules['cortex.primary.significant_locations']
+        patcher = mock.patch.dict(self.module._models, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(self.module, 'fit_locations', wraps=fit_locations)
+        self.fit = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def saves(self):
+        return [c for c in self.attachments.calls if c == ('set', 'U1', MODEL)]
+
+    def test_series_fits_once(self):
+        # A model fitted up to the end of the interval serves every window in it.
+        model = location_model(id='U1', start=0, end=3 * DAY)
+        for day in range(3):
+            significant_locations(id='U1', start=day * DAY, end=(day + 1) * DAY)
+        hometime(id='U1', start=0, end=4 * DAY, resolution=DAY)
+        entropy(id='U1', start=0, end=4 * DAY, resolution=DAY)
+        self.assertEqual(self.fit.call_count, 1)
+        self.assertEqual(len(self.saves()), 1)
+        self.assertIs(location_model(id='U1', start=0, end=2 * DAY), model)
+
+    def test_saved_model_reused(self):
+        # Another process reads the saved model instead of fitting its own.
+        model = location_model(id='U1', start=0, end=3 * DAY)
+        self.module._models.clear()
+        np.testing.assert_allclose(location_model(id='U1', start=0, end=3 * DAY)['centroids'], model['centroids'])
+        self.assertEqual(self.fit.call_count, 1)
+        self.assertEqual(len(self.saves()), 1)
+
+    def test_changed_parameters_refit(self):
+        location_model(id='U1', start=0, end=3 * DAY)
+        for i, params in enumerate([{'k_max': 5}, {'minibatch': True}, {'max_points': 200}], 2):
+            with self.subTest(**params):
+                location_model(id='U1', start=0, end=3 * DAY, **params)
+                self.assertEqual(self.fit.call_count, i)
+                self.assertEqual(self.fit.call_args[1], {'k_max': 10, 'init': mock.ANY, 'minibatch': False,
+                                                         'max_points': None, **params})
+        self.assertEqual(len(self.saves()), 4)
+
+    def test_changed_eps_reduces_again(self):
+        location_model(id='U1', start=0, end=3 * DAY)
+        with mock.patch.object(self.module, 'reduce_locations', wraps=reduce_locations) as reduce:
+            location_model(id='U1', start=0, end=3 * DAY, eps=1e-3)
+        # All the fixes are reduced again, without the points reduced with the old eps.
+        self.assertEqual(len(reduce.call_args[0][0]), 3 * 288)
+        self.assertEqual(len(reduce.call_args[0][2][0]), 0)
+        self.assertEqual(self.fit.call_count, 2)
+        self.assertEqual(self.attachments.attachments[('U1', MODEL)].count('"eps": 0.001'), 1)
+
+    def test_later_end_updates(self):
+        location_model(id='U1', start=0, end=2 * DAY)
+        with mock.patch.object(self.module, 'reduce_locations', wraps=reduce_locations) as reduce:
+            model = location_model(id='U1', start=0, end=3 * DAY)
+        # Only the fixes since the saved end are reduced, and the fit starts from the saved centroids.
+        self.assertEqual(len(reduce.call_args[0][0]), 288)
+        self.assertEqual(self.fit.call_count, 2)
+        self.assertEqual(model['end'], 3 * DAY)
+
+    def test_changed_attachment(self):
+        model = location_model(id='U1', start=0, end=3 * DAY)
+        with self.subTest('rewritten'):
+            # A model saved by another process since is used instead of the one kept.
+            body = self.attachments.get_attachment('U1', MODEL)['data']
+            body['centroids'] = body['centroids'][::-1]
+            self.attachments.set_attachment('U1', 'me', attachment_key=MODEL, body=body)
+            np.testing.assert_allclose(location_model(id='U1', start=0, end=3 * DAY)['centroids'],
+                                       model['centroids'][::-1])
+            self.assertEqual(self.fit.call_count, 1)
+        for name, reset in [('reset', lambda: self.attachments.set_attachment('U1', 'me', attachment_key=MODEL, body=None)),
+                            ('deleted', lambda: self.attachments.attachments.pop(('U1', MODEL)))]:
+            with self.subTest(name):
+                calls = self.fit.call_count
+                reset()
+                np.testing.assert_allclose(location_model(id='U1', start=0, end=3 * DAY)['centroids'],
+                                           model['centroids'])
+                self.assertEqual(self.fit.call_count, calls + 1)
+                self.assertIn(('U1', MODEL), self.attachments.attachments)
+
+    def test_no_gps(self):
+        self.serve([])
+        self.assertIsNone(location_model(id='U1', start=0, end=3 * DAY))
+        self.assertEqual(hometime(id='U1', start=0, end=3 * DAY, resolution=DAY)['data'],
+                         [{'timestamp': 0, 'hometime': None}, {'timestamp': DAY, 'hometime': None}])
+        self.assertEqual(self.saves(), [])
+
+    def test_hometime_and_entropy_same_as_per_window(self):
+        _hometime = hometime(id='U1', start=0, end=4 * DAY, resolution=DAY)['data']
+        _entropy = entropy(id='U1', start=0, end=4 * DAY, resolution=DAY)['data']
+        self.assertEqual([h['timestamp'] for h in _hometime], [0, DAY, 2 * DAY])
+        for h, e in zip(_hometime, _entropy):
+            locations = significant_locations(id='U1', start=h['timestamp'], end=h['timestamp'] + DAY)['data']
+            with self.subTest(window=h['timestamp']):
+                self.assertEqual(h['hometime'], [l['duration'] for l in locations if l['rank'] == 0][0])
+                self.assertAlmostEqual(e['entropy'], sum(l['proportion'] * math.log(l['proportion'])
+                                                         for l in locations if l['proportion'] > 0))
+        self.assertEqual(self.fit.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
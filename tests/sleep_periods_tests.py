@@ -0,0 +1,151 @@
+import unittest
+import datetime
+import sys, os
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from cortex.primary.sleep_periods import _nightly_sleep_periods
+from cortex.primary.accelerometer_bins import AccelerometerProfile, expected_sleep_period
+from tests.fixtures import accelerometer_bins, accelerometer_profile, wake_time
+
+
+def legacy_expected_sleep_period(accelerometer_data_reduced):
+    """
+    The expected sleep period search as it was before it used prefix sums.
+    """
+    df = pd.DataFrame.from_dict(accelerometer_data_reduced)
+    times = [(datetime.time(hour=h, minute=m), (datetime.datetime.combine(datetime.date.today(), datetime.time(hour=h, minute=m)) + datetime.timedelta(hours=8, minutes=0)).time()) for h in range(18, 24)  for m in [0, 30] ] + [(datetime.time(hour=h, minute=m), (datetime.datetime.combine(datetime.date.today(), datetime.time(hour=h, minute=m)) + datetime.timedelta(hours=8, minutes=0)).time()) for h in range(0, 4) for m in [0, 30]]
+
+    mean_activity = float('inf')
+    for t0, t1 in times:
+        if datetime.time(hour=18, minute=0) <= t0 <= datetime.time(hour=23, minute=30):
+            selection = pd.concat([df.loc[t0 <= df.time, :], df.loc[df.time <= t1, :]])
+        else:
+            selection = df.loc[(t0 <= df.time) & (df.time <= t1), :]
+        if len(selection) == 0 or selection['count'].sum() == 0:
+            continue
+        nonnan_ind = np.where(np.logical_not(np.isnan(selection['magnitude'])))[0]
+        nonnan_sel = selection.iloc[nonnan_ind]
+        sel_act = np.average(nonnan_sel['magnitude'], weights=nonnan_sel['count'])
+        if sel_act < mean_activity:
+            mean_activity = sel_act
+            _sleep_period_expected = {'bed': t0, 'wake': t1, 'accelerometer_magnitude': sel_act}
+
+    if mean_activity == float('inf'):
+        _sleep_period_expected = {'bed': None, 'wake': None, 'accelerometer_magnitude': None}
+    return _sleep_period_expected
+
+
+def legacy_sleep_periods(bins, reduced_data, bed_time, wake_time):
+    """
+    The per-night sleep period detection as it was before it was vectorized.
+    """
+    accelDf = pd.DataFrame({'Time': pd.to_datetime(bins['timestamp'], unit='ms'),
+                            'magnitude': bins['magnitude']})
+    df10min = pd.DataFrame.from_dict(reduced_data).sort_values(by='time')
+
+    sleepStart, sleepStartFlex = bed_time, (datetime.datetime.combine(datetime.date.today(), bed_time) -
+                                            datetime.timedelta(hours=2)).time()
+    sleepEnd, sleepEndFlex = wake_time, (datetime.datetime.combine(datetime.date.today(), wake_time) +
+                                         datetime.timedelta(hours=2)).time()
+
+    accelDf.loc[:, "Shifted Time"] = pd.to_datetime(accelDf['Time']) - \
+        (datetime.datetime.combine(datetime.date.min, sleepEndFlex) - datetime.datetime.min)
+    accelDf.loc[:, "Shifted Day"] = pd.to_datetime(accelDf['Shifted Time']).dt.date
+
+    sleepStartShifted = (datetime.datetime.combine(datetime.date.today(), sleepStart) -
+                         (datetime.datetime.combine(datetime.date.min, sleepEndFlex) -
+                          datetime.datetime.min)).time()
+    sleepStartFlexShifted = (datetime.datetime.combine(datetime.date.today(), sleepStartFlex) -
+                             (datetime.datetime.combine(datetime.date.min, sleepEndFlex) -
+                              datetime.datetime.min)).time()
+    sleepEndShifted = (datetime.datetime.combine(datetime.date.today(), sleepEnd) -
+                       (datetime.datetime.combine(datetime.date.min, sleepEndFlex) -
+                        datetime.datetime.min)).time()
+
+    _sleep_periods = []
+    for day, df in accelDf.groupby('Shifted Day'):
+        night_activity_count, night_inactivity_count = 0, 0
+        day_sleep_period_start = None
+        for t, tDf in df.groupby(pd.Grouper(key='Shifted Time', freq='10min')):
+            normal_time = t + (datetime.datetime.combine(datetime.date.min, sleepEndFlex) - datetime.datetime.min)
+            if len(df10min.loc[df10min['time'] == normal_time.time(), 'magnitude'].values) == 0:
+                continue
+            if (sleepStartFlexShifted <= t.time() < sleepStartShifted) or (sleepEndShifted <= t.time()):
+                if tDf['magnitude'].abs().mean() < df10min.loc[df10min['time'] == normal_time.time(), 'magnitude'].values[0]:
+                    night_inactivity_count += 1
+                    if day_sleep_period_start is None:
+                        day_sleep_period_start = normal_time.time()
+            elif sleepStartShifted <= t.time() < sleepEndShifted:
+                if tDf['magnitude'].abs().mean() > df10min.loc[df10min['time'] == normal_time.time(), 'magnitude'].values[0]:
+                    night_activity_count += 1
+
+        daily_sleep = (datetime.datetime.combine(datetime.date.today(), datetime.time(hour=8)) -
+                       datetime.timedelta(minutes=night_activity_count * 10) +
+                       datetime.timedelta(minutes=night_inactivity_count * 10)).time()
+        daily_sleep = daily_sleep.hour + daily_sleep.minute/60
+
+        if day_sleep_period_start is None:
+            day_sleep_period_start = bed_time
+        if day_sleep_period_start < datetime.time(hour=8):
+            sleep_period_timestamp = datetime.datetime.combine(day + datetime.timedelta(days=1),
+                                                               day_sleep_period_start).timestamp() * 1000
+        else:
+            sleep_period_timestamp = datetime.datetime.combine(day, day_sleep_period_start).timestamp() * 1000
+        _sleep_periods.append({'start': int(sleep_period_timestamp),
+                               'end': int(sleep_period_timestamp + (daily_sleep * 3600000))})
+    return _sleep_periods
+
+
+class TestSleepPeriods(unittest.TestCase):
+
+    def assertSameSleepPeriods(self, bins, profile, bed_time, wake_time):
+        expected = legacy_sleep_periods(bins, profile.records(), bed_time, wake_time)
+        actual = _nightly_sleep_periods(bins, profile.magnitude, bed_time, wake_time)
+        self.assertEqual(actual, expected)
+
+    def test_sleep_periods_same_as_legacy(self):
+        for seed in range(5):
+            bins = accelerometer_bins(seed)
+            profile = accelerometer_profile(bins)
+            for bed_time in [datetime.time(18, 0), datetime.time(22, 30), datetime.time(23, 30),
+                             datetime.time(0, 0), datetime.time(2, 30), datetime.time(3, 30)]:
+                with self.subTest(seed=seed, bed_time=bed_time):
+                    self.assertSameSleepPeriods(bins, profile, bed_time, wake_time(bed_time))
+
+    def test_sleep_periods_missing_baseline(self):
+        # Bins for times of day without a baseline are ignored.
+        bins = accelerometer_bins(7, days=3)
+        profile = AccelerometerProfile()
+        profile.add({k: v[:len(v) // 2] for k, v in bins.items()})
+        self.assertSameSleepPeriods(bins, profile, datetime.time(23, 0), datetime.time(7, 0))
+
+    def test_sleep_periods_one_bin(self):
+        bins = {k: v[100:101] for k, v in accelerometer_bins(8, days=1, gaps=0).items()}
+        profile = accelerometer_profile(bins)
+        self.assertSameSleepPeriods(bins, profile, datetime.time(22, 0), datetime.time(6, 0))
+
+    def test_expected_sleep_period_same_as_legacy(self):
+        for seed in range(10):
+            profile = accelerometer_profile(accelerometer_bins(seed, gaps=0.5))
+            expected = legacy_expected_sleep_period(profile.records())
+            actual = expected_sleep_period(profile)
+            with self.subTest(seed=seed):
+                self.assertEqual((actual['bed'], actual['wake']), (expected['bed'], expected['wake']))
+                self.assertAlmostEqual(actual['accelerometer_magnitude'], expected['accelerometer_magnitude'])
+
+    def test_expected_sleep_period_empty(self):
+        self.assertEqual(expected_sleep_period(AccelerometerProfile()),
+                         {'bed': None, 'wake': None, 'accelerometer_magnitude': None})
+
+    def test_expected_sleep_period_options(self):
+        # A quiet window from 01:00 to 06:00 is found with 10 minute steps and a 5 hour length.
+        profile = AccelerometerProfile()
+        profile.total[:], profile.count[:] = 10.0, 1
+        profile.total[6:37] = 1.0
+        period = expected_sleep_period(profile, step=10, hours=[5, 8])
+        self.assertEqual((period['bed'], period['wake']), (datetime.time(1, 0), datetime.time(6, 0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
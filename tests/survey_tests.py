@@ -0,0 +1,90 @@
+import unittest
+import random
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from cortex.raw.survey import _remove_duplicate_activity_events
+
+
+def legacy_remove_duplicate_activity_events(raw_data):
+    """
+    The duplicate removal as it was before it hashed the temporal slices.
+    """
+    raw_minus_duplicates = []
+    for index, event in enumerate(raw_data):
+        duplicates = list(filter(lambda x: x['temporal_slices']==event['temporal_slices'],raw_minus_duplicates))
+        if not len(duplicates)==0:
+            true_event = duplicates[0] if duplicates[0]['duration']>=event['duration'] else event
+            raw_minus_duplicates[raw_minus_duplicates.index(duplicates[0])] =  true_event
+        else:
+            raw_minus_duplicates.append(event)
+    return raw_minus_duplicates
+
+
+def event(timestamp, duration, slices):
+    return {'timestamp': timestamp, 'activity': 'A', 'duration': duration, 'temporal_slices': slices}
+
+
+def answer(item, value, duration=1000):
+    return {'item': item, 'value': value, 'type': None, 'duration': duration, 'level': None}
+
+
+class TestRemoveDuplicateActivityEvents(unittest.TestCase):
+
+    def test_no_duplicates(self):
+        raw = [event(3, 10, [answer('Q1', 'yes')]), event(2, 10, [answer('Q1', 'no')]),
+               event(1, 10, [answer('Q2', 'yes')])]
+        self.assertEqual(_remove_duplicate_activity_events(raw), raw)
+
+    def test_empty(self):
+        self.assertEqual(_remove_duplicate_activity_events([]), [])
+
+    def test_keeps_longest_duration(self):
+        raw = [event(3, 10, [answer('Q1', 'yes')]), event(2, 30, [answer('Q1', 'yes')]),
+               event(1, 20, [answer('Q1', 'yes')])]
+        self.assertEqual(_remove_duplicate_activity_events(raw), [raw[1]])
+
+    def test_keeps_first_when_tied(self):
+        raw = [event(2, 10, [answer('Q1', 'yes')]), event(1, 10, [answer('Q1', 'yes')])]
+        self.assertIs(_remove_duplicate_activity_events(raw)[0], raw[0])
+
+    def test_replaces_in_place(self):
+        # The longer duplicate takes the place of the first, not its own.
+        raw = [event(4, 10, [answer('Q1', 'yes')]), event(3, 10, [answer('Q2', 'no')]),
+               event(2, 50, [answer('Q1', 'yes')]), event(1, 10, [answer('Q3', 'no')])]
+        self.assertEqual(_remove_duplicate_activity_events(raw), [raw[2], raw[1], raw[3]])
+
+    def test_nested_slices(self):
+        # Slices are compared by value: dict key order doesn't matter, list order and nesting do.
+        a = event(3, 10, [{'item': 'Q1', 'value': ['x', {'y': 1, 'z': [2]}]}])
+        b = event(2, 20, [{'value': ['x', {'z': [2], 'y': 1}], 'item': 'Q1'}])
+        c = event(1, 30, [{'item': 'Q1', 'value': [{'y': 1, 'z': [2]}, 'x']}])
+        self.assertEqual(_remove_duplicate_activity_events([a, b, c]), [b, c])
+
+    def test_slice_order(self):
+        a = event(2, 10, [answer('Q1', 'yes'), answer('Q2', 'no')])
+        b = event(1, 20, [answer('Q2', 'no'), answer('Q1', 'yes')])
+        self.assertEqual(_remove_duplicate_activity_events([a, b]), [a, b])
+
+    def test_equal_numbers(self):
+        # As with ==, 1 and 1.0 are the same value.
+        a, b = event(2, 10, [answer('Q1', 1)]), event(1, 20, [answer('Q1', 1.0)])
+        self.assertEqual(_remove_duplicate_activity_events([a, b]), [b])
+
+    def test_empty_slices(self):
+        raw = [event(3, 10, []), event(2, 5, [answer('Q1', 'yes')]), event(1, 20, [])]
+        self.assertEqual(_remove_duplicate_activity_events(raw), [raw[2], raw[1]])
+
+    def test_same_as_legacy(self):
+        rng = random.Random(0)
+        raw = [event(i, rng.choice([10, 20, 30]),
+                     [answer(f'Q{j}', rng.choice(['yes', 'no', 1, None]), rng.choice([500, 1000]))
+                      for j in range(rng.randint(0, 2))])
+               for i in range(500)]
+        expected = legacy_remove_duplicate_activity_events(raw)
+        actual = _remove_duplicate_activity_events(raw)
+        self.assertEqual(len(actual), len(expected))
+        self.assertTrue(all(a is e for a, e in zip(actual, expected)))
+
+
+if __name__ == '__main__':
+    unittest.main()
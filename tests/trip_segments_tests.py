@@ -0,0 +1,105 @@
+import unittest
+import json
+import sys, os
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from cortex.primary.trips import TripSegmenter
+
+
+def legacy_trips(gps_data):
+    """
+    The trip segmentation as it was before it was vectorized.
+    """
+    def haversine_np(lon1, lat1, lon2, lat2):
+        lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+        dlon = lon2 - lon1
+        dlat = lat2 - lat1
+        a = np.sin(dlat/2.0)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2.0)**2
+        c = 2 * np.arcsin(np.sqrt(a))
+        return 6367 * c
+
+    SPEED_THRESHOLD = 10.0
+    TIME_THRESHOLD = 600
+
+    gps_data['dt'] = (gps_data['timestamp'] - gps_data['timestamp'].shift()) / (1000*3600)
+    gps_data['dx'] = haversine_np(
+        gps_data.latitude.shift(fill_value=0), gps_data.longitude.shift(fill_value=0),
+        gps_data.loc[1:, 'latitude'], gps_data.loc[1:, 'longitude']
+    )
+    gps_data['speed'] = gps_data['dx'] / gps_data['dt']
+    gps_data['stationary'] = ((gps_data['speed'] < SPEED_THRESHOLD) | (gps_data['dt'] > TIME_THRESHOLD))
+    gps_data['stationary_1'] = gps_data['stationary'].shift()
+    gps_data['idx'] = gps_data.index
+    new = gps_data[gps_data['stationary'] != gps_data['stationary_1']].copy()
+    new['idx_shift'] = new['idx'].shift(-1, fill_value=0)
+    new = new[new['idx_shift'] != 0]
+    new['distance'] = new.apply(lambda row: gps_data['dx'][row['idx']:row['idx_shift']].sum(), axis=1)
+    new['end'] = new.apply(lambda row: gps_data['timestamp'][row['idx_shift'] - 1], axis=1)
+    new = new[['timestamp', 'end', 'latitude', 'longitude', 'distance']]
+    new.columns = ['start', 'end', 'latitude', 'longitude', 'distance']
+    return list(new.T.to_dict().values())
+
+
+class TestTripSegmenter(unittest.TestCase):
+
+    def make_gps(self, seed, n=2000):
+        """
+        A random walk of GPS fixes alternating between staying put and moving, with some
+        repeated timestamps and long gaps.
+        """
+        rng = np.random.default_rng(seed)
+        timestamp = 1617235200000 + np.cumsum(rng.choice([0, 1000, 60000, 300000, 3 * 10**9], n,
+                                                         p=[.02, .3, .5, .17, .01]))
+        moving = np.repeat(rng.random(n // 50) < .5, 50)
+        step = np.where(moving, .01, .00001)[:, None] * rng.normal(size=(n, 2))
+        latitude, longitude = (np.array([42.33, -71.1]) + np.cumsum(step, axis=0)).T
+        return pd.DataFrame({'timestamp': timestamp, 'latitude': latitude, 'longitude': longitude})
+
+    def assertSameTrips(self, actual, expected):
+        self.assertEqual(len(actual), len(expected))
+        for a, e in zip(actual, expected):
+            self.assertEqual((a['start'], a['end'], a['latitude'], a['longitude']),
+                             (e['start'], e['end'], e['latitude'], e['longitude']))
+            self.assertAlmostEqual(a['distance'], e['distance'])
+
+    def test_trips_same_as_legacy(self):
+        for seed in range(5):
+            df = self.make_gps(seed)
+            actual = TripSegmenter().add(df['timestamp'], df['latitude'], df['longitude'])
+            with self.subTest(seed=seed):
+                self.assertSameTrips(actual, legacy_trips(df.copy()))
+
+    def test_trips_chunked(self):
+        # Trips open at the end of a chunk are continued by the next one.
+        df = self.make_gps(5)
+        expected = TripSegmenter().add(df['timestamp'], df['latitude'], df['longitude'])
+        for size in [1, 7, 50, 333]:
+            segmenter, actual = TripSegmenter(), []
+            for i in range(0, len(df), size):
+                chunk = df.iloc[i:i + size]
+                actual += segmenter.add(chunk['timestamp'], chunk['latitude'], chunk['longitude'])
+            with self.subTest(size=size):
+                self.assertSameTrips(actual, expected)
+
+    def test_trips_resumed_from_attachment(self):
+        # Trips continue across runs through the saved state, as in incremental updates.
+        df = self.make_gps(6)
+        expected = TripSegmenter().add(df['timestamp'], df['latitude'], df['longitude'])
+        state, actual = None, []
+        for i in range(0, len(df), 400):
+            segmenter = TripSegmenter.from_attachment(json.loads(state)) if state else TripSegmenter()
+            chunk = df.iloc[i:i + 400]
+            actual += segmenter.add(chunk['timestamp'], chunk['latitude'], chunk['longitude'])
+            segmenter.end = int(chunk['timestamp'].iloc[-1])
+            state = json.dumps(segmenter.to_attachment())
+        self.assertSameTrips(actual, expected)
+        self.assertEqual(json.loads(state)['end'], df['timestamp'].iloc[-1])
+
+    def test_trips_few_fixes(self):
+        self.assertEqual(TripSegmenter().add([], [], []), [])
+        self.assertEqual(TripSegmenter().add([1617235200000], [42.33], [-71.1]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
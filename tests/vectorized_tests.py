@@ -0,0 +1,87 @@
+import unittest
+import sys, os
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from tests.fake_lamp import FakeLAMPTestCase, sensor_events
+from cortex.raw.calls import calls
+from cortex.feature_types import _bincount
+from cortex.secondary.call_number import call_number
+from cortex.secondary.call_duration import call_duration
+
+HOUR = 3600000
+
+
+def legacy_bincount(timestamps, bins, weights=None):
+    """
+    The per-window count (or sum of weights) of the events in each window [bins[i], bins[i+1]).
+    """
+    weights = np.ones(len(timestamps), dtype=int) if weights is None else np.asarray(weights)
+    return np.array([sum(w for t, w in zip(timestamps, weights) if start <= t < end)
+                     for start, end in zip(bins[:-1], bins[1:])])
+
+
+class TestBincount(unittest.TestCase):
+
+    def test_same_as_legacy(self):
+        rng = np.random.default_rng(0)
+        timestamps = rng.integers(-10 * HOUR, 60 * HOUR, 2000)
+        bins = np.arange(0, 48 * HOUR + 1, HOUR)
+        for weights in [None, rng.integers(0, 100, 2000), rng.random(2000)]:
+            with self.subTest(weights=None if weights is None else weights.dtype):
+                expected = legacy_bincount(timestamps, bins, weights)
+                actual = _bincount(timestamps, bins, weights)
+                np.testing.assert_allclose(actual, expected)
+                self.assertEqual(actual.dtype.kind, expected.dtype.kind)
+
+    def test_edges(self):
+        # Windows are half-open, and events outside all windows are left out.
+        bins = np.array([0, 10, 20])
+        np.testing.assert_array_equal(_bincount([-1, 0, 9, 10, 19, 20, 25], bins), [2, 2])
+        np.testing.assert_array_equal(_bincount([], bins), [0, 0])
+        np.testing.assert_array_equal(_bincount([5, 15], bins, weights=[2.5, 1.5]), [2.5, 1.5])
+
+
+class TestVectorizedFeatures(FakeLAMPTestCase):
+
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(1)
+        timestamp = rng.integers(0, 72 * HOUR, 1500)
+        # Events on the edge between two windows are counted in both by the per-window features.
+        timestamp = timestamp[timestamp % HOUR != 0]
+        self.serve(sensor_events('lamp.calls', timestamp, call_type=rng.choice([1, 2], len(timestamp)).tolist(),
+                                 call_duration=rng.integers(1, 600, len(timestamp)).tolist(),
+                                 call_trace=rng.choice(['a', 'b', 'c'], len(timestamp)).tolist()))
+
+    def legacy(self, incoming):
+        """
+        The call number and duration as they were computed before, one window at a time.
+        """
+        label = {True: 1, False: 2}[incoming]
+        result = []
+        for start in range(HOUR, 60 * HOUR - HOUR, HOUR):
+            _calls = calls(id='U1', start=start, end=start + HOUR, cache=False)['data']
+            result.append({'timestamp': start,
+                           'call_number': len([c for c in _calls if c['call_type'] == label]),
+                           'call_duration': sum(c['call_duration'] for c in _calls if c['call_type'] == label)})
+        return result
+
+    def test_same_as_per_window(self):
+        for incoming in [True, False]:
+            expected = self.legacy(incoming)
+            number = call_number(id='U1', start=HOUR, end=60 * HOUR, resolution=HOUR, incoming=incoming)['data']
+            duration = call_duration(id='U1', start=HOUR, end=60 * HOUR, resolution=HOUR, incoming=incoming)['data']
+            with self.subTest(incoming=incoming):
+                self.assertEqual([{'timestamp': e['timestamp'], 'call_number': e['call_number']} for e in expected],
+                                 number)
+                self.assertEqual([{'timestamp': e['timestamp'], 'call_duration': e['call_duration']} for e in expected],
+                                 duration)
+
+    def test_no_events(self):
+        self.serve([])
+        self.assertEqual(call_number(id='U1', start=0, end=3 * HOUR, resolution=HOUR)['data'],
+                         [{'timestamp': 0, 'call_number': 0}, {'timestamp': HOUR, 'call_number': 0}])
+
+
+if __name__ == '__main__':
+    unittest.main()